@@ -1,32 +1,236 @@
 import os
+import weakref
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import Flask, Response, abort, render_template, send_file, stream_template, stream_with_context, request, flash, get_flashed_messages, redirect, session, g, jsonify
+from flask.testing import FlaskClient
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows, LikeCounterShard, ArchivedMessage, Notification
+from assets import asset_url, assets_cli, load_manifest, send_asset, use_template_cache
+from archive import archive_cli, cursor_for as message_cursor, get_message, user_messages_page
+from bulk import ingest_messages
+from compression import init_compression
+from directory import ORDERINGS, cursor_for, directory_page
+from export import export_cli, export_stream, read_resume_token
+from counters import apply_like_deltas, like_counts, likes_cli
+from notifications import discard_notifications, mark_read, mention_notifications, notifications_page, notify
+from partitions import partitions_cli, prepare_partitions
+from queries import engine_options, feed_messages, following_ids, user_by_id
+from ranking import AffinityCache, ranked_messages
+from recommendations import recommendations_cli, suggestions_for
+from sharding import shard_binds, shards_cli
+from images import ensure_variant, image_path, parse_image_name, save_upload, sized
+from cooperative import patch_psycopg
+from metrics import init_metrics
+from slowlog import init_slow_query_log, slowlog_cli
+from profiling import init_profiling, profile_cli
+from likes import LikeBuffer, liked_message_ids, likes_buffer
+from hashtags import extract_hashtags, index_messages, is_hashtag, link_hashtags, tagged_messages, tags_cli, unindex_messages
+from trending import TrendTracker, init_trending, record_hashtags, trending, trending_cli
+from stream import Broadcaster, announce_new_messages, event_stream, message_event
 
 CURR_USER_KEY = "curr_user"
 
+# Apps built in this process, so a forked worker can reset them
+_apps = weakref.WeakSet()
+_fork_hook_registered = False
+
+
+def init_worker_state(app):
+    """Set up the state each worker process keeps for itself."""
+
+    app.extensions['broadcaster'] = Broadcaster(app,
+                                                max_connections=app.config['STREAM_MAX_CONNECTIONS'],
+                                                poll_interval=app.config['STREAM_POLL_INTERVAL'])
+    app.extensions['trends'] = TrendTracker(flush_seconds=app.config['TRENDING_FLUSH_SECONDS'])
+    app.extensions['affinities'] = AffinityCache(ttl=app.config['RANKED_AFFINITY_TTL'])
+    app.extensions['likes'] = LikeBuffer(app, app.config['LIKE_JOURNAL_FOLDER'],
+                                         flush_seconds=app.config['LIKE_FLUSH_SECONDS'])
+
+
+def start_worker(concurrency=None):
+    """Get a freshly started worker ready (gunicorn's post_worker_init).
+
+    Takes over the journaled likes of dead workers and creates the coming
+    months' message partitions. `concurrency` is how many requests the
+    worker serves at once; live timeline connections are held to one fewer,
+    so a sync worker (1) refuses them rather than being tied up by one.
+    """
+
+    for app in list(_apps):
+        if concurrency is not None:
+            broadcaster = app.extensions['broadcaster']
+            broadcaster.max_connections = min(broadcaster.max_connections, concurrency - 1)
+        app.extensions['likes'].recover()
+        with app.app_context():
+            prepare_partitions()
+
+
+def reset_after_fork():
+    """Give a forked worker (e.g. under `gunicorn --preload`) its own connections and state.
+
+    Pooled connections inherited from the parent are dropped without being
+    closed, since the parent may still be using them.
+    """
+
+    for app in list(_apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+        init_worker_state(app)
+
+
+def track_app(app):
+    """Remember `app` for reset_after_fork and start_worker.
+
+    The fork hook is registered along with the first app, so merely importing
+    this module changes nothing.
+    """
+
+    global _fork_hook_registered
+    if not _fork_hook_registered:
+        os.register_at_fork(after_in_child=reset_after_fork)
+        _fork_hook_registered = True
+    _apps.add(app)
+
+
+class ReadThroughClient(FlaskClient):
+    """Test client that reads each response body to the end, as a server would.
+
+    Streamed pages hold their request context, and so the database session,
+    until the body is finished or closed. Reading it here releases them, even
+    when a test only looks at the status, and before the contexts kept by
+    `with client:` are pushed back. Pass buffered=False to read a stream
+    yourself.
+    """
+
+    def open(self, *args, buffered=True, **kwargs):
+        return super().open(*args, buffered=buffered, **kwargs)
+
 
 def create_app(database='postgresql:///warbler', csrf=True):
     app = Flask(__name__)
+    app.test_client_class = ReadThroughClient
 
     # Get DB_URI from environ variable (useful for production/testing) or,
     # if not set there, use development local db.
     app.config['SQLALCHEMY_DATABASE_URI'] = (
         os.environ.get('DATABASE_URL', database))
 
+    # Databases for users' messages, likes and follows; see sharding.py
+    app.config['SHARD_DATABASE_URLS'] = [url for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if url]
+    app.config['SQLALCHEMY_BINDS'] = shard_binds(app.config['SHARD_DATABASE_URLS'])
+
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Only psycopg 3 can prepare statements server-side; see queries.py
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], int(os.environ.get('DB_PREPARE_THRESHOLD', 5)))
     app.config['SQLALCHEMY_ECHO'] = False
     app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
     app.config['WTF_CSRF_ENABLED'] = csrf
 
+    # Live timeline (Server-Sent Events). Limits are per worker process.
+    app.config['STREAM_MAX_CONNECTIONS'] = int(os.environ.get('STREAM_MAX_CONNECTIONS', 100))
+    app.config['STREAM_HEARTBEAT'] = float(os.environ.get('STREAM_HEARTBEAT', 15))
+    app.config['STREAM_POLL_INTERVAL'] = float(os.environ.get('STREAM_POLL_INTERVAL', 2))
+
+    # Like counters: messages past the threshold spread their count over shards.
+    app.config['LIKE_COUNTER_HOT_THRESHOLD'] = int(os.environ.get('LIKE_COUNTER_HOT_THRESHOLD', 1000))
+    app.config['LIKE_COUNTER_SHARDS'] = int(os.environ.get('LIKE_COUNTER_SHARDS', 16))
+
+    # Likes are buffered per worker and written this often; see likes.py
+    app.config['LIKE_FLUSH_SECONDS'] = float(os.environ.get('LIKE_FLUSH_SECONDS', 1))
+    app.config['LIKE_JOURNAL_FOLDER'] = os.environ.get('LIKE_JOURNAL_FOLDER',
+                                                       os.path.join(app.instance_path, 'like-journal'))
+    app.config['LIKE_BATCH_MAX'] = int(os.environ.get('LIKE_BATCH_MAX', 200))
+
+    # Bulk message ingestion
+    app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+    app.config['BULK_MAX_ROWS'] = int(os.environ.get('BULK_MAX_ROWS', 10000))
+
+    app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 48))
+
+    # Messages older than this many days are moved to the archive table
+    app.config['ARCHIVE_HORIZON_DAYS'] = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 180))
+
+    # Each worker merges its hashtag counts into the database this often
+    app.config['TRENDING_FLUSH_SECONDS'] = float(os.environ.get('TRENDING_FLUSH_SECONDS', 60))
+
+    # Uploaded images
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(app.instance_path, 'uploads'))
+    app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 5 * 1024 * 1024))
+
+    # Built (fingerprinted, precompressed) static assets; see assets.py
+    app.config['ASSETS_FOLDER'] = os.environ.get('ASSETS_FOLDER', os.path.join(app.static_folder, 'dist'))
+
+    # Compiled templates, written by `flask assets build`
+    app.config['TEMPLATE_CACHE_FOLDER'] = os.environ.get('TEMPLATE_CACHE_FOLDER',
+                                                         os.path.join(app.instance_path, 'jinja-cache'))
+
+    # Response compression; levels are per codec and kept low to spare CPU
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 5))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    app.config['COMPRESS_STREAM_FLUSH_BYTES'] = int(os.environ.get('COMPRESS_STREAM_FLUSH_BYTES', 8192))
+
+    # Ranked ("top") home timeline
+    app.config['RANKED_CANDIDATES'] = int(os.environ.get('RANKED_CANDIDATES', 500))
+    app.config['RANKED_BUDGET_MS'] = float(os.environ.get('RANKED_BUDGET_MS', 50))
+    app.config['RANKED_AFFINITY_TTL'] = float(os.environ.get('RANKED_AFFINITY_TTL', 300))
+    app.config['RANKED_AFFINITY_LIKES'] = int(os.environ.get('RANKED_AFFINITY_LIKES', 1000))
+
+    # Slow-query log, off unless SLOW_QUERY_MS is set; see slowlog.py
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 0))
+    app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', os.path.join(app.instance_path, 'slow-queries.log'))
+    app.config['SLOW_QUERY_LOG_BYTES'] = int(os.environ.get('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024))
+    app.config['SLOW_QUERY_LOG_BACKUPS'] = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 5))
+    app.config['SLOW_QUERY_EXPLAIN_SECONDS'] = float(os.environ.get('SLOW_QUERY_EXPLAIN_SECONDS', 300))
+    app.config['SLOW_QUERY_EXPLAIN_ANALYZE'] = os.environ.get('SLOW_QUERY_EXPLAIN_ANALYZE', '').lower() in ('1', 'true', 'yes')
+
+    # Request profiling, for a sample of requests or with a signed header; see profiling.py
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_MODE'] = os.environ.get('PROFILE_MODE', 'sample')
+    app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+    app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', os.path.join(app.instance_path, 'profiles'))
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 200))
+    app.config['PROFILE_TOKEN_SECONDS'] = int(os.environ.get('PROFILE_TOKEN_SECONDS', 600))
+
     # toolbar = DebugToolbarExtension(app)
 
+    # Under gevent workers, database waits yield to other requests
+    patch_psycopg()
     connect_db(app)
+    with app.app_context():
+        init_metrics(app, db.engines)
+        init_slow_query_log(app, db.engines)
+    init_profiling(app)
+    init_trending(app)
+    init_compression(app)
+
+    init_worker_state(app)
+    track_app(app)
+    app.extensions['assets'] = load_manifest(app.config['ASSETS_FOLDER'])
+    use_template_cache(app)
+
+    app.cli.add_command(likes_cli)
+    app.cli.add_command(export_cli)
+    app.cli.add_command(partitions_cli)
+    app.cli.add_command(archive_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(trending_cli)
+    app.cli.add_command(tags_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(shards_cli)
+    app.cli.add_command(slowlog_cli)
+    app.cli.add_command(profile_cli)
+
+    app.add_template_filter(link_hashtags, 'hashtags')
+    app.add_template_filter(sized)
+    app.add_template_global(asset_url)
 
     ##############################################################################
     # Utils
@@ -36,6 +240,18 @@ def create_app(database='postgresql:///warbler', csrf=True):
         form = MessageForm()
         return dict(nmf=form)
 
+    def stream_page(template, **context):
+        """Render a (long) page with stream_template, so its first bytes go out early.
+
+        The session cookie goes out with the headers, before the template
+        runs, so flashed messages are popped here and passed in as `flashes`.
+        The request context, and with it the database session, lasts until
+        the body is finished or closed.
+        """
+
+        context['flashes'] = get_flashed_messages(with_categories=True)
+        return stream_template(template, **context)
+
     # app name
     @app.errorhandler(404)
     def not_found(e):
@@ -49,7 +265,7 @@ def create_app(database='postgresql:///warbler', csrf=True):
         """If we're logged in, add curr user to Flask global."""
 
         if CURR_USER_KEY in session:
-            g.user = User.query.get(session[CURR_USER_KEY])
+            g.user = user_by_id(session[CURR_USER_KEY])
 
         else:
             g.user = None
@@ -81,12 +297,20 @@ def create_app(database='postgresql:///warbler', csrf=True):
         form = UserAddForm()
 
         if form.validate_on_submit():
+            image_url = form.image_url.data or User.image_url.default.arg
+            if form.image.data:
+                try:
+                    image_url = save_upload(form.image.data, 'avatar')
+                except ValueError as e:
+                    form.image.errors.append(str(e))
+                    return render_template('users/signup.html', form=form)
+
             try:
                 user = User.signup(
                     username=form.username.data,
                     password=form.password.data,
                     email=form.email.data,
-                    image_url=form.image_url.data or User.image_url.default.arg,
+                    image_url=image_url,
                 )
                 db.session.commit()
 
@@ -136,32 +360,53 @@ def create_app(database='postgresql:///warbler', csrf=True):
     def list_users():
         """Page with listing of users.
 
-        Can take a 'q' param in querystring to search by that username.
+        Can take a 'q' param in querystring to search by that username,
+        'order' (newest, followers or username) and 'after', the cursor of
+        the last user on the previous page.
+
+        The page is streamed, so the first cards go out while later rows are
+        still being fetched.
         """
         search = request.args.get('q')
+        order = request.args.get('order')
+        if order not in ORDERINGS:
+            order = 'newest'
+        per_page = app.config['USERS_PER_PAGE']
 
-        if not search:
-            users = User.query.all()
-        else:
-            users = User.query.filter(User.username.like(f"%{search}%")).all()
+        stmt = select(User)
+        if search:
+            stmt = stmt.where(User.username.like(f"%{search}%"))
+        stmt = directory_page(stmt, order, request.args.get('after'), per_page)
 
-        return render_template('users/index.html', users=users)
+        users = db.session.execute(stmt.execution_options(yield_per=per_page)).scalars()
+
+        following = set()
+        if g.user:
+            following = {row.user_being_followed_id for row in
+                         Follows.query.filter_by(user_following_id=g.user.id)}
+
+        return stream_page('users/index.html', users=users, following=following,
+                           search=search, order=order, orderings=ORDERINGS,
+                           per_page=per_page, cursor_for=cursor_for)
 
     @app.route('/users/<int:user_id>')
     def users_show(user_id):
-        """Show user profile."""
+        """Show user profile.
+
+        Can take a 'before' param, the cursor of the last message on the
+        previous page, to page back through older (possibly archived)
+        messages.
+        """
 
         user = User.query.get_or_404(user_id)
 
         # snagging messages in order from the database;
         # user.messages won't be in order by default
-        messages = (Message
-                    .query
-                    .filter(Message.user_id == user_id)
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('users/show.html', user=user, messages=messages)
+        messages = user_messages_page(user_id, request.args.get('before'), 100)
+        liked = liked_message_ids(g.user, (msg.id for msg in messages)) if g.user else set()
+        older = message_cursor(messages[-1]) if len(messages) == 100 else None
+
+        return stream_page('users/show.html', user=user, messages=messages, liked=liked, older=older)
 
     @app.route('/users/<int:user_id>/likes')
     def users_likes(user_id):
@@ -173,9 +418,10 @@ def create_app(database='postgresql:///warbler', csrf=True):
 
         user = User.query.get_or_404(user_id)
 
-        messages = user.likes
+        messages = user.liked_messages()
+        liked = liked_message_ids(g.user, (msg.id for msg in messages))
 
-        return render_template('users/likes.html', user=user, messages=messages)
+        return stream_page('users/likes.html', user=user, messages=messages, liked=liked)
 
     @app.route('/users/<int:user_id>/following')
     def show_following(user_id):
@@ -186,7 +432,8 @@ def create_app(database='postgresql:///warbler', csrf=True):
             return redirect("/")
 
         user = User.query.get_or_404(user_id)
-        return render_template('users/following.html', user=user)
+        return stream_page('users/following.html', user=user, users=user.following_users(),
+                           following=set(following_ids(g.user.id)))
 
     @app.route('/users/<int:user_id>/followers')
     def users_followers(user_id):
@@ -197,7 +444,8 @@ def create_app(database='postgresql:///warbler', csrf=True):
             return redirect("/")
 
         user = User.query.get_or_404(user_id)
-        return render_template('users/followers.html', user=user)
+        return stream_page('users/followers.html', user=user, users=user.follower_users(),
+                           following=set(following_ids(g.user.id)))
 
     @app.route('/users/follow/<int:follow_id>', methods=['POST'])
     def add_follow(follow_id):
@@ -208,8 +456,11 @@ def create_app(database='postgresql:///warbler', csrf=True):
             return redirect("/")
 
         followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
-        db.session.commit()
+        if not db.session.get(Follows, (follow_id, g.user.id)):
+            db.session.add(Follows(user_being_followed_id=follow_id, user_following_id=g.user.id))
+            followed_user.follower_count = User.follower_count + 1
+            notify([{'user_id': follow_id, 'actor_id': g.user.id, 'kind': 'follow'}])
+            db.session.commit()
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -221,9 +472,14 @@ def create_app(database='postgresql:///warbler', csrf=True):
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
-        db.session.commit()
+        followed_user = User.query.get_or_404(follow_id)
+        follow = db.session.get(Follows, (follow_id, g.user.id))
+        if follow:
+            db.session.delete(follow)
+            followed_user.follower_count = User.follower_count - 1
+            discard_notifications(Notification.kind == 'follow', Notification.user_id == follow_id,
+                                  Notification.actor_id == g.user.id)
+            db.session.commit()
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -241,10 +497,21 @@ def create_app(database='postgresql:///warbler', csrf=True):
             # POST - The user submitted the form. Check that they are authorized to edit the profile
             u = User.authenticate(g.user.username, form.password.data)
             if u:
+                # Uploads take precedence over URLs
+                image_url, header_image_url = form.image_url.data, form.header_image_url.data
+                try:
+                    if form.image.data:
+                        image_url = save_upload(form.image.data, 'avatar')
+                    if form.header_image.data:
+                        header_image_url = save_upload(form.header_image.data, 'header')
+                except ValueError as e:
+                    flash(str(e), "danger")
+                    return render_template('/users/edit.html', form=form)
+
                 u.update_profile(form.username.data,
                                  form.email.data,
-                                 form.image_url.data,
-                                 form.header_image_url.data,
+                                 image_url,
+                                 header_image_url,
                                  form.bio.data)
                 flash('You have successfully updated your profile!', 'success')
                 return redirect(f'/users/{g.user.id}')
@@ -261,6 +528,52 @@ def create_app(database='postgresql:///warbler', csrf=True):
 
         return render_template('/users/edit.html', form=form)
 
+    @app.route('/api/users/<int:user_id>/suggestions')
+    def users_suggestions(user_id):
+        """Precomputed "who to follow" suggestions for the current user."""
+
+        if not g.user or g.user.id != user_id:
+            return jsonify({'warning': 'Access unauthorized.'}), 401
+
+        limit = min(request.args.get('limit', 10, type=int), 50)
+        suggestions = [{'id': s.suggested_user.id,
+                        'username': s.suggested_user.username,
+                        'image_url': s.suggested_user.image_url,
+                        'score': s.score}
+                       for s in suggestions_for(user_id, limit)]
+
+        return jsonify({'suggestions': suggestions}), 200
+
+    @app.route('/users/<int:user_id>/export')
+    def export_user(user_id):
+        """Download everything in the current user's account.
+
+        Takes `format` (ndjson or csv) and `resume`, the token from the last
+        checkpoint of an interrupted download.
+        """
+
+        if not g.user or g.user.id != user_id:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in ('ndjson', 'csv'):
+            return jsonify({'warning': 'format must be ndjson or csv.'}), 400
+
+        resume = request.args.get('resume')
+        if resume:
+            try:
+                read_resume_token(user_id, resume)
+            except ValueError as e:
+                return jsonify({'warning': str(e)}), 400
+
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        filename = f"warbler-{g.user.username}.{fmt}"
+
+        return Response(stream_with_context(export_stream(user_id, fmt, resume)),
+                        mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
     @app.route('/users/delete', methods=["POST"])
     def delete_user():
         """Delete user."""
@@ -271,6 +584,41 @@ def create_app(database='postgresql:///warbler', csrf=True):
 
         do_logout()
 
+        # The database drops this user's likes along with them; take them off
+        # the counters first.
+        liked_ids = [row.message_id for row in Likes.query.filter_by(user_id=g.user.id)]
+        apply_like_deltas({message_id: -1 for message_id in liked_ids})
+        # Archived messages keep their likes, and their own count of them
+        ArchivedMessage.query.filter(ArchivedMessage.id.in_(liked_ids)).update(
+            {ArchivedMessage.like_count: ArchivedMessage.like_count - 1}, synchronize_session=False)
+
+        # ...and the users they follow lose a follower.
+        User.query.filter(User.id.in_(following_ids(g.user.id))).update(
+            {User.follower_count: User.follower_count - 1}, synchronize_session=False)
+
+        # Likes of this user's messages aren't cascaded once messages is
+        # partitioned. The ids are read up front because with shards, the
+        # likes and messages may be in different databases.
+        own_message_ids = db.session.scalars(select(Message.id).where(Message.user_id == g.user.id)).all()
+        own_archived_ids = db.session.scalars(
+            select(ArchivedMessage.id).where(ArchivedMessage.user_id == g.user.id)).all()
+        Likes.query.filter(Likes.message_id.in_(own_message_ids + own_archived_ids)).delete(
+            synchronize_session=False)
+        LikeCounterShard.query.filter(LikeCounterShard.message_id.in_(own_message_ids)).delete(
+            synchronize_session=False)
+        unindex_messages(own_message_ids)
+        unindex_messages(own_archived_ids)
+
+        # Shards have no foreign keys to cascade these either
+        Likes.query.filter_by(user_id=g.user.id).delete(synchronize_session=False)
+        Follows.query.filter((Follows.user_following_id == g.user.id)
+                             | (Follows.user_being_followed_id == g.user.id)).delete(synchronize_session=False)
+
+        # Other users' notifications about this user would otherwise vanish
+        # by cascade without coming off their unread counts
+        discard_notifications(Notification.actor_id == g.user.id)
+        discard_notifications(Notification.message_id.in_(own_message_ids))
+
         db.session.delete(g.user)
         db.session.commit()
 
@@ -295,30 +643,72 @@ def create_app(database='postgresql:///warbler', csrf=True):
             return redirect("/")
 
         if form.validate_on_submit():
-            msg = Message(text=form.text.data)
-            g.user.messages.append(msg)
+            msg = Message(text=form.text.data, user_id=g.user.id)
+            db.session.add(msg)
+            db.session.flush()
+            index_messages([msg])
+            notify(mention_notifications(g.user.id, [(msg.id, msg.text)]))
+            announce_new_messages()
             db.session.commit()
 
+            record_hashtags([extract_hashtags(msg.text)])
+
             return redirect(f"/users/{g.user.id}")
 
 
+    @app.route('/api/messages/bulk', methods=["POST"])
+    def messages_bulk_add():
+        """Add many messages for the current user from an NDJSON body.
+
+        Each line is an object with `text` and optionally an ISO 8601
+        `timestamp`. Bad lines are reported by line number; the rest are
+        inserted. The body must be sent as application/x-ndjson: a
+        cross-site form can't use that type, so this stands in for a CSRF
+        token.
+        """
+
+        if not g.user:
+            return jsonify({'warning': 'Access unauthorized.'}), 401
+
+        if request.mimetype != 'application/x-ndjson':
+            return jsonify({'warning': 'Send messages as application/x-ndjson.'}), 415
+
+        inserted, errors = ingest_messages(g.user.id, request.stream,
+                                           chunk_size=app.config['BULK_CHUNK_SIZE'],
+                                           max_rows=app.config['BULK_MAX_ROWS'])
+
+        return jsonify({'inserted': inserted, 'errors': errors}), 200
+
     @app.route('/messages/<int:message_id>', methods=["GET"])
     def messages_show(message_id):
         """Show a message."""
 
-        msg = Message.query.get_or_404(message_id)
-        return render_template('messages/show.html', message=msg)
+        msg = get_message(message_id)
+        if msg is None:
+            abort(404)
+
+        like_count = msg.like_count if msg.archived else like_counts([msg])[msg.id]
+        return render_template('messages/show.html', message=msg, like_count=like_count)
 
     @app.route('/messages/<int:message_id>/delete', methods=["POST"])
     def messages_destroy(message_id):
         """Delete a message."""
 
-        msg = Message.query.get_or_404(message_id)
+        msg = get_message(message_id)
+        if msg is None:
+            abort(404)
 
         if not g.user or msg.user_id != g.user.id:
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
+        # No foreign key cascades these: archived messages keep their likes,
+        # and messages may be partitioned
+        Likes.query.filter_by(message_id=msg.id).delete()
+        LikeCounterShard.query.filter_by(message_id=msg.id).delete()
+        unindex_messages([msg.id])
+        discard_notifications(Notification.message_id == msg.id)
+
         db.session.delete(msg)
         db.session.commit()
 
@@ -332,24 +722,193 @@ def create_app(database='postgresql:///warbler', csrf=True):
             return redirect("/")
 
         # Grab the message object
-        msg = Message.query.get(message_id)
-        msg_liked = False
+        msg = Message.query.get_or_404(message_id)
 
         # The current user can only like other users messages
         if msg.user_id != g.user.id:
-            if msg in g.user.likes:
-                # This message was already liked remove the like
-                like = Likes.query.filter_by(message_id=msg.id, user_id=g.user.id).delete()
-                db.session.commit()
-            else:
-                g.user.likes.append(msg)
-                db.session.commit()
-                msg_liked = True
+            # Through the buffer, so intents still waiting there can't
+            # overwrite this one later; then written straight away.
+            msg_liked = not liked_message_ids(g.user, [msg.id])
+            likes_buffer().write_now(g.user.id, msg.id, msg_liked)
         else:
             return jsonify({'warning': 'You can not like your own Warbles!'}), 403
 
         return jsonify({'like_status': msg_liked}), 200
 
+    @app.route('/api/likes', methods=['POST'])
+    def likes_batch():
+        """Like or unlike several messages: a JSON object of {message id: liked}.
+
+        The likes are buffered and written shortly after (see likes.py), so
+        this answers 202. Messages that can't be liked are reported by id.
+        """
+
+        if not g.user:
+            return jsonify({'warning': 'Access unauthorized.'}), 401
+
+        likes = request.get_json(silent=True)
+        if (not isinstance(likes, dict) or len(likes) > app.config['LIKE_BATCH_MAX']
+                or not all(key.isdigit() and isinstance(liked, bool) for key, liked in likes.items())):
+            return jsonify({'warning': f"Send up to {app.config['LIKE_BATCH_MAX']} "
+                                       "message ids, each mapped to true or false."}), 400
+
+        likes = {int(key): liked for key, liked in likes.items()}
+        authors = dict(db.session.execute(select(Message.id, Message.user_id).where(Message.id.in_(likes))).all())
+
+        errors = {}
+        for message_id in likes:
+            if message_id not in authors:
+                errors[message_id] = 'No such message.'
+            elif authors[message_id] == g.user.id:
+                errors[message_id] = 'You can not like your own Warbles!'
+
+        accepted = {message_id: liked for message_id, liked in likes.items() if message_id not in errors}
+        if accepted:
+            likes_buffer().add(g.user.id, accepted)
+
+        return jsonify({'accepted': sorted(accepted), 'errors': errors}), 202
+
+    @app.route('/api/likes/state')
+    def likes_state():
+        """Which of the messages in `ids` (comma separated) has the current user liked?"""
+
+        if not g.user:
+            return jsonify({'warning': 'Access unauthorized.'}), 401
+
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+        if not all(i.isdigit() for i in ids) or len(ids) > 200:
+            return jsonify({'warning': 'ids must be up to 200 comma separated message ids.'}), 400
+
+        liked = liked_message_ids(g.user, (int(i) for i in ids))
+        return jsonify({'liked': sorted(liked)}), 200
+
+    ##############################################################################
+    # Live timeline
+
+    @app.route('/stream/timeline')
+    def timeline_stream():
+        """Stream new messages from followed users as Server-Sent Events.
+
+        Clients resuming after a dropped connection send `Last-Event-ID` (or a
+        `last_event_id` param on first connect) and are sent the messages they
+        missed before the live ones.
+        """
+
+        if not g.user:
+            return jsonify({'warning': 'Access unauthorized.'}), 401
+
+        user_ids = [row.user_being_followed_id for row in
+                    Follows.query.filter_by(user_following_id=g.user.id)]
+        user_ids.append(g.user.id)
+
+        broadcaster = app.extensions['broadcaster']
+        if not broadcaster.max_connections:
+            return jsonify({'warning': "Live updates aren't available on this server."}), 503
+        if broadcaster.full:
+            return jsonify({'warning': 'Too many live connections, try again shortly.'}), 503, {'Retry-After': '30'}
+
+        # Marked before the backlog is read, so nothing committed in between is missed
+        since = broadcaster.mark()
+
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        backlog = []
+        if last_id and last_id.isdigit():
+            missed = (Message.query
+                      .filter(Message.user_id.in_(user_ids), Message.id > int(last_id))
+                      .order_by(Message.id.desc())
+                      .limit(100))
+            # Users are looked up separately: messages may be on other shards
+            missed = sorted(missed, key=lambda message: message.id)[-100:]
+            users = {user.id: user for user in User.query.filter(User.id.in_({m.user_id for m in missed}))}
+            backlog = [message_event(message, users[message.user_id]) for message in missed]
+
+        # The generator only touches the broadcaster and the backlog, so the
+        # request's database session is released as soon as we return.
+        return Response(event_stream(broadcaster, user_ids, since, backlog, app.config['STREAM_HEARTBEAT']),
+                        mimetype='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    ##############################################################################
+    # Notifications
+
+    @app.route('/notifications')
+    def notifications_index():
+        """Show the current user's notifications, newest first.
+
+        Viewing the first page marks everything read. Takes a 'before'
+        param, the id of the last notification on the previous page.
+        """
+
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        before = request.args.get('before', type=int)
+        read_id = g.user.notifications_read_id
+        notifications = notifications_page(g.user.id, before, 50)
+
+        if before is None and g.user.unread_notifications:
+            mark_read(g.user)
+            db.session.commit()
+
+        older = notifications[-1].id if len(notifications) == 50 else None
+        return stream_page('notifications/index.html', notifications=notifications, read_id=read_id,
+                           older=older)
+
+    ##############################################################################
+    # Hashtags
+
+    @app.route('/tags/<tag>')
+    def tags_show(tag):
+        """Show messages using a hashtag, newest first.
+
+        Takes a 'before' param, the cursor of the last message on the
+        previous page.
+        """
+
+        tag = tag.lower()
+        if not is_hashtag(tag):
+            abort(404)
+
+        messages = tagged_messages(tag, request.args.get('before'), 100)
+        liked = liked_message_ids(g.user, (msg.id for msg in messages)) if g.user else set()
+        counts = like_counts(messages)
+        older = message_cursor(messages[-1]) if len(messages) == 100 else None
+
+        return stream_page('tags/show.html', tag=tag, messages=messages, liked=liked, counts=counts,
+                           older=older)
+
+    ##############################################################################
+    # Uploaded images and built assets
+
+    @app.route('/images/<name>.jpg')
+    def images(name):
+        """Serve an uploaded image, or a variant (`<digest>-<variant>.jpg`), making it if need be."""
+
+        parsed = parse_image_name(name)
+        if parsed is None:
+            abort(404)
+
+        digest, variant = parsed
+
+        path = ensure_variant(digest, variant) if variant else image_path(digest)
+        if path is None or not os.path.exists(path):
+            abort(404)
+
+        response = send_file(path, mimetype='image/jpeg', max_age=365 * 24 * 3600)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        """Serve a built static asset, precompressed according to Accept-Encoding."""
+
+        response = send_asset(filename)
+        if response is None:
+            abort(404)
+        return response
+
     ##############################################################################
     # Homepage and error pages
 
@@ -358,17 +917,29 @@ def create_app(database='postgresql:///warbler', csrf=True):
         """Show homepage:
 
         - anon users: no messages
-        - logged in: 100 most recent messages of followed_users
+        - logged in: 100 most recent messages of followed_users, or with
+          ?feed=top the 100 best-scoring of their recent messages
         """
 
         if g.user:
-            user_ids = [user.id for user in g.user.following]
+            user_ids = following_ids(g.user.id)
             user_ids.append(g.user.id)
-            messages = db.session.query(Message).filter(Message.user_id.in_(user_ids)).order_by(
-                Message.timestamp.desc()).limit(100).all()
 
-            likes = [message.id for message in g.user.likes]
-            return render_template('home.html', messages=messages, likes=likes)
+            feed = 'top' if request.args.get('feed') == 'top' else 'latest'
+            if feed == 'top':
+                messages = ranked_messages(user_ids, g.user.id, app.extensions['affinities'], 100,
+                                           candidates=app.config['RANKED_CANDIDATES'],
+                                           budget_ms=app.config['RANKED_BUDGET_MS'],
+                                           affinity_likes=app.config['RANKED_AFFINITY_LIKES'])
+            else:
+                messages = feed_messages(user_ids, 100)
+
+            liked = liked_message_ids(g.user, (msg.id for msg in messages))
+            counts = like_counts(messages)
+            # user_ids also holds the user themselves, who is never suggested
+            suggestions = suggestions_for(g.user.id, already_following=user_ids)
+            return stream_page('home.html', messages=messages, liked=liked, counts=counts,
+                               suggestions=suggestions, trends=trending('1h'), feed=feed)
 
         else:
             return render_template('home-anon.html')
@@ -384,6 +955,10 @@ def create_app(database='postgresql:///warbler', csrf=True):
     def add_header(req):
         """Add non-caching headers on every request."""
 
+        # ...except content-addressed files, which never change
+        if req.cache_control.immutable:
+            return req
+
         req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
         req.headers["Pragma"] = "no-cache"
         req.headers["Expires"] = "0"
@@ -392,4 +967,15 @@ def create_app(database='postgresql:///warbler', csrf=True):
 
     return app
 
-app = create_app()
\ No newline at end of file
+
+def __getattr__(name):
+    """Build the default app on first use of `app.app` (`flask --app app`, gunicorn `app:app`).
+
+    Importing this module for `create_app` alone doesn't build one.
+    """
+
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
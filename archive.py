@@ -0,0 +1,171 @@
+"""Cold storage for old messages.
+
+Most reads are for the last few weeks of messages, so `flask archive run`
+moves messages older than ARCHIVE_HORIZON_DAYS from `messages` into the
+compact `messages_archive` table, keeping the hot table and its indexes
+small. Archived messages keep their ids, so message pages and profile
+pagination read from both tiers without the caller needing to know where a
+message lives. Their like count is folded into `like_count`; the like rows
+stay, so they still show on the likers' pages, but archived messages can't
+be liked or unliked any more.
+"""
+
+import heapq
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import insert, text, tuple_
+
+from counters import like_counts
+from models import db, Message, ArchivedMessage, LikeCounterShard
+from queries import user_messages
+
+archive_cli = AppGroup('archive', help="Move old messages to cold storage.")
+
+
+def archive_cutoff():
+    return datetime.utcnow() - timedelta(days=current_app.config['ARCHIVE_HORIZON_DAYS'])
+
+
+def get_message(message_id):
+    """A message from either tier, or None."""
+
+    return db.session.get(Message, message_id) or db.session.get(ArchivedMessage, message_id)
+
+
+def parse_cursor(before):
+    """Parse a `before` cursor (`<timestamp>_<id>`) into a tuple, or None."""
+
+    if not before:
+        return None
+
+    timestamp, _, message_id = before.rpartition('_')
+    try:
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except ValueError:
+        return None
+
+
+def cursor_for(message):
+    return f"{message.timestamp.isoformat()}_{message.id}"
+
+
+def user_messages_page(user_id, before=None, limit=100):
+    """One page of a user's messages, newest first, from both tiers.
+
+    `before` is the cursor of the last message on the previous page. The
+    archive is only consulted when the hot table can't fill the page by
+    itself or the page reaches back past the archive horizon.
+    """
+
+    position = parse_cursor(before)
+
+    hot = user_messages(user_id, limit, position)
+
+    if len(hot) == limit and hot[-1].timestamp >= archive_cutoff():
+        return hot
+
+    cold = (ArchivedMessage.query
+            .filter(ArchivedMessage.user_id == user_id)
+            .order_by(ArchivedMessage.timestamp.desc(), ArchivedMessage.id.desc()))
+    if position:
+        cold = cold.filter(tuple_(ArchivedMessage.timestamp, ArchivedMessage.id) < position)
+    cold = cold.limit(limit).all()
+
+    newest_first = heapq.merge(hot, cold, key=lambda m: (m.timestamp, m.id), reverse=True)
+    return list(newest_first)[:limit]
+
+
+def archive_batch(cutoff, batch_size=1000):
+    """Move up to `batch_size` messages older than `cutoff`. Returns how many moved."""
+
+    messages = (Message.query
+                .filter(Message.timestamp < cutoff)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all())
+
+    if not messages:
+        return 0
+
+    ids = [message.id for message in messages]
+    counts = like_counts(messages)
+
+    db.session.execute(insert(ArchivedMessage), [
+        {'id': m.id, 'text': m.text, 'timestamp': m.timestamp, 'user_id': m.user_id,
+         'like_count': counts[m.id]}
+        for m in messages])
+
+    LikeCounterShard.query.filter(LikeCounterShard.message_id.in_(ids)).delete(synchronize_session=False)
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(ids)
+
+
+def tier_sizes():
+    """Rows and bytes on disk for each tier.
+
+    On PostgreSQL both come from the catalog (sizes include indexes, TOAST
+    and every partition; row counts are the planner's estimate once the table has been analyzed). Elsewhere
+    rows are counted and sizes are None.
+    """
+
+    report = {}
+
+    for name, model in (('hot', Message), ('archive', ArchivedMessage)):
+        table = model.__tablename__
+
+        if db.engine.dialect.name == 'postgresql':
+            size, rows, unanalyzed = db.session.execute(text(
+                "SELECT sum(pg_total_relation_size(oid)), sum(greatest(reltuples, 0)), bool_or(reltuples < 0) "
+                "FROM pg_class "
+                "WHERE (oid = to_regclass(:table) AND relkind = 'r') "
+                "OR oid IN (SELECT relid FROM pg_partition_tree(to_regclass(:table)) WHERE isleaf)"),
+                {'table': table}).one()
+            if unanalyzed:
+                rows = db.session.query(model).count()
+            report[name] = {'rows': int(rows or 0), 'bytes': int(size or 0)}
+        else:
+            report[name] = {'rows': db.session.query(model).count(), 'bytes': None}
+
+    return report
+
+
+@archive_cli.command('run')
+@click.option('--horizon-days', type=int, default=None,
+              help="Archive messages older than this (default: ARCHIVE_HORIZON_DAYS).")
+@click.option('--batch-size', default=1000, help="Messages moved per transaction.")
+def run_command(horizon_days, batch_size):
+    """Move old messages into the archive table."""
+
+    # Databases created before likes outlived their messages still have the
+    # foreign key that would delete them along with the hot rows
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey"))
+        db.session.commit()
+
+    if horizon_days is None:
+        cutoff = archive_cutoff()
+    else:
+        cutoff = datetime.utcnow() - timedelta(days=horizon_days)
+
+    total = 0
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            break
+
+    click.echo(f"Archived {total} messages older than {cutoff:%Y-%m-%d}.")
+
+
+@archive_cli.command('report')
+def report_command():
+    """Show how much space each tier uses."""
+
+    for name, sizes in tier_sizes().items():
+        size = f"{sizes['bytes'] / 1024:,.0f} kB" if sizes['bytes'] is not None else "size unknown"
+        click.echo(f"{name:8} {sizes['rows']:>12,} rows  {size}")
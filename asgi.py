@@ -0,0 +1,420 @@
+"""ASGI entry point: the read-mostly pages as JSON, on SQLAlchemy's asyncio engine.
+
+Serve it like:
+
+    WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn asgi:app
+
+or `uvicorn asgi:app`. These GET endpoints are answered with asyncpg, and
+the independent queries behind each (a profile's counts and its messages,
+say) run at the same time, each on its own connection:
+
+- /api/timeline: the logged-in user's newest feed messages
+- /api/users/<id>: a profile, its counts and a page of its messages
+  (`?before=<cursor>` for older ones)
+- /api/users/<id>/following and /api/users/<id>/followers
+- /api/messages/<id>
+
+Everything else, every write included, is handed to the Flask app from
+app.py through asgiref's WsgiToAsgi, which runs it on a thread, so the
+whole site works behind this one entry point. The logged-in user is read
+from the Flask session cookie.
+
+The sessions are AsyncSessions around the same RoutingSession as
+`db.session`, on asyncio engines for the same databases, so the models and
+sharding (sharding.py) are shared with the Flask side. Likes still in a
+Flask worker's buffer (likes.py) show up here once flushed, about a second
+later.
+"""
+
+import asyncio
+import heapq
+import json
+import re
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import CURR_USER_KEY, create_app
+from archive import archive_cutoff, cursor_for, parse_cursor
+from models import db, RoutingSession, User, Message, ArchivedMessage, Likes, Follows, LikeCounterShard
+from partitions import is_partitioned, recent_cutoffs
+from stream import message_event
+
+PAGE_SIZE = 100
+
+# Drivers for the asyncio engines, by the Flask engines' drivers
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgresql+psycopg': 'postgresql+psycopg_async',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(url):
+    """`url` with the asyncio driver for its database."""
+
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+##############################################################################
+# Queries, each on the session it's given
+
+async def newest_messages(session, criterion, limit, position=None):
+    """The newest `limit` messages matching `criterion`, like queries.py's `_newest`."""
+
+    for since in recent_cutoffs():
+        stmt = select(Message).where(criterion)
+        if since is not None:
+            stmt = stmt.where(Message.timestamp >= since)
+        if position is not None:
+            stmt = stmt.where(tuple_(Message.timestamp, Message.id) < tuple_(*position))
+        stmt = stmt.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit)
+
+        # With shards each one's newest come back in turn
+        messages = sorted((await session.scalars(stmt)).all(),
+                          key=lambda message: (message.timestamp, message.id), reverse=True)[:limit]
+        if since is None or len(messages) == limit:
+            return messages
+
+
+async def user_messages_page(session, user_id, before=None, limit=PAGE_SIZE):
+    """One page of a user's messages from both tiers, like archive.py's."""
+
+    position = parse_cursor(before)
+    hot = await newest_messages(session, Message.user_id == user_id, limit, position)
+    if len(hot) == limit and hot[-1].timestamp >= archive_cutoff():
+        return hot
+
+    cold = (select(ArchivedMessage)
+            .where(ArchivedMessage.user_id == user_id)
+            .order_by(ArchivedMessage.timestamp.desc(), ArchivedMessage.id.desc()))
+    if position:
+        cold = cold.where(tuple_(ArchivedMessage.timestamp, ArchivedMessage.id) < tuple_(*position))
+    cold = (await session.scalars(cold.limit(limit))).all()
+
+    newest_first = heapq.merge(hot, cold, key=lambda m: (m.timestamp, m.id), reverse=True)
+    return list(newest_first)[:limit]
+
+
+async def get_message(session, message_id):
+    return await session.get(Message, message_id) or await session.get(ArchivedMessage, message_id)
+
+
+async def get_user(session, user_id):
+    return await session.get(User, user_id)
+
+
+async def users_by_id(session, user_ids):
+    if not user_ids:
+        return []
+    return (await session.scalars(select(User).where(User.id.in_(user_ids)).order_by(User.id))).all()
+
+
+async def column_values(session, stmt):
+    return (await session.scalars(stmt)).all()
+
+
+async def count(session, criterion):
+    return await session.scalar(select(func.count()).where(criterion))
+
+
+async def liked_message_ids(session, user_id, message_ids):
+    if not message_ids:
+        return set()
+    rows = await session.scalars(select(Likes.message_id)
+                                 .where(Likes.user_id == user_id, Likes.message_id.in_(message_ids)))
+    return set(rows)
+
+
+async def like_counts(session, messages):
+    """{message_id: count}, like counters.py's `like_counts`."""
+
+    counts = {message.id: message.like_count for message in messages}
+    if not counts:
+        return counts
+
+    pending = await session.execute(select(LikeCounterShard.message_id, func.sum(LikeCounterShard.delta))
+                                    .where(LikeCounterShard.message_id.in_(counts))
+                                    .group_by(LikeCounterShard.message_id))
+    for message_id, delta in pending:
+        counts[message_id] += delta
+    return counts
+
+
+def following_ids(user_id):
+    return select(Follows.user_being_followed_id).where(Follows.user_following_id == user_id)
+
+
+def follower_ids(user_id):
+    return select(Follows.user_following_id).where(Follows.user_being_followed_id == user_id)
+
+
+##############################################################################
+# Serializing
+
+def user_json(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+        'location': user.location,
+        'follower_count': user.follower_count,
+    }
+
+
+def messages_json(messages, users, counts, liked):
+    users = {user.id: user for user in users}
+    return [{**message_event(message, users[message.user_id]),
+             'like_count': counts[message.id],
+             'liked': message.id in liked,
+             'cursor': cursor_for(message)}
+            for message in messages if message.user_id in users]
+
+
+##############################################################################
+# The app
+
+class Request:
+    """What the views need from an HTTP scope."""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.args = {key: values[-1] for key, values in parse_qs(scope['query_string'].decode()).items()}
+        cookie = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookie.load(value.decode('latin-1'))
+        self.cookies = {key: morsel.value for key, morsel in cookie.items()}
+
+
+class ReadApp:
+    """The ASGI app: async read endpoints, and the Flask app for everything else."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.fallback = WsgiToAsgi(flask_app)
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self.engines = None
+        self.sessions = None
+        self._starting = asyncio.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, view in ROUTES:
+                match = pattern.fullmatch(scope['path'])
+                if match:
+                    return await self.respond(view, {key: int(value) for key, value in match.groupdict().items()},
+                                              scope, send)
+
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def start(self):
+        """Create the asyncio engines, in the worker and on its event loop."""
+
+        async with self._starting:
+            if self.sessions is not None:
+                return
+            # Once, so recent_cutoffs() never queries on the event loop
+            await asyncio.to_thread(self._check_partitions)
+
+            with self.flask_app.app_context():
+                self.engines = {key: create_async_engine(async_url(engine.url))
+                                for key, engine in db.engines.items()}
+                slow_queries = self.flask_app.extensions.get('slow_queries')
+                if slow_queries:
+                    for engine in self.engines.values():
+                        slow_queries.attach(engine.sync_engine)
+
+            self.sessions = async_sessionmaker(
+                sync_session_class=RoutingSession, db=db,
+                engines={key: engine.sync_engine for key, engine in self.engines.items()})
+
+    def _check_partitions(self):
+        with self.flask_app.app_context():
+            is_partitioned()
+            db.session.remove()
+
+    async def stop(self):
+        if self.engines:
+            await asyncio.gather(*(engine.dispose() for engine in self.engines.values()))
+        self.engines = self.sessions = None
+        # Which may be started again on another event loop
+        self._starting = asyncio.Lock()
+
+    async def read(self, query, *args):
+        """`query(session, *args)` on a session of its own, so reads can run side by side."""
+
+        async with self.sessions() as session:
+            return await query(session, *args)
+
+    def current_user_id(self, request):
+        cookie = request.cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return None
+        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+        try:
+            return self.serializer.loads(cookie, max_age=max_age).get(CURR_USER_KEY)
+        except BadSignature:
+            return None
+
+    async def respond(self, view, kwargs, scope, send):
+        if self.sessions is None:
+            await self.start()
+
+        # For current_app: the config, and the partition check's cache
+        with self.flask_app.app_context():
+            status, body = await view(self, Request(scope), **kwargs)
+
+        content = json.dumps(body).encode()
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode()),
+            (b'cache-control', b'no-cache, no-store, must-revalidate'),
+        ]})
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else content})
+
+
+##############################################################################
+# Views: (status, JSON body)
+
+UNAUTHORIZED = 401, {'warning': 'Access unauthorized.'}
+NOT_FOUND = 404, {'warning': 'Not found.'}
+
+
+async def timeline(api, request):
+    """The newest messages by the logged-in user and the users they follow."""
+
+    user_id = api.current_user_id(request)
+    if user_id is None:
+        return UNAUTHORIZED
+
+    user_ids = [*await api.read(column_values, following_ids(user_id)), user_id]
+    messages = await api.read(newest_messages, Message.user_id.in_(user_ids), PAGE_SIZE)
+
+    message_ids = [message.id for message in messages]
+    users, counts, liked = await asyncio.gather(
+        api.read(users_by_id, {message.user_id for message in messages}),
+        api.read(like_counts, messages),
+        api.read(liked_message_ids, user_id, message_ids))
+
+    return 200, {'messages': messages_json(messages, users, counts, liked)}
+
+
+async def users_show(api, request, user_id):
+    """A profile, its counts and a page of its messages."""
+
+    viewer_id = api.current_user_id(request)
+    user, message_count, following_count, likes_count, messages = await asyncio.gather(
+        api.read(get_user, user_id),
+        api.read(count, Message.user_id == user_id),
+        api.read(count, Follows.user_following_id == user_id),
+        api.read(count, Likes.user_id == user_id),
+        api.read(user_messages_page, user_id, request.args.get('before'), PAGE_SIZE))
+    if user is None:
+        return NOT_FOUND
+
+    counts, liked = await asyncio.gather(
+        api.read(like_counts, messages),
+        api.read(liked_message_ids, viewer_id, [message.id for message in messages]) if viewer_id
+        else asyncio.sleep(0, set()))
+
+    return 200, {
+        'user': {**user_json(user), 'message_count': message_count,
+                 'following_count': following_count, 'likes_count': likes_count},
+        'messages': messages_json(messages, [user], counts, liked),
+        'older': cursor_for(messages[-1]) if len(messages) == PAGE_SIZE else None,
+    }
+
+
+async def follow_list(api, request, user_id, ids_of):
+    viewer_id = api.current_user_id(request)
+    if viewer_id is None:
+        return UNAUTHORIZED
+
+    user, ids, following = await asyncio.gather(
+        api.read(get_user, user_id),
+        api.read(column_values, ids_of(user_id)),
+        api.read(column_values, following_ids(viewer_id)))
+    if user is None:
+        return NOT_FOUND
+
+    following = set(following)
+    users = await api.read(users_by_id, ids)
+    return 200, {'user': user_json(user),
+                 'users': [{**user_json(other), 'followed': other.id in following} for other in users]}
+
+
+async def show_following(api, request, user_id):
+    """The users `user_id` follows."""
+
+    return await follow_list(api, request, user_id, following_ids)
+
+
+async def users_followers(api, request, user_id):
+    """The users following `user_id`."""
+
+    return await follow_list(api, request, user_id, follower_ids)
+
+
+async def messages_show(api, request, message_id):
+    """A message, from either tier."""
+
+    message = await api.read(get_message, message_id)
+    if message is None:
+        return NOT_FOUND
+
+    viewer_id = api.current_user_id(request)
+    user, counts, liked = await asyncio.gather(
+        api.read(get_user, message.user_id),
+        api.read(like_counts, [] if message.archived else [message]),
+        api.read(liked_message_ids, viewer_id, [message_id]) if viewer_id else asyncio.sleep(0, set()))
+
+    counts.setdefault(message.id, message.like_count)
+    return 200, {'message': messages_json([message], [user], counts, liked)[0]}
+
+
+ROUTES = [
+    (re.compile(r'/api/timeline'), timeline),
+    (re.compile(r'/api/users/(?P<user_id>\d+)'), users_show),
+    (re.compile(r'/api/users/(?P<user_id>\d+)/following'), show_following),
+    (re.compile(r'/api/users/(?P<user_id>\d+)/followers'), users_followers),
+    (re.compile(r'/api/messages/(?P<message_id>\d+)'), messages_show),
+]
+
+
+def create_asgi_app(flask_app=None):
+    """The ASGI app around `flask_app` (by default a new one from create_app)."""
+
+    return ReadApp(flask_app or create_app())
+
+
+def __getattr__(name):
+    """Build the default app on first use of `asgi.app`, as app.py does."""
+
+    if name == 'app':
+        global app
+        app = create_asgi_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
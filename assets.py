@@ -0,0 +1,179 @@
+"""Static asset build: minify, fingerprint and precompress.
+
+`flask assets build` writes each file in ASSET_FILES to ASSETS_FOLDER as
+`<name>.<hash>.<ext>`, along with `.gz` and (if the `brotli` package is
+installed) `.br` copies, and records the names in `manifest.json`.
+Templates link to assets with `asset_url(...)`, which uses the manifest when
+there is one and the plain /static/ file otherwise, so development works
+without a build.
+
+Built files are served from /assets/ by `serve_asset`, which picks the
+smallest encoding the client accepts. Their names change with their content,
+so they're cached for a year.
+
+The build also compiles every Jinja template into a bytecode cache in
+TEMPLATE_CACHE_FOLDER, so workers load templates without parsing them. The
+cache is only used if the folder exists.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import current_app, request, send_file, url_for
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+assets_cli = AppGroup('assets', help="Build static assets.")
+
+# Paths relative to the static folder
+ASSET_FILES = [
+    'stylesheets/style.css',
+    'likes.js',
+    'modal.js',
+]
+
+MANIFEST = 'manifest.json'
+
+# Preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def minify_css(source):
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};:,>])\s*', r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+def minify_js(source):
+    """Drop indentation, blank lines and whole-line comments.
+
+    Lines are kept apart: our scripts rely on automatic semicolon insertion.
+    """
+
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def build_assets(static_folder, output_folder, echo=print):
+    """Build every asset into `output_folder` and write the manifest. Returns the manifest."""
+
+    manifest = {}
+
+    for name in ASSET_FILES:
+        with open(os.path.join(static_folder, name), encoding='utf-8') as f:
+            source = f.read()
+
+        stem, ext = os.path.splitext(name)
+        data = MINIFIERS.get(ext, lambda s: s)(source).encode('utf-8')
+        built = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+        path = os.path.join(output_folder, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+
+        manifest[name] = built
+        echo(f"  {name} -> {built} ({len(source.encode('utf-8'))} -> {len(data)} bytes)")
+
+    with open(os.path.join(output_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(output_folder):
+    """The built asset names, or {} if assets haven't been built."""
+
+    try:
+        with open(os.path.join(output_folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(name):
+    """The URL for a static asset: the fingerprinted build if there is one."""
+
+    built = current_app.extensions['assets'].get(name)
+    if built is None:
+        return url_for('static', filename=name)
+    return url_for('serve_asset', filename=built)
+
+
+def use_template_cache(app):
+    """Load templates from the bytecode cache, if it has been built."""
+
+    folder = app.config['TEMPLATE_CACHE_FOLDER']
+    if os.path.isdir(folder):
+        app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(folder)}
+
+
+def compile_templates(app):
+    """Compile every template into the bytecode cache. Returns how many there were."""
+
+    folder = app.config['TEMPLATE_CACHE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    FileSystemBytecodeCache(folder).clear()
+
+    env = app.jinja_env
+    if env.bytecode_cache is None:
+        env.bytecode_cache = FileSystemBytecodeCache(folder)
+
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+def send_asset(filename):
+    """A response for a built asset, precompressed if the client accepts it, or None."""
+
+    folder = current_app.config['ASSETS_FOLDER']
+    path = os.path.realpath(os.path.join(folder, filename))
+    if not path.startswith(os.path.realpath(folder) + os.sep) or not os.path.isfile(path):
+        return None
+
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            encoding, path = name, path + suffix
+            break
+
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], max_age=365 * 24 * 3600)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@assets_cli.command('build')
+def build_command():
+    """Minify, fingerprint and precompress the static assets, and compile templates."""
+
+    folder = current_app.config['ASSETS_FOLDER']
+    click.echo(f"Building assets into {folder}" + ("" if brotli else " (brotli not installed: gzip only)"))
+    build_assets(current_app.static_folder, folder, echo=click.echo)
+
+    count = compile_templates(current_app)
+    click.echo(f"Compiled {count} templates into {current_app.config['TEMPLATE_CACHE_FOLDER']}")
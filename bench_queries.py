@@ -0,0 +1,125 @@
+"""Hot query benchmark: ad-hoc queries against the cached statements in queries.py.
+
+For each query a request makes on the home or profile page, it times the
+query as it used to be written (a fresh Query each time) and the cached
+lambda statement, and reports the median per call. Both send the same SQL,
+so the difference is Python overhead.
+
+Run it like:
+
+    python bench_queries.py --calls 2000
+
+It uses DATABASE_URL if set, else the development database, and needs a
+user there who follows somebody.
+"""
+
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import lambda_stmt, select, tuple_
+
+from app import create_app
+from models import db, User, Message, Follows
+from partitions import recent_messages
+import queries
+
+
+def old_user_by_id(user_id):
+    return User.query.get(user_id)
+
+
+def old_user_by_username(username):
+    return User.query.filter_by(username=username).first()
+
+
+def old_following_ids(user):
+    return [followed.id for followed in user.following]
+
+
+def old_feed_messages(user_ids, limit):
+    return recent_messages(Message.query.filter(Message.user_id.in_(user_ids)), limit)
+
+
+def old_user_messages(user_id, limit, position):
+    query = Message.query.filter(Message.user_id == user_id)
+    query = query.filter(tuple_(Message.timestamp, Message.id) < position)
+    return recent_messages(query, limit)
+
+
+def new_user_by_username(username):
+    # User.authenticate without the password check
+    return db.session.execute(
+        lambda_stmt(lambda: select(User).where(User.username == username).limit(1))
+    ).scalar_one_or_none()
+
+
+def timed(fn, calls, setup):
+    """Median seconds per call, running `setup` (untimed) before each."""
+
+    times = []
+    for _ in range(calls):
+        setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = create_app(csrf=False)
+    with app.app_context():
+        follow = db.session.execute(db.select(Follows).limit(1)).scalar()
+        if follow is None:
+            raise SystemExit("No follows in the database: seed it first.")
+
+        user = db.session.get(User, follow.user_following_id)
+        user_id, username = user.id, user.username
+        user_ids = queries.following_ids(user_id) + [user_id]
+        # A cursor past the newest message, so the whole page is returned
+        position = (datetime.utcnow() + timedelta(days=1), 0)
+
+        # Empty the identity map, so lookups can't skip the database
+        fresh = db.session.expunge_all
+        # g.user is already loaded when the home page asks who it follows
+        def unload_following():
+            db.session.add(user)
+            db.session.expire(user, ['following'])
+
+        cases = [
+            ("user by id", fresh,
+             lambda: old_user_by_id(user_id), lambda: queries.user_by_id(user_id)),
+            ("user by username", fresh,
+             lambda: old_user_by_username(username), lambda: new_user_by_username(username)),
+            ("following ids", unload_following,
+             lambda: old_following_ids(user), lambda: queries.following_ids(user_id)),
+            ("home feed", fresh,
+             lambda: old_feed_messages(user_ids, 100), lambda: queries.feed_messages(user_ids, 100)),
+            ("profile page", fresh,
+             lambda: old_user_messages(user_id, 100, position),
+             lambda: queries.user_messages(user_id, 100, position)),
+        ]
+
+        total_old = total_new = 0
+        print(f"{'query':>16}  {'ad hoc':>9}  {'cached':>9}  {'saved':>9}")
+        for name, setup, old, new in cases:
+            # Warm both, so neither pays for first-time compilation
+            for fn in (old, new):
+                setup()
+                fn()
+            old_time, new_time = timed(old, args.calls, setup), timed(new, args.calls, setup)
+            total_old += old_time
+            total_new += new_time
+            print(f"{name:>16}  {old_time * 1e6:7.0f}us  {new_time * 1e6:7.0f}us  {(old_time - new_time) * 1e6:7.0f}us")
+
+        print(f"{'total':>16}  {total_old * 1e6:7.0f}us  {total_new * 1e6:7.0f}us  "
+              f"{(total_old - total_new) * 1e6:7.0f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Startup benchmark: how long until a fresh process serves its first page.
+
+Each run is a new interpreter, so nothing is warm. It reports, as medians:
+
+- import: `import app`
+- create_app: building the app
+- first request: GET /login (templates, forms, the database connection)
+- second request: the same again, for comparison
+
+Run it like:
+
+    python bench_startup.py --runs 10
+
+It uses DATABASE_URL if set, else the development database.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+RUN = """
+import json, time
+start = time.perf_counter()
+import app as app_module
+imported = time.perf_counter()
+app = app_module.create_app(csrf=False)
+created = time.perf_counter()
+client = app.test_client()
+assert client.get('/login').status_code == 200
+first = time.perf_counter()
+client.get('/login')
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first request': first - created, 'second request': second - first}))
+"""
+
+
+def run_once():
+    output = subprocess.run([sys.executable, '-c', RUN], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+
+    for name in runs[0]:
+        times = [run[name] * 1000 for run in runs]
+        print(f"{name:>15}: {statistics.median(times):7.1f} ms  (min {min(times):.1f}, max {max(times):.1f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Worker benchmark: gthread against gevent workers under many connections.
+
+For each worker class it starts gunicorn (WORKER_CLASS, see
+gunicorn.conf.py; gthread workers get GUNICORN_THREADS threads, 4 unless
+set), opens --connections client connections at once, each
+requesting profile pages and now and then logging in (bcrypt) for
+--seconds, and reports requests per second and the median and 99th
+percentile latency.
+
+Run it like:
+
+    python bench_workers.py --connections 200 --seconds 20
+
+It uses DATABASE_URL if set, else the development database, and signs up
+a `benchuser` there if there isn't one.
+"""
+
+import argparse
+import http.cookiejar
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+USERNAME = 'benchuser'
+PASSWORD = 'benchpassword'
+
+
+def ensure_user():
+    """The ids of some users to look at, signing up the bench user if needed."""
+
+    from app import create_app
+    from models import db, User
+
+    app = create_app(os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    with app.app_context():
+        if User.query.filter_by(username=USERNAME).first() is None:
+            User.signup(USERNAME, f'{USERNAME}@example.com', PASSWORD, None)
+            db.session.commit()
+        return [user.id for user in User.query.order_by(User.id).limit(50)]
+
+
+def start_server(worker_class, port, workers):
+    env = dict(os.environ, WORKER_CLASS=worker_class, BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers))
+    env.setdefault('GUNICORN_THREADS', '4')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"gunicorn with {worker_class} workers didn't start")
+
+
+def client(base, user_ids, login_every, deadline, latencies, errors):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    count = 0
+    while time.monotonic() < deadline:
+        count += 1
+        started = time.perf_counter()
+        try:
+            if login_every and count % login_every == 0:
+                page = opener.open(f'{base}/login', timeout=30).read().decode()
+                token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+                form = urllib.parse.urlencode({'csrf_token': token, 'username': USERNAME, 'password': PASSWORD})
+                opener.open(f'{base}/login', form.encode(), timeout=30).read()
+            else:
+                opener.open(f'{base}/users/{user_ids[count % len(user_ids)]}', timeout=30).read()
+        except (OSError, AttributeError):
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def run(worker_class, args, user_ids):
+    server = start_server(worker_class, args.port, args.workers)
+    try:
+        latencies, errors = [], []
+        deadline = time.monotonic() + args.seconds
+        threads = [threading.Thread(target=client, daemon=True,
+                                    args=(f'http://127.0.0.1:{args.port}', user_ids, args.login_every,
+                                          deadline, latencies, errors))
+                   for _ in range(args.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f"{worker_class:>8}: {len(latencies) / args.seconds:7.1f} req/s  "
+          f"p50 {statistics.median(latencies or [0]) * 1000:6.0f} ms  p99 {p99 * 1000:6.0f} ms  "
+          f"({len(errors)} errors)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--login-every', type=int, default=20,
+                        help="Every this many requests a connection logs in (0 for never).")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--worker-class', action='append',
+                        help="Worker classes to compare (default gthread and gevent).")
+    args = parser.parse_args()
+
+    user_ids = ensure_user()
+    for worker_class in args.worker_class or ['gthread', 'gevent']:
+        run(worker_class, args, user_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Bulk message ingestion (history imports, bots)."""
+
+import json
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from models import db, Message
+from hashtags import extract_hashtags, index_messages
+from notifications import mention_notifications, notify
+from stream import announce_new_messages
+from trending import WINDOWS, record_hashtags
+
+MAX_MESSAGE_LENGTH = Message.text.type.length
+
+
+def parse_line(line):
+    """Validate one NDJSON line and return the row to insert.
+
+    Raises ValueError with a message for the client if the line is bad.
+    """
+
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise ValueError("not valid JSON") from None
+
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+
+    text = data.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("text is required")
+    if len(text) > MAX_MESSAGE_LENGTH:
+        raise ValueError(f"text is longer than {MAX_MESSAGE_LENGTH} characters")
+
+    row = {'text': text}
+
+    if data.get('timestamp') is not None:
+        try:
+            timestamp = datetime.fromisoformat(data['timestamp'])
+        except (TypeError, ValueError):
+            raise ValueError("timestamp must be an ISO 8601 date") from None
+
+        # Timestamps are stored as naive UTC
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        row['timestamp'] = timestamp
+
+    return row
+
+
+def insert_messages(user_id, rows):
+    """Insert rows for `user_id` in one multi-row INSERT. Returns the new ids."""
+
+    now = datetime.utcnow()
+    for row in rows:
+        row['user_id'] = user_id
+        # Every row needs the same keys for a single multi-row INSERT
+        row.setdefault('timestamp', now)
+
+    if db.session().data_shards:
+        # Sharded messages get their ids from the primary (see sharding.py)
+        for row, message_id in zip(rows, db.session().next_message_ids(len(rows))):
+            row['id'] = message_id
+
+    # A Core insert: the ORM's bulk insert can't be routed to a shard
+    table = Message.__table__
+    result = db.session.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+    return result.scalars().all()
+
+
+def ingest_messages(user_id, lines, chunk_size=500, max_rows=10000):
+    """Add messages for `user_id` from an iterable of NDJSON lines.
+
+    Valid lines are inserted `chunk_size` at a time, each chunk in its own
+    transaction. Bad lines are skipped and reported. Live timelines are only
+    notified once for each chunk.
+
+    Returns (number inserted, [{'line': n, 'error': ...}]).
+    """
+
+    inserted = 0
+    errors = []
+    chunk = []
+
+    def flush():
+        nonlocal inserted
+        if chunk:
+            ids = insert_messages(user_id, chunk)
+            index_messages((message_id, row['timestamp'], row['text']) for message_id, row in zip(ids, chunk))
+            inserted += len(ids)
+
+            # Backdated imports shouldn't make a tag trend or notify anyone now
+            recent = datetime.utcnow() - timedelta(seconds=WINDOWS['1h'])
+            new = [(message_id, row) for message_id, row in zip(ids, chunk) if row['timestamp'] >= recent]
+            notify(mention_notifications(user_id, [(message_id, row['text']) for message_id, row in new]))
+
+            announce_new_messages()
+            db.session.commit()
+
+            record_hashtags(extract_hashtags(row['text']) for _, row in new)
+            chunk.clear()
+
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+
+        if number > max_rows:
+            errors.append({'line': number, 'error': f"more than {max_rows} lines in one request"})
+            break
+
+        try:
+            chunk.append(parse_line(line))
+        except ValueError as e:
+            errors.append({'line': number, 'error': str(e)})
+            continue
+
+        if len(chunk) >= chunk_size:
+            flush()
+
+    flush()
+
+    return inserted, errors
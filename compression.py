@@ -0,0 +1,140 @@
+"""Compression of dynamic responses.
+
+Pages, JSON and exports are compressed with brotli (when the `brotli`
+package is installed) or gzip, whichever the client prefers. Levels default
+to the cheap end of each codec's range, which gets most of the size win on
+our repetitive markup for a fraction of the CPU.
+
+Streamed responses (stream_template, exports) are compressed as they go:
+output is flushed every COMPRESS_STREAM_FLUSH_BYTES of input, so the
+browser can start rendering before the page is finished. Files sent with
+send_file, already-encoded responses and event streams are left alone.
+
+Compressing a secret alongside input an attacker can reflect into the same
+page leaks the secret through the response size (BREACH). The only secret
+our pages carry is the CSRF token, and forms mask it afresh every time it's
+rendered (see forms.MaskedCSRF), so there's nothing stable to guess.
+"""
+
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+}
+
+
+def choose_encoding(accept_encodings):
+    """The encoding to use for a client's Accept-Encoding, or None."""
+
+    options = [name for name in (('br',) if brotli else ()) + ('gzip',) if accept_encodings[name]]
+    if not options:
+        return None
+    # Highest quality wins; ties go to the first (smaller) option
+    return max(options, key=lambda name: accept_encodings[name])
+
+
+class StreamCompressor:
+    """Incremental gzip or brotli compression with explicit flushes."""
+
+    def __init__(self, encoding, config):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._codec = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            # wbits 31: gzip container
+            self._codec = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._codec.process(data)
+        return self._codec.compress(data)
+
+    def flush(self):
+        """Everything compressed so far, in a form the client can decode now."""
+
+        if self.encoding == 'br':
+            return self._codec.flush()
+        return self._codec.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._codec.finish()
+        return self._codec.flush(zlib.Z_FINISH)
+
+
+def compress_stream(chunks, compressor, flush_bytes):
+    """Compress an iterable of chunks, flushing every `flush_bytes` of input."""
+
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+
+            out = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= flush_bytes:
+                out += compressor.flush()
+                pending = 0
+            if out:
+                yield out
+
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response, config):
+    """Compress `response` in place if it's worth it and the client accepts it."""
+
+    if (request.method == 'HEAD'
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    compressor = StreamCompressor(encoding, config)
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor,
+                                            config['COMPRESS_STREAM_FLUSH_BYTES'])
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.content_encoding = encoding
+    return response
+
+
+def init_compression(app):
+    """Compress the app's responses (see the module docstring)."""
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, app.config)
@@ -0,0 +1,69 @@
+"""Running under cooperative (gevent) workers.
+
+With WORKER_CLASS=gevent, gunicorn.conf.py monkey-patches the standard
+library before the app is imported, and each worker serves many requests
+at once on greenlets. Monkey-patching doesn't reach everything, so:
+
+- psycopg2 does its I/O inside libpq. `patch_psycopg` installs a wait
+  callback so that a greenlet waiting on PostgreSQL lets the others run.
+- bcrypt takes a few hundred milliseconds of CPU per password. `offload`
+  runs it on gevent's pool of native threads, and bcrypt releases the GIL,
+  so the worker keeps serving meanwhile.
+
+`db.session` needs nothing extra. It is scoped to the Flask app context,
+which lives in a context variable, and every greenlet has its own
+context variables, so each request gets its own session. The per-worker
+state (the broadcaster, like buffer and caches) guards itself with
+threading locks, which monkey-patching makes cooperative.
+
+Without gevent (or without monkey-patching) these do nothing, and gevent
+isn't even imported.
+"""
+
+import sys
+
+
+def is_cooperative():
+    """Is this process monkey-patched by gevent?"""
+
+    # A patched process has already imported gevent.monkey
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def patch_psycopg():
+    """Make psycopg2 yield to other greenlets while it waits. Returns whether it did."""
+
+    if not is_cooperative():
+        return False
+
+    from psycopg2 import extensions
+    extensions.set_wait_callback(wait_callback)
+    return True
+
+
+def wait_callback(conn, timeout=None):
+    """psycopg2 wait callback that waits on the connection's socket through gevent."""
+
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state!r}")
+
+
+def offload(fn, *args):
+    """Call `fn(*args)` on a native thread when cooperative, so CPU-bound work doesn't stall the worker."""
+
+    if is_cooperative():
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
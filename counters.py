@@ -0,0 +1,132 @@
+"""Per-message like counters.
+
+`Message.like_count` is kept up to date incrementally instead of counting the
+likes table on every render. Ordinary messages get a plain
+`like_count = like_count + 1`. Once a message is hot (past
+LIKE_COUNTER_HOT_THRESHOLD likes), changes go to one of LIKE_COUNTER_SHARDS
+rows in `message_like_shards` at random, so simultaneous likes of a viral
+message don't all queue up on the one row lock. Compaction (`flask likes
+compact`, run periodically) folds the shards back into `like_count`.
+"""
+
+import random
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, case, update
+
+from models import db, Message, LikeCounterShard, dialect_insert
+
+likes_cli = AppGroup('likes', help="Maintain like counters.")
+
+
+def apply_like_deltas(deltas):
+    """Apply {message_id: change in likes} to the counters.
+
+    Takes two statements however many messages are involved: one UPDATE
+    for the ordinary messages and one multi-row upsert into the shards of
+    the hot ones. Doesn't commit.
+    """
+
+    deltas = {message_id: delta for message_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    threshold = current_app.config['LIKE_COUNTER_HOT_THRESHOLD']
+    hot_ids = {row.id for row in
+               db.session.query(Message.id)
+               .filter(Message.id.in_(deltas), Message.like_count >= threshold)}
+
+    cold = {message_id: delta for message_id, delta in deltas.items() if message_id not in hot_ids}
+    if cold:
+        db.session.execute(
+            update(Message)
+            .where(Message.id.in_(cold))
+            .values(like_count=Message.like_count + case(cold, value=Message.id))
+            .execution_options(synchronize_session=False))
+
+    if hot_ids:
+        shards = current_app.config['LIKE_COUNTER_SHARDS']
+        stmt = dialect_insert(LikeCounterShard)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['message_id', 'shard'],
+            set_={'delta': LikeCounterShard.delta + stmt.excluded.delta})
+        db.session.execute(stmt, [
+            {'message_id': message_id, 'shard': random.randrange(shards), 'delta': deltas[message_id]}
+            for message_id in hot_ids])
+
+
+def like_counts(messages):
+    """Current like counts for `messages`, as {message_id: count}.
+
+    Adds any changes still sitting in shards to each message's `like_count`,
+    using one grouped query for the whole page.
+    """
+
+    counts = {message.id: message.like_count for message in messages}
+    if not counts:
+        return counts
+
+    pending = (db.session.query(LikeCounterShard.message_id, db.func.sum(LikeCounterShard.delta))
+               .filter(LikeCounterShard.message_id.in_(counts))
+               .group_by(LikeCounterShard.message_id))
+
+    for message_id, delta in pending:
+        counts[message_id] += delta
+
+    return counts
+
+
+def compact_like_shards(batch_size=1000):
+    """Fold pending shard deltas into `Message.like_count`.
+
+    Shards are decremented by what was read rather than deleted outright, so
+    likes landing while we compact are never lost. Returns the number of
+    shard rows folded.
+    """
+
+    rows = (db.session.query(LikeCounterShard.message_id, LikeCounterShard.shard, LikeCounterShard.delta)
+            .filter(LikeCounterShard.delta != 0)
+            .limit(batch_size)
+            .all())
+
+    if rows:
+        totals = {}
+        for message_id, shard, delta in rows:
+            totals[message_id] = totals.get(message_id, 0) + delta
+
+        shard_table = LikeCounterShard.__table__
+        db.session.execute(
+            shard_table.update()
+            .where(shard_table.c.message_id == bindparam('b_message_id'),
+                   shard_table.c.shard == bindparam('b_shard'))
+            .values(delta=shard_table.c.delta - bindparam('b_delta')),
+            [{'b_message_id': message_id, 'b_shard': shard, 'b_delta': delta}
+             for message_id, shard, delta in rows])
+
+        db.session.execute(
+            update(Message)
+            .where(Message.id.in_(totals))
+            .values(like_count=Message.like_count + case(totals, value=Message.id))
+            .execution_options(synchronize_session=False))
+
+    LikeCounterShard.query.filter(LikeCounterShard.delta == 0).delete()
+    db.session.commit()
+
+    return len(rows)
+
+
+@likes_cli.command('compact')
+@click.option('--batch-size', default=1000, help="Shard rows folded per transaction.")
+def compact_command(batch_size):
+    """Fold sharded like counters back into messages.like_count."""
+
+    total = 0
+    while True:
+        folded = compact_like_shards(batch_size)
+        total += folded
+        if folded < batch_size:
+            break
+
+    click.echo(f"Folded {total} shard rows.")
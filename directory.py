@@ -0,0 +1,51 @@
+"""Keyset pagination for the user directory."""
+
+from sqlalchemy import tuple_
+
+from models import User
+
+# How the directory can be sorted. Each ordering is backed by an index:
+# the primary key, the unique username index, and (follower_count, id).
+ORDERINGS = {
+    'newest': 'Newest',
+    'followers': 'Most followed',
+    'username': 'A-Z',
+}
+
+
+def cursor_for(user, order):
+    """The `after` value that continues the listing past `user`."""
+
+    if order == 'followers':
+        return f"{user.follower_count}.{user.id}"
+    if order == 'username':
+        return user.username
+    return str(user.id)
+
+
+def directory_page(stmt, order, after, per_page):
+    """Restrict and sort a select of users to one page of the directory.
+
+    `after` is the cursor of the last user on the previous page, so the
+    database seeks straight to the page through the ordering's index rather
+    than counting past every earlier row.
+    """
+
+    if order == 'followers':
+        if after:
+            count, _, user_id = after.partition('.')
+            if count.isdigit() and user_id.isdigit():
+                stmt = stmt.where(tuple_(User.follower_count, User.id) < (int(count), int(user_id)))
+        stmt = stmt.order_by(User.follower_count.desc(), User.id.desc())
+
+    elif order == 'username':
+        if after:
+            stmt = stmt.where(User.username > after)
+        stmt = stmt.order_by(User.username)
+
+    else:
+        if after and after.isdigit():
+            stmt = stmt.where(User.id < int(after))
+        stmt = stmt.order_by(User.id.desc())
+
+    return stmt.limit(per_page)
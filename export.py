@@ -0,0 +1,227 @@
+"""Streaming export of everything in a user's account.
+
+Rows are read with server-side cursors (`yield_per`, which is a named cursor
+on PostgreSQL) and written out one at a time, so memory use doesn't depend on
+the size of the account. Every so often a checkpoint with a signed resume
+token is written; passing it back restarts the export just after that point.
+
+Likes and follows may be on other databases than the messages and users
+they refer to (see sharding.py), so those are looked up a batch at a time
+and joined here, and followers, whose follows are spread over every shard,
+are merged in id order from all of them.
+"""
+
+import csv
+import heapq
+import io
+import itertools
+import json
+import sys
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import select
+
+from models import db, User, Message, ArchivedMessage, Likes, Follows
+
+export_cli = AppGroup('export', help="Export account data.")
+
+CSV_FIELDS = ['type', 'id', 'message_id', 'user_id', 'username', 'text', 'timestamp', 'like_count']
+
+
+def messages_query(user_id, after):
+    return (select(Message.id, Message.timestamp, Message.text, Message.like_count)
+            .where(Message.user_id == user_id, Message.id > after)
+            .order_by(Message.id))
+
+
+def archived_messages_query(user_id, after):
+    return (select(ArchivedMessage.id, ArchivedMessage.timestamp, ArchivedMessage.text,
+                   ArchivedMessage.like_count)
+            .where(ArchivedMessage.user_id == user_id, ArchivedMessage.id > after)
+            .order_by(ArchivedMessage.id))
+
+
+def query_records(query):
+    """A section that's a single statement."""
+
+    def records(user_id, after, batch_size):
+        for row in db.session.execute(query(user_id, after).execution_options(yield_per=batch_size)):
+            yield row._asdict()
+
+    return records
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def like_records(user_id, after, batch_size):
+    """The user's likes, with the message (hot or archived) and its author."""
+
+    likes = db.session.execute(select(Likes.id, Likes.message_id)
+                               .where(Likes.user_id == user_id, Likes.id > after)
+                               .order_by(Likes.id)
+                               .execution_options(yield_per=batch_size))
+
+    for batch in _batches(likes, batch_size):
+        ids = {like.message_id for like in batch}
+        messages = {row.id: row for row in db.session.execute(
+            select(Message.id, Message.user_id, Message.text, Message.timestamp)
+            .where(Message.id.in_(ids)))}
+        if archived := ids.difference(messages):
+            messages.update((row.id, row) for row in db.session.execute(
+                select(ArchivedMessage.id, ArchivedMessage.user_id, ArchivedMessage.text,
+                       ArchivedMessage.timestamp)
+                .where(ArchivedMessage.id.in_(archived))))
+        usernames = _usernames({message.user_id for message in messages.values()})
+
+        for like in batch:
+            message = messages.get(like.message_id)
+            if message is not None and message.user_id in usernames:
+                yield {'id': like.id, 'message_id': message.id, 'user_id': message.user_id,
+                       'username': usernames[message.user_id], 'text': message.text,
+                       'timestamp': message.timestamp}
+
+
+def follower_records(user_id, after, batch_size):
+    ids = (select(Follows.user_following_id)
+           .where(Follows.user_being_followed_id == user_id, Follows.user_following_id > after)
+           .order_by(Follows.user_following_id)
+           .execution_options(yield_per=batch_size))
+    # One result per shard the follows are on, each in order
+    merged = heapq.merge(*(result.scalars() for result in db.session().scatter(ids)))
+    return _user_records(merged, batch_size)
+
+
+def following_records(user_id, after, batch_size):
+    ids = db.session.scalars(select(Follows.user_being_followed_id)
+                             .where(Follows.user_following_id == user_id, Follows.user_being_followed_id > after)
+                             .order_by(Follows.user_being_followed_id)
+                             .execution_options(yield_per=batch_size))
+    return _user_records(ids, batch_size)
+
+
+def _user_records(ids, batch_size):
+    for batch in _batches(ids, batch_size):
+        usernames = _usernames(batch)
+        for user_id in batch:
+            if user_id in usernames:
+                yield {'id': user_id, 'username': usernames[user_id]}
+
+
+def _usernames(user_ids):
+    if not user_ids:
+        return {}
+    return dict(db.session.execute(select(User.id, User.username).where(User.id.in_(user_ids))).all())
+
+
+# Exported in this order; a resume token records the section and the last key
+SECTIONS = [
+    ('message', query_records(messages_query)),
+    ('message', query_records(archived_messages_query)),
+    ('like', like_records),
+    ('follower', follower_records),
+    ('following', following_records),
+]
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='warbler-export')
+
+
+def make_resume_token(user_id, section, key):
+    return _serializer().dumps([user_id, section, key])
+
+
+def read_resume_token(user_id, token):
+    """Return (section, key) to resume from, or raise ValueError."""
+
+    try:
+        token_user_id, section, key = _serializer().loads(token)
+    except (BadSignature, TypeError, ValueError):
+        raise ValueError("invalid resume token") from None
+
+    if token_user_id != user_id:
+        raise ValueError("resume token is for another account")
+
+    return section, key
+
+
+def export_records(user_id, section=0, after=0, batch_size=1000):
+    """Yield (section index, record) for the whole account, in a stable order."""
+
+    for index in range(section, len(SECTIONS)):
+        record_type, records = SECTIONS[index]
+
+        for row in records(user_id, after if index == section else 0, batch_size):
+            record = {'type': record_type, **row}
+            if record.get('timestamp') is not None:
+                record['timestamp'] = record['timestamp'].isoformat()
+            yield index, record
+
+
+def export_stream(user_id, fmt='ndjson', resume=None, checkpoint_every=1000):
+    """Generate the export as NDJSON or CSV text.
+
+    A `checkpoint` record carrying a resume token is written every
+    `checkpoint_every` records, and a `complete` one at the very end, so a
+    client can tell a finished download from a truncated one.
+    """
+
+    section, after = read_resume_token(user_id, resume) if resume else (0, 0)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction='ignore')
+
+        def drain():
+            text = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return text
+
+        def render(record):
+            writer.writerow(record)
+            return drain()
+
+        def marker(record_type, token):
+            return render({'type': record_type, 'text': token})
+
+        if not resume:
+            writer.writeheader()
+            yield drain()
+    else:
+        def render(record):
+            return json.dumps(record) + '\n'
+
+        def marker(record_type, token):
+            return render({'type': record_type, 'resume': token})
+
+    count = 0
+    for index, record in export_records(user_id, section, after):
+        yield render(record)
+
+        count += 1
+        if count % checkpoint_every == 0:
+            yield marker('checkpoint', make_resume_token(user_id, index, record['id']))
+
+    yield marker('complete', make_resume_token(user_id, len(SECTIONS), 0))
+
+
+@export_cli.command('user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--resume', default=None, help="Resume token from an interrupted export.")
+def export_user_command(user_id, fmt, resume):
+    """Write a user's export to stdout."""
+
+    if db.session.get(User, user_id) is None:
+        raise click.ClickException(f"No user #{user_id}")
+
+    for chunk in export_stream(user_id, fmt, resume):
+        sys.stdout.write(chunk)
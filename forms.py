@@ -1,34 +1,90 @@
+import base64
+import binascii
+import os
+
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import _FlaskFormCSRF
+from flask_wtf.file import FileAllowed, FileField
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+IMAGE_TYPES = FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'], "Images only")
+
+
+def mask_token(token):
+    """`token` XORed with a fresh random pad, which is sent along with it.
+
+    Pages are compressed (see compression.py), so a token that came out the
+    same in every response could be guessed a byte at a time from response
+    sizes (BREACH). Masked, it's different every time it's rendered.
+    """
+
+    token = token.encode()
+    pad = os.urandom(len(token))
+    return base64.urlsafe_b64encode(pad + bytes(a ^ b for a, b in zip(pad, token))).decode()
+
+
+def unmask_token(masked):
+    """The token `mask_token` was given, or `masked` as it is if it isn't a masked token."""
+
+    try:
+        data = base64.urlsafe_b64decode(masked.encode())
+    except (AttributeError, ValueError, binascii.Error):
+        return masked
+    pad, token = data[:len(data) // 2], data[len(data) // 2:]
+    try:
+        return bytes(a ^ b for a, b in zip(pad, token)).decode()
+    except UnicodeDecodeError:
+        return masked
+
+
+class MaskedCSRF(_FlaskFormCSRF):
+    """Flask-WTF's CSRF protection, with the token masked in every form."""
+
+    def generate_csrf_token(self, csrf_token_field):
+        return mask_token(super().generate_csrf_token(csrf_token_field))
+
+    def validate_csrf_token(self, form, field):
+        field.data = unmask_token(field.data)
+        super().validate_csrf_token(form, field)
+
+
+class MaskedForm(FlaskForm):
+    """Base for the app's forms: see MaskedCSRF."""
+
+    class Meta:
+        csrf_class = MaskedCSRF
+
 
-class MessageForm(FlaskForm):
+class MessageForm(MaskedForm):
     """Form for adding/editing messages."""
 
     text = TextAreaField('text', validators=[DataRequired()])
 
 
-class UserAddForm(FlaskForm):
+class UserAddForm(MaskedForm):
     """Form for adding users."""
 
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image = FileField('(Optional) Upload an image', validators=[IMAGE_TYPES])
 
 
-class UserEditForm(FlaskForm):
+class UserEditForm(MaskedForm):
     """Form for adding users."""
 
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     image_url = StringField('Image URL')
+    image = FileField('Upload an image', validators=[IMAGE_TYPES])
     header_image_url = StringField('Header Image URL')
+    header_image = FileField('Upload a header image', validators=[IMAGE_TYPES])
     bio = StringField('Bio')
     password = PasswordField('Password', validators=[Length(min=6)])
 
-class LoginForm(FlaskForm):
+class LoginForm(MaskedForm):
     """Login form."""
 
     username = StringField('Username', validators=[DataRequired()])
@@ -0,0 +1,76 @@
+"""gunicorn settings: `gunicorn app:app`.
+
+Workers are gunicorn's default (sync) unless WORKER_CLASS is set, and get
+GUNICORN_THREADS threads each if that is.
+
+Long-lived responses need a worker that serves several requests at once:
+each live timeline connection (/stream/timeline) holds a thread or greenlet
+for as long as the browser stays, so a worker takes at most one fewer than
+it can serve, and none at all under plain sync workers, which get a 503.
+Use WORKER_CLASS=gthread with GUNICORN_THREADS, or WORKER_CLASS=gevent, to
+have them. Data exports are streamed too, and under sync workers are cut off
+at the `timeout`; the client resumes them with the resume token.
+
+With PRELOAD_APP=1 the app is built once in the master and the workers are
+forked from it, so they share its memory and start instantly.
+app.reset_after_fork gives each worker its own database connections.
+
+WORKER_CLASS=gevent runs cooperative workers, each serving up to
+WORKER_CONNECTIONS requests at once (see cooperative.py). The standard
+library is then monkey-patched here, before the app is imported.
+
+Each worker takes over the journaled likes of dead workers as it starts
+(see likes.py), and creates the coming months' message partitions (see
+partitions.py).
+
+Metrics are kept in files under PROMETHEUS_MULTIPROC_DIR so /metrics can
+add up every worker's (see metrics.py). It is emptied when gunicorn starts.
+"""
+
+import os
+import shutil
+import tempfile
+
+if 'WORKER_CLASS' in os.environ:
+    worker_class = os.environ['WORKER_CLASS']
+    if worker_class.startswith('gevent'):
+        from gevent import monkey
+        monkey.patch_all()
+
+if 'GUNICORN_THREADS' in os.environ:
+    threads = int(os.environ['GUNICORN_THREADS'])
+
+preload_app = os.environ.get('PRELOAD_APP', '').lower() in ('1', 'true', 'yes')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+# Before the app (and prometheus_client) is imported, which with preload_app
+# is before on_starting
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def on_starting(server):
+    folder = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_concurrency(cfg):
+    """How many requests one worker serves at once."""
+
+    if cfg.worker_class_str.startswith(('gevent', 'eventlet')):
+        return cfg.worker_connections
+    # gunicorn runs sync workers with more than one thread as gthread
+    return cfg.threads
+
+
+def post_worker_init(worker):
+    import app
+    app.start_worker(worker_concurrency(worker.cfg))
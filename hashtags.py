@@ -0,0 +1,133 @@
+"""Hashtags: parsing them out of message text, and the `message_tags` index.
+
+Every message's tags are written to `message_tags` (tag, timestamp,
+message_id) in the same transaction as the message, and removed with it.
+A tag page is then a single range scan of that table's primary key, newest
+first, instead of a `LIKE '%#tag%'` over every message.
+"""
+
+import re
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+from sqlalchemy import insert, select, tuple_
+
+from archive import parse_cursor
+from models import db, Message, ArchivedMessage, MessageTag
+from partitions import is_partitioned
+
+tags_cli = AppGroup('tags', help="Maintain the hashtag index.")
+
+HASHTAG_RE = re.compile(r'(?<![\w#])#(\w{1,50})')
+
+
+def extract_hashtags(text):
+    """The distinct hashtags in `text`, lowercased, in order of appearance."""
+
+    tags = []
+    for match in HASHTAG_RE.finditer(text or ''):
+        tag = match.group(1).lower()
+        if tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def is_hashtag(tag):
+    return HASHTAG_RE.fullmatch(f"#{tag}") is not None
+
+
+def link_hashtags(text):
+    """`text` as HTML, with each hashtag linking to its tag page."""
+
+    html = []
+    position = 0
+    for match in HASHTAG_RE.finditer(text or ''):
+        html.append(escape(text[position:match.start()]))
+        html.append(Markup('<a href="/tags/{}" class="hashtag">{}</a>').format(
+            match.group(1).lower(), match.group(0)))
+        position = match.end()
+    html.append(escape((text or '')[position:]))
+
+    return Markup('').join(html)
+
+
+def index_messages(messages):
+    """Add index entries for new messages: (id, timestamp, text) tuples or Message objects.
+
+    Doesn't commit, so the entries land in the same transaction as the messages.
+    """
+
+    rows = []
+    for message in messages:
+        message_id, timestamp, text = (
+            (message.id, message.timestamp, message.text) if isinstance(message, db.Model) else message)
+        rows.extend({'tag': tag, 'timestamp': timestamp, 'message_id': message_id}
+                    for tag in extract_hashtags(text))
+
+    if rows:
+        db.session.execute(insert(MessageTag), rows)
+
+
+def unindex_messages(message_ids):
+    """Remove the index entries of deleted messages. `message_ids` may be a subquery."""
+
+    MessageTag.query.filter(MessageTag.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+
+def tagged_messages(tag, before=None, limit=100):
+    """One page of the messages using `tag`, newest first, from both tiers.
+
+    `before` is the cursor (see archive.cursor_for) of the last message on
+    the previous page.
+    """
+
+    entries = MessageTag.query.filter(MessageTag.tag == tag)
+    position = parse_cursor(before)
+    if position:
+        entries = entries.filter(tuple_(MessageTag.timestamp, MessageTag.message_id) < position)
+    entries = (entries.order_by(MessageTag.timestamp.desc(), MessageTag.message_id.desc())
+               .limit(limit)
+               .all())
+
+    if not entries:
+        return []
+
+    ids = [entry.message_id for entry in entries]
+
+    # Authors in a second query: they may be in another database (see sharding.py)
+    hot = Message.query.filter(Message.id.in_(ids)).options(db.selectinload(Message.user))
+    if is_partitioned():
+        # Lets the planner skip partitions outside the page
+        hot = hot.filter(Message.timestamp.between(entries[-1].timestamp, entries[0].timestamp))
+    found = {message.id: message for message in hot}
+
+    missing = [message_id for message_id in ids if message_id not in found]
+    if missing:
+        cold = (ArchivedMessage.query.filter(ArchivedMessage.id.in_(missing))
+                .options(db.joinedload(ArchivedMessage.user)))
+        found.update((message.id, message) for message in cold)
+
+    return [found[message_id] for message_id in ids if message_id in found]
+
+
+@tags_cli.command('reindex')
+@click.option('--batch-size', default=10000, help="Messages indexed per transaction.")
+def reindex_command(batch_size):
+    """Rebuild the hashtag index from every message, hot and archived."""
+
+    MessageTag.query.delete()
+    db.session.commit()
+
+    total = 0
+    for model in (Message, ArchivedMessage):
+        result = db.session.execute(
+            select(model.id, model.timestamp, model.text)
+            .where(model.text.contains('#'))
+            .execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            index_messages(rows)
+            total += len(rows)
+
+    db.session.commit()
+    click.echo(f"Indexed hashtags from {total} messages.")
@@ -0,0 +1,169 @@
+"""Uploaded profile and header images.
+
+Uploads are decoded, normalized to JPEG and stored on local disk under the
+SHA-256 of the normalized file, `<digest>.jpg`, in UPLOAD_FOLDER. The
+variants pages actually show are resized once at upload time and stored next
+to it as `<digest>-<variant>.jpg`. A name never changes content, so
+everything under /images/ is served with a year-long immutable cache header.
+
+A variant that doesn't exist yet (e.g. a new size added after the upload) is
+generated on first request. Concurrent requests for it in the same worker
+wait for one to finish rather than all resizing the same image, and files
+are written atomically, so a race between workers is harmless.
+
+Users can still give a remote URL instead; those are shown as they are.
+Pillow is only imported once an image is processed.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+
+from flask import current_app
+
+# name: (width, height)
+VARIANTS = {
+    'avatar': (200, 200),
+    'card': (600, 200),
+    'header': (1500, 500),
+}
+
+# Variants made at upload time for each kind of image
+UPLOAD_VARIANTS = {
+    'avatar': ['avatar'],
+    'header': ['card', 'header'],
+}
+
+MAX_DIMENSION = 3000
+MAX_PIXELS = 40_000_000
+JPEG_QUALITY = 85
+
+IMAGE_URL_RE = re.compile(r'^/images/([0-9a-f]{64})\.jpg$')
+IMAGE_NAME_RE = re.compile(r'([0-9a-f]{64})(?:-(\w+))?')
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def upload_folder():
+    return current_app.config['UPLOAD_FOLDER']
+
+
+def image_path(digest, variant=None):
+    name = f"{digest}-{variant}.jpg" if variant else f"{digest}.jpg"
+    return os.path.join(upload_folder(), name)
+
+
+def image_url(digest, variant=None):
+    return f"/images/{digest}-{variant}.jpg" if variant else f"/images/{digest}.jpg"
+
+
+def sized(url, variant):
+    """The URL of `variant` of an uploaded image; other URLs are returned as they are."""
+
+    match = IMAGE_URL_RE.match(url or '')
+    if match is None:
+        return url
+    return image_url(match.group(1), variant)
+
+
+def parse_image_name(name):
+    """(digest, variant or None) for an image name without `.jpg`, or None if it isn't one."""
+
+    match = IMAGE_NAME_RE.fullmatch(name)
+    if match is None or (match.group(2) and match.group(2) not in VARIANTS):
+        return None
+    return match.group(1), match.group(2)
+
+
+def _write(path, data):
+    """Write a file atomically, so readers never see half of it."""
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _resize(image, variant):
+    from PIL import Image, ImageOps
+
+    return ImageOps.fit(image, VARIANTS[variant], Image.LANCZOS)
+
+
+def save_upload(file, kind):
+    """Store an uploaded image and its variants; return its URL.
+
+    Raises ValueError with a message for the user if the file isn't a usable image.
+    """
+
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    data = file.read(current_app.config['UPLOAD_MAX_BYTES'] + 1)
+    if len(data) > current_app.config['UPLOAD_MAX_BYTES']:
+        raise ValueError(f"Images can be at most {current_app.config['UPLOAD_MAX_BYTES'] // 1024 // 1024} MB")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_PIXELS:
+            raise ValueError("That image is too large")
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise ValueError("That file isn't an image we can read") from None
+
+    image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+    original = _encode(image)
+    digest = hashlib.sha256(original).hexdigest()
+
+    os.makedirs(upload_folder(), exist_ok=True)
+    if not os.path.exists(image_path(digest)):
+        _write(image_path(digest), original)
+
+    for variant in UPLOAD_VARIANTS[kind]:
+        if not os.path.exists(image_path(digest, variant)):
+            _write(image_path(digest, variant), _encode(_resize(image, variant)))
+
+    return image_url(digest)
+
+
+def ensure_variant(digest, variant):
+    """Make sure `variant` of an uploaded image exists; return its path, or None if there's no such image."""
+
+    path = image_path(digest, variant)
+    if os.path.exists(path):
+        return path
+
+    from PIL import Image
+
+    with _locks_lock:
+        lock = _locks.setdefault(path, threading.Lock())
+
+    try:
+        with lock:
+            # Another request may have made it while we waited
+            if os.path.exists(path):
+                return path
+
+            try:
+                image = Image.open(image_path(digest))
+            except FileNotFoundError:
+                return None
+
+            _write(path, _encode(_resize(image.convert('RGB'), variant)))
+            return path
+    finally:
+        with _locks_lock:
+            _locks.pop(path, None)
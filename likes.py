@@ -0,0 +1,353 @@
+"""Write-behind buffering of likes.
+
+Likes arrive as intents: "user U now likes (or no longer likes) message M".
+Each worker keeps the latest intent per (user, message) in a LikeBuffer and
+writes them all every LIKE_FLUSH_SECONDS in one transaction: one multi-row
+INSERT for the likes, one DELETE for the unlikes, then the counters and
+notifications for what actually changed. A like storm becomes a handful of
+statements a second, and a user toggling back and forth costs nothing.
+
+Intents are absolute, not toggles, so writing one twice does no harm. Before
+a batch is acknowledged it is appended to this worker's journal in
+LIKE_JOURNAL_FOLDER and fsynced; a flush deletes the journal segments it
+has written. If a worker dies with intents unwritten, the next worker to
+start on the host finds its segments (by their dead pid) and writes them
+(see `LikeBuffer.recover`), and `flask likes replay` does the same by hand.
+
+The buffer is per worker, so two workers given intents for the same
+(user, message) within one window may write them out of order. The client
+(static/likes.js) sends one batch at a time, which keeps that rare.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import current_app
+from sqlalchemy import delete, select, tuple_
+
+from counters import apply_like_deltas, likes_cli
+from models import db, User, Message, Likes, Notification, PRIMARY, dialect_insert
+from notifications import discard_notifications, notify
+
+
+class LikeBuffer:
+    """This worker's like intents not yet written to the database.
+
+    The flushing thread is started by the first intent (or recovered ones)
+    and stops once the buffer is empty, so an idle worker holds no thread
+    (and none is ever inherited across a fork).
+    """
+
+    def __init__(self, app, folder, flush_seconds=1.0):
+        self.app = app
+        self.folder = folder
+        self.flush_seconds = flush_seconds
+
+        self._intents = {}
+        self._flushing = {}
+        self._segments = []
+        self._journal = None
+        self._sequence = 0
+        self._recovered = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, user_id, intents):
+        """Buffer {message_id: liked} for `user_id`, durably.
+
+        Returns once the intents are in the journal.
+        """
+
+        with self._lock:
+            self._recover()
+            if self._journal is None:
+                os.makedirs(self.folder, exist_ok=True)
+                path = os.path.join(self.folder, f'likes-{os.getpid()}-{self._sequence}.log')
+                self._journal = open(path, 'a')
+                self._segments.append(path)
+
+            for message_id, liked in intents.items():
+                self._journal.write(json.dumps([user_id, message_id, liked]) + '\n')
+                self._intents[(user_id, message_id)] = liked
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._start_thread()
+
+    def write_now(self, user_id, message_id, liked):
+        """Buffer one intent, then write just that one rather than the whole buffer.
+
+        Journaled first, like any other, and written between flushes, so no
+        older intent for the same like can land after it. If writing it
+        fails it's left for the next flush.
+        """
+
+        self.add(user_id, {message_id: liked})
+        with self._flush_lock:
+            try:
+                write_likes({(user_id, message_id): liked})
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Writing a like failed; leaving it buffered")
+                return
+
+            with self._lock:
+                if self._intents.get((user_id, message_id)) == liked:
+                    del self._intents[(user_id, message_id)]
+
+    def recover(self):
+        """Take over dead workers' journals and start writing them. Call as a worker starts."""
+
+        with self._lock:
+            self._recover()
+            if self._intents:
+                self._start_thread()
+
+    def _start_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='warbler-likes', daemon=True)
+            self._thread.start()
+
+    def pending(self, user_id, message_ids):
+        """{message_id: liked} for the unwritten intents of `user_id` among `message_ids`."""
+
+        with self._lock:
+            found = {}
+            for intents in (self._flushing, self._intents):
+                for message_id in message_ids:
+                    liked = intents.get((user_id, message_id))
+                    if liked is not None:
+                        found[message_id] = liked
+            return found
+
+    def take(self):
+        """Return the buffered intents and their journal segments, starting afresh."""
+
+        with self._lock:
+            self._recover()
+            intents, segments = self._intents, self._segments
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+                self._sequence += 1
+            self._intents, self._segments = {}, []
+            self._flushing = intents
+            return intents, segments
+
+    def put_back(self, intents, segments):
+        """Return intents that failed to write; newer ones for the same key win."""
+
+        with self._lock:
+            self._intents = {**intents, **self._intents}
+            self._segments = segments + self._segments
+            self._flushing = {}
+
+    def flush(self):
+        """Write everything buffered and commit. Returns the number of intents written."""
+
+        with self._flush_lock:
+            intents, segments = self.take()
+            if not intents:
+                return 0
+
+            try:
+                write_likes(intents)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.put_back(intents, segments)
+                raise
+
+            with self._lock:
+                self._flushing = {}
+            for path in segments:
+                os.remove(path)
+            return len(intents)
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.flush_seconds)
+                try:
+                    written = self.flush()
+                except Exception:
+                    self.app.logger.exception("Writing buffered likes failed; retrying")
+                    written = None
+                finally:
+                    db.session.remove()
+
+                if written == 0:
+                    with self._lock:
+                        if not self._intents:
+                            self._thread = None
+                            return
+
+    def _recover(self):
+        """Take over the journal segments of dead workers. Call with the lock held.
+
+        Also done on the first intent, if `recover` wasn't called. Each is
+        renamed to this worker's pid before it's read, so two workers starting
+        together don't both claim it, and a worker dying before it writes them
+        leaves them for the next. Segments already under our pid (a dead
+        predecessor's) keep their names, and new names are numbered after
+        them so none is overwritten.
+        """
+
+        if self._recovered:
+            return
+        self._recovered = True
+
+        pid = os.getpid()
+        orphans = [(name, segment_owner(name)) for name in orphaned_segments(self.folder)]
+        self._sequence = max((sequence + 1 for _, (owner, sequence) in orphans if owner == pid), default=0)
+
+        for name, (owner, _) in orphans:
+            path = os.path.join(self.folder, name)
+            if owner != pid:
+                claimed = os.path.join(self.folder, f'likes-{pid}-{self._sequence}.log')
+                self._sequence += 1
+                try:
+                    os.rename(path, claimed)
+                except FileNotFoundError:
+                    continue
+                path = claimed
+            self._intents.update(read_segment(path))
+            self._segments.append(path)
+
+
+def orphaned_segments(folder):
+    """Names of the journal segments in `folder` left by dead workers, oldest first."""
+
+    if not os.path.isdir(folder):
+        return []
+
+    orphans = []
+    for name in os.listdir(folder):
+        owner = segment_owner(name)
+        # Our own pid means a dead predecessor's: we haven't written yet
+        if owner and (owner[0] == os.getpid() or not _alive(owner[0])):
+            orphans.append((owner, name))
+    return [name for _, name in sorted(orphans)]
+
+
+def segment_owner(name):
+    """(pid, sequence) of a journal segment's file name, or None if it isn't one."""
+
+    parts = name[:-len('.log')].split('-') if name.endswith('.log') else []
+    if len(parts) == 3 and parts[0] == 'likes' and parts[1].isdigit() and parts[2].isdigit():
+        return int(parts[1]), int(parts[2])
+    return None
+
+
+def read_segment(path):
+    intents = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                user_id, message_id, liked = json.loads(line)
+            except ValueError:
+                # A line cut short by the crash was never acknowledged
+                continue
+            intents[(user_id, message_id)] = liked
+    return intents
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_likes(intents):
+    """Bring the likes table in line with {(user_id, message_id): liked}.
+
+    Intents for users or messages that have since been deleted are dropped.
+    Adjusts the like counters and notifications by what actually changed.
+    Doesn't commit.
+    """
+
+    message_ids = {message_id for _, message_id in intents}
+    authors = dict(db.session.execute(select(Message.id, Message.user_id).where(Message.id.in_(message_ids))).all())
+    users = set(db.session.scalars(select(User.id).where(User.id.in_({user_id for user_id, _ in intents}))))
+    intents = {(user_id, message_id): liked for (user_id, message_id), liked in intents.items()
+               if user_id in users and message_id in authors}
+
+    added, removed = [], []
+    for shard, pairs in _by_shard(intents).items():
+        bind_arguments = {'shard_id': shard} if shard else {}
+
+        likes = [{'user_id': user_id, 'message_id': message_id} for user_id, message_id in pairs
+                 if intents[(user_id, message_id)]]
+        if likes:
+            stmt = (dialect_insert(Likes, db.session().get_bind(shard_id=shard or PRIMARY))
+                    .values(likes)
+                    .on_conflict_do_nothing(index_elements=['user_id', 'message_id'])
+                    .returning(Likes.user_id, Likes.message_id))
+            added += db.session.execute(stmt, bind_arguments=bind_arguments).all()
+
+        unlikes = [pair for pair in pairs if not intents[pair]]
+        if unlikes:
+            stmt = (delete(Likes)
+                    .where(Likes.user_id.in_({user_id for user_id, _ in unlikes}),
+                           tuple_(Likes.user_id, Likes.message_id).in_(unlikes))
+                    .returning(Likes.user_id, Likes.message_id))
+            removed += db.session.execute(stmt, bind_arguments=bind_arguments).all()
+
+    deltas = Counter(message_id for _, message_id in added)
+    deltas.subtract(message_id for _, message_id in removed)
+    apply_like_deltas(deltas)
+
+    notify([{'user_id': authors[message_id], 'actor_id': user_id, 'kind': 'like', 'message_id': message_id}
+            for user_id, message_id in added])
+    if removed:
+        discard_notifications(Notification.kind == 'like',
+                              tuple_(Notification.actor_id, Notification.message_id).in_(
+                                  [tuple(row) for row in removed]))
+
+
+def _by_shard(intents):
+    """The (user_id, message_id) keys of `intents` grouped by the shard of their likes."""
+
+    session = db.session()
+    if not session.data_shards:
+        return {None: list(intents)} if intents else {}
+
+    placements = session.shards_for_users({user_id for user_id, _ in intents})
+    groups = {}
+    for user_id, message_id in intents:
+        groups.setdefault(placements[user_id], []).append((user_id, message_id))
+    return groups
+
+
+def liked_message_ids(user, message_ids):
+    """`user.liked_message_ids`, counting this worker's unwritten intents."""
+
+    message_ids = list(message_ids)
+    liked = user.liked_message_ids(message_ids)
+    for message_id, intent in likes_buffer().pending(user.id, message_ids).items():
+        if intent:
+            liked.add(message_id)
+        else:
+            liked.discard(message_id)
+    return liked
+
+
+def likes_buffer():
+    return current_app.extensions['likes']
+
+
+@likes_cli.command('replay')
+def replay_command():
+    """Write the journaled likes of dead workers."""
+
+    buffer = likes_buffer()
+    click.echo(f"Wrote {buffer.flush()} buffered likes.")
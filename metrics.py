@@ -0,0 +1,109 @@
+"""Prometheus metrics, served at /metrics.
+
+- warbler_http_requests_total{endpoint, method, status} and
+  warbler_http_request_duration_seconds{endpoint}: per view function. A
+  streamed page is timed until its last byte.
+- warbler_http_requests_in_progress
+- warbler_db_pool_checked_out{bind} and warbler_db_pool_overflow{bind}:
+  connections in use, and how many of those are beyond the pool size.
+- warbler_bcrypt_seconds{operation}: password hashing and checking.
+- warbler_cache_lookups_total{cache, result}: hits and misses; the hit
+  ratio is `rate(...{result="hit"}) / rate(...)`.
+
+Under gunicorn each worker has its own counters. With
+PROMETHEUS_MULTIPROC_DIR set (gunicorn.conf.py does) they're kept in files
+in that directory and /metrics adds up every worker's, whichever worker
+answers. The variable has to be set before prometheus_client is imported.
+"""
+
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+
+REQUESTS = Counter('warbler_http_requests_total', "HTTP requests.", ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram('warbler_http_request_duration_seconds', "HTTP request latency.", ['endpoint'])
+IN_PROGRESS = Gauge('warbler_http_requests_in_progress', "HTTP requests being served.",
+                    multiprocess_mode='livesum')
+
+POOL_CHECKED_OUT = Gauge('warbler_db_pool_checked_out', "Database connections in use.", ['bind'],
+                         multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('warbler_db_pool_overflow', "Database connections in use beyond the pool size.", ['bind'],
+                      multiprocess_mode='livesum')
+
+BCRYPT_SECONDS = Histogram('warbler_bcrypt_seconds', "Time spent in bcrypt.", ['operation'],
+                           buckets=(.05, .1, .2, .3, .5, .75, 1, 2, 5))
+
+CACHE_LOOKUPS = Counter('warbler_cache_lookups_total', "Cache lookups.", ['cache', 'result'])
+
+
+def record_cache(cache, hits=0, misses=0):
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def init_metrics(app, engines):
+    """Time `app`'s requests, watch the pools of `engines` ({bind key: engine}) and serve /metrics."""
+
+    for key, engine in engines.items():
+        watch_pool(engine, key or 'primary')
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        IN_PROGRESS.inc()
+
+    @app.after_request
+    def note_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(error):
+        started = g.pop('request_started', None)
+        if started is None:
+            return
+
+        endpoint = request.endpoint or 'none'
+        status = 500 if error is not None else g.pop('response_status', 500)
+        REQUESTS.labels(endpoint, request.method, str(status)).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+        IN_PROGRESS.dec()
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def watch_pool(engine, bind):
+    """Keep the pool gauges for `engine` up to date as connections come and go."""
+
+    pool = engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return
+
+    def update(returning):
+        # The pool in use, which changes when the engine is disposed. A
+        # connection being checked in is still counted as out.
+        current = engine.pool
+        in_use = current.checkedout() - returning
+        POOL_CHECKED_OUT.labels(bind).set(in_use)
+        POOL_OVERFLOW.labels(bind).set(max(in_use - current.size(), 0) if hasattr(current, 'size') else 0)
+
+    event.listen(engine, 'checkout', lambda *args: update(0))
+    event.listen(engine, 'checkin', lambda *args: update(1))
+
+
+def generate_metrics():
+    """The metrics in the text format, for every worker in multiprocess mode."""
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
@@ -4,9 +4,212 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, lambda_stmt, select, text
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.sql.util import find_tables
+
+from cooperative import offload
+from metrics import BCRYPT_SECONDS, record_cache
+
+# Sharded tables, and the user id column that decides which shard a row
+# lives on. Everything else is on the primary database. See sharding.py.
+SHARD_KEYS = {
+    'messages': 'user_id',
+    'likes': 'user_id',
+    'follows': 'user_following_id',
+}
+
+PRIMARY = 'primary'
+
+
+class RoutingSession(ShardedSession):
+    """The session behind `db.session`: sends each statement where its rows are.
+
+    With no shards configured everything goes to the primary. Otherwise
+    rows of the SHARD_KEYS tables are written to their user's shard, and
+    reads go to the shards named by the statement's shard key criteria
+    (`user_id == x`, `user_id IN (...)`), or to every shard if it has none,
+    with the results concatenated. Statements that mix a sharded table with
+    any other table can't be answered by one database and are refused.
+    """
+
+    def __init__(self, db, engines=None, **kwargs):
+        # `engines` in place of db.engines: the sync side of asyncio engines (see asgi.py)
+        engines = db.engines if engines is None else engines
+        self.data_shards = sorted((key for key in engines if key and key.startswith('shard')),
+                                  key=lambda key: int(key[len('shard'):]))
+        shards = {PRIMARY: engines[None], **{key: engines[key] for key in self.data_shards}}
+
+        super().__init__(shard_chooser=self._choose_shard,
+                         identity_chooser=self._choose_identity_shards,
+                         execute_chooser=self._choose_execute_shards,
+                         shards=shards, **kwargs)
+        self._db = db
+        self._model_changes = {}
+        # {user_id: shard}, looked up once per session
+        self._placements = {}
+
+    @property
+    def connection_callable(self):
+        # Only flushes need a connection chosen row by row, and ORM bulk
+        # INSERT and UPDATE refuse to run at all while one is offered.
+        return super().connection_callable if self._flushing else None
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        if shard_id is None and mapper is None and instance is None:
+            shard_id = PRIMARY
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+    def shards_for_users(self, user_ids):
+        """{user_id: shard} for `user_ids`, from the shard map in `users`.
+
+        Users without a recorded shard are on shard `id % number of shards`.
+        """
+
+        missing = {user_id for user_id in user_ids if user_id not in self._placements}
+        record_cache('shard_map', hits=len(set(user_ids)) - len(missing), misses=len(missing))
+        if missing:
+            # A plain connection, so this is safe in the middle of a flush
+            rows = self.connection(bind_arguments={'shard_id': PRIMARY}).execute(
+                select(User.id, User.shard).where(User.id.in_(missing)))
+            recorded = dict(rows.all())
+            for user_id in missing:
+                shard = recorded.get(user_id)
+                if shard is None:
+                    shard = user_id % len(self.data_shards)
+                self._placements[user_id] = f'shard{shard}'
+
+        return {user_id: self._placements[user_id] for user_id in user_ids}
+
+    def forget_placements(self):
+        self._placements.clear()
+
+    def shards_for(self, statement, parameters=None):
+        """The shards `statement` has to run on."""
+
+        if not self.data_shards:
+            return [PRIMARY]
+
+        if hasattr(statement, '_resolved'):
+            # A lambda statement
+            statement = statement._resolved
+
+        tables = {table.name for table in find_tables(statement, include_crud=True, include_joins=True)}
+        sharded = tables & SHARD_KEYS.keys()
+        if not sharded:
+            return [PRIMARY]
+        if len(tables) > 1:
+            raise InvalidRequestError(
+                f"Can't run a statement across sharded and other tables: {', '.join(sorted(tables))}")
+
+        table = sharded.pop()
+        user_ids = _shard_key_values(statement, table, SHARD_KEYS[table], parameters)
+        if user_ids is None:
+            return list(self.data_shards)
+        return sorted(set(self.shards_for_users(user_ids).values()))
+
+    def scatter(self, statement, params=None):
+        """Run `statement` on each shard it needs, returning one result per shard.
+
+        For aggregates and anything else whose per-shard results have to be
+        combined by the caller rather than concatenated.
+        """
+
+        return [self.execute(statement, params, bind_arguments={'shard_id': shard_id})
+                for shard_id in self.shards_for(statement, params)]
+
+    def next_message_ids(self, count):
+        """Allocate `count` message ids from the primary's sequence.
+
+        Messages on different shards share one id space, so a message id
+        alone still identifies a message.
+        """
+
+        if self.get_bind().dialect.name != 'postgresql':
+            raise InvalidRequestError("Sharding needs a PostgreSQL primary to allocate message ids.")
+
+        rows = self.connection(bind_arguments={'shard_id': PRIMARY}).execute(
+            text("SELECT nextval('messages_id_seq') FROM generate_series(1, :count)"), {'count': count})
+        return [row[0] for row in rows]
+
+    def _choose_shard(self, mapper, instance, clause=None, **kw):
+        key = SHARD_KEYS.get(mapper.local_table.name) if self.data_shards else None
+        if key is None:
+            return PRIMARY
+        if instance is None:
+            raise InvalidRequestError(f"No single shard for {mapper.local_table.name} without a row.")
+
+        user_id = getattr(instance, key)
+        return self.shards_for_users([user_id])[user_id]
+
+    def _choose_identity_shards(self, mapper, primary_key, **kw):
+        key = SHARD_KEYS.get(mapper.local_table.name) if self.data_shards else None
+        if key is None:
+            return [PRIMARY]
+
+        for column, value in zip(mapper.primary_key, primary_key):
+            if column.name == key:
+                return [self.shards_for_users([value])[value]]
+        return list(self.data_shards)
+
+    def _choose_execute_shards(self, orm_context):
+        return self.shards_for(orm_context.statement, orm_context.parameters)
+
+
+def _shard_key_values(statement, table, key, parameters):
+    """The user ids `statement` is limited to, or None if it isn't.
+
+    Looks at INSERT parameters, and at `key == x` and `key IN (...)` terms
+    ANDed together at the top level of the WHERE clause.
+    """
+
+    if statement.is_insert:
+        rows = parameters if isinstance(parameters, list) else [parameters or {}]
+        values = [row.get(key) for row in rows]
+        return None if None in values else values
+
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return None
+
+    terms = where.clauses if getattr(where, 'operator', None) is operators.and_ else [where]
+    for term in terms:
+        column, value = getattr(term, 'left', None), getattr(term, 'right', None)
+        if (getattr(column, 'name', None) != key
+                or getattr(getattr(column, 'table', None), 'name', None) != table
+                or not isinstance(value, BindParameter)):
+            continue
+        # Session.get() passes the primary key values as parameters
+        if isinstance(parameters, dict) and value.key in parameters:
+            value = parameters[value.key]
+        else:
+            value = value.effective_value
+        if term.operator is operators.eq:
+            return [value]
+        if term.operator is operators.in_op:
+            return list(value)
+
+    return None
+
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def assign_message_ids(session, flush_context, instances):
+    """Give new messages ids from the shared sequence when they're sharded."""
+
+    if not session.data_shards:
+        return
+
+    new = [obj for obj in session.new if isinstance(obj, Message) and obj.id is None]
+    if new:
+        for message, message_id in zip(new, session.next_message_ids(len(new))):
+            message.id = message_id
 
 
 class Follows(db.Model):
@@ -42,13 +245,76 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # No foreign key: likes stay with a message when it's archived (see
+    # archive.py), and the views that delete messages delete their likes.
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        # A user's newest likes, for ranking (see ranking.load_affinities)
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+    )
+
+
+class LikeCounterShard(db.Model):
+    """Pending like count changes for a hot message, spread over several rows.
+
+    See counters.py: these are folded back into `Message.like_count` by
+    compaction.
+    """
+
+    __tablename__ = 'message_like_shards'
+
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    delta = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
     )
 
 
+class FollowSuggestion(db.Model):
+    """A precomputed "who to follow" suggestion (see recommendations.py)."""
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    suggested_user = db.relationship('User', foreign_keys=[suggested_user_id])
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -94,25 +360,67 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Maintained by the follow/unfollow views so the directory can be sorted
+    # by popularity without counting the follows table.
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Maintained by notifications.py so the unread badge is a column read.
+    # Notifications with ids above `notifications_read_id` are unread.
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    notifications_read_id = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Which shard holds this user's messages, likes and follows. NULL means
+    # shard `id % number of shards`; `flask shards move` records others.
+    shard = db.Column(
+        db.Integer,
+    )
+
+    __table_args__ = (
+        db.Index('ix_users_follower_count_id', 'follower_count', 'id'),
+    )
+
     messages = db.relationship('Message', cascade='delete, all')
 
+    # passive_deletes: deleting a user doesn't load these just to delete the
+    # rows behind them (the delete_user view does that directly).
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="Likes.user_id == User.id",
+        secondaryjoin="foreign(Likes.message_id) == Message.id",
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -121,14 +429,63 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.get(Follows, (self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.get(Follows, (other_user.id, self.id)) is not None
+
+    # The counts and lists below look follows and likes up on their own and
+    # users and messages separately, rather than through the relationships
+    # above, so they work when these live in different databases (see
+    # sharding.py). Counting also beats loading whole collections.
+
+    def message_count(self):
+        return db.session.scalar(select(db.func.count()).where(Message.user_id == self.id))
+
+    def following_count(self):
+        return db.session.scalar(select(db.func.count()).where(Follows.user_following_id == self.id))
+
+    def likes_count(self):
+        return db.session.scalar(select(db.func.count()).where(Likes.user_id == self.id))
+
+    def following_users(self):
+        ids = select(Follows.user_being_followed_id).where(Follows.user_following_id == self.id)
+        return _users_by_id(db.session.scalars(ids).all())
+
+    def follower_users(self):
+        ids = select(Follows.user_following_id).where(Follows.user_being_followed_id == self.id)
+        return _users_by_id(db.session.scalars(ids).all())
+
+    def liked_messages(self):
+        """Messages this user has liked, hot or archived."""
+
+        ids = db.session.scalars(select(Likes.message_id).where(Likes.user_id == self.id)).all()
+        if not ids:
+            return []
+        messages = Message.query.filter(Message.id.in_(ids)).all()
+        archived = set(ids).difference(message.id for message in messages)
+        if archived:
+            messages += ArchivedMessage.query.filter(ArchivedMessage.id.in_(archived)).all()
+        # Sorted here: with shards, each one's results come back separately
+        return sorted(messages, key=lambda message: message.id)
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Only asks the database about the given messages, so the cost depends
+        on what's being rendered rather than on how many likes the user has.
+        Returns a set of message ids.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(Likes.message_id)
+                .filter(Likes.user_id == self.id, Likes.message_id.in_(message_ids)))
+        return {row.message_id for row in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +494,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with BCRYPT_SECONDS.labels('hash').time():
+            hashed_pwd = offload(bcrypt.generate_password_hash, password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -160,10 +518,14 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        # A cached statement: this runs on every login (see queries.py)
+        user = db.session.execute(
+            lambda_stmt(lambda: select(User).where(User.username == username).limit(1))
+        ).scalar_one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with BCRYPT_SECONDS.labels('check').time():
+                is_auth = offload(bcrypt.check_password_hash, user.password, password)
             if is_auth:
                 return user
 
@@ -207,7 +569,57 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # Maintained incrementally by counters.py; hot messages may have more
+    # pending in `message_like_shards`.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    user = db.relationship('User')
+
+    archived = False
+
+    __table_args__ = (
+        # Profile pages and the timeline read a user's newest messages
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of the hot table by the archival job (archive.py).
+
+    Archived messages keep their id, their likes and final like count but
+    can no longer be liked or unliked.
+    """
+
+    __tablename__ = 'messages_archive'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
     )
 
     user_id = db.Column(
@@ -216,8 +628,174 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     user = db.relationship('User')
 
+    archived = True
+
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class Notification(db.Model):
+    """Something that happened to a user: a mention, a new follower or a like."""
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Who the notification is for
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # Who did it
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'mention', 'follow' or 'like'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # The message mentioning or liked; no foreign key, as with message_tags
+    message_id = db.Column(
+        db.Integer,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    __table_args__ = (
+        # The inbox pages back through a user's notifications by id
+        db.Index('ix_notifications_user_id_id', 'user_id', 'id'),
+        db.Index('ix_notifications_actor_id', 'actor_id'),
+        db.Index('ix_notifications_message_id', 'message_id'),
+    )
+
+
+class MessageTag(db.Model):
+    """Inverted index from hashtag to the messages using it (see hashtags.py).
+
+    The primary key is also the tag page's sort order, so a page is one
+    range scan. There's no foreign key to messages: ids may live in the
+    partitioned table or the archive, and deletes clean up after themselves.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        # For removing a deleted message's (or user's) entries
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+
+class TagBucketCount(db.Model):
+    """How often a hashtag was used in a time bucket, merged from every worker.
+
+    Only each worker's heavy hitters make it here (see trending.py).
+    """
+
+    __tablename__ = 'tag_bucket_counts'
+
+    bucket_start = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class TrendingTag(db.Model):
+    """A precomputed trending hashtag for the sidebar."""
+
+    __tablename__ = 'trending_tags'
+
+    period = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    tag = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+def _users_by_id(ids):
+    if not ids:
+        return []
+    return User.query.filter(User.id.in_(ids)).order_by(User.id).all()
+
+
+def dialect_insert(model, engine=None):
+    """An INSERT for `model` that supports ON CONFLICT on our database (or `engine`'s)."""
+
+    if (engine or db.engine).dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    return insert(model)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
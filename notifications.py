@@ -0,0 +1,117 @@
+"""Notifications: mentions, new followers and likes.
+
+Each user has an `unread_notifications` counter that is kept up to date as
+notifications are added and removed, so the badge in the navbar is a column
+on the already-loaded user rather than a COUNT(*) on every page. Reading the
+inbox resets it, and records the newest id read in `notifications_read_id`.
+"""
+
+import re
+from collections import Counter
+
+from sqlalchemy import case, insert, select, update
+
+from models import db, User, Message, ArchivedMessage, Notification
+
+MENTION_RE = re.compile(r'(?<![\w@])@(\w{1,50})')
+
+
+def extract_mentions(text):
+    """The distinct usernames @mentioned in `text`, in order of appearance."""
+
+    names = []
+    for match in MENTION_RE.finditer(text or ''):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+    return names
+
+
+def mention_notifications(author_id, messages):
+    """Notification rows for the mentions in `messages`, (id, text) pairs.
+
+    All the usernames are resolved in one query; unknown ones are ignored.
+    """
+
+    mentions = [(message_id, extract_mentions(text)) for message_id, text in messages]
+    names = {name for _, message_names in mentions for name in message_names}
+    if not names:
+        return []
+
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(names)))
+
+    return [{'user_id': user_ids[name], 'actor_id': author_id, 'kind': 'mention', 'message_id': message_id}
+            for message_id, message_names in mentions
+            for name in message_names if name in user_ids]
+
+
+def _adjust_unread(counts):
+    """Add {user_id: change} to users' unread counters."""
+
+    counts = {user_id: change for user_id, change in counts.items() if change}
+    if counts:
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(counts))
+            .values(unread_notifications=User.unread_notifications + case(counts, value=User.id))
+            .execution_options(synchronize_session=False))
+
+
+def notify(rows):
+    """Add notifications (dicts of user_id, actor_id, kind and message_id).
+
+    Nobody is notified of their own actions. Doesn't commit.
+    """
+
+    rows = [row for row in rows if row['user_id'] != row['actor_id']]
+    if not rows:
+        return
+
+    db.session.execute(insert(Notification), [{'message_id': None, **row} for row in rows])
+    _adjust_unread(Counter(row['user_id'] for row in rows))
+
+
+def discard_notifications(*criteria):
+    """Delete the notifications matching `criteria`, taking unread ones off the counters."""
+
+    unread = (db.session.query(Notification.user_id, db.func.count())
+              .join(User, User.id == Notification.user_id)
+              .filter(*criteria, Notification.id > User.notifications_read_id)
+              .group_by(Notification.user_id))
+    _adjust_unread({user_id: -count for user_id, count in unread})
+
+    Notification.query.filter(*criteria).delete(synchronize_session=False)
+
+
+def mark_read(user):
+    """Mark all of `user`'s notifications read."""
+
+    newest = (select(db.func.coalesce(db.func.max(Notification.id), 0))
+              .where(Notification.user_id == user.id)
+              .scalar_subquery())
+    User.query.filter_by(id=user.id).update(
+        {User.unread_notifications: 0, User.notifications_read_id: newest}, synchronize_session=False)
+
+
+def notifications_page(user_id, before=None, limit=50):
+    """One page of a user's notifications, newest first, each with its `message` (or None).
+
+    `before` is the id of the last notification on the previous page.
+    """
+
+    query = (Notification.query
+             .filter(Notification.user_id == user_id)
+             .options(db.joinedload(Notification.actor)))
+    if before:
+        query = query.filter(Notification.id < before)
+    notifications = query.order_by(Notification.id.desc()).limit(limit).all()
+
+    ids = {n.message_id for n in notifications if n.message_id is not None}
+    messages = {m.id: m for m in Message.query.filter(Message.id.in_(ids))} if ids else {}
+    missing = ids - messages.keys()
+    if missing:
+        messages.update((m.id, m) for m in ArchivedMessage.query.filter(ArchivedMessage.id.in_(missing)))
+
+    for notification in notifications:
+        notification.message = messages.get(notification.message_id)
+
+    return notifications
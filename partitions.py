@@ -0,0 +1,301 @@
+"""Monthly range partitioning of the messages table (PostgreSQL only).
+
+`flask partitions migrate` converts an existing `messages` table online:
+
+1. create `messages_partitioned`, partitioned by range on `timestamp`, with a
+   partition per month holding data plus a default partition;
+2. install a trigger on `messages` that mirrors every insert, update and
+   delete into the new table;
+3. copy existing rows across in id-ordered batches, one short transaction
+   each (rows the trigger already copied are left alone);
+4. reconcile the two tables batch by batch, in case a delete raced a copy;
+5. swap the tables under a brief lock. The old table is kept as
+   `messages_unpartitioned` until you drop it.
+
+A partitioned table can't be the target of a foreign key on `id` alone, so
+the foreign key from message_like_shards (and from likes, on databases
+created before likes lost theirs) is dropped in the swap and the views
+clean those rows up themselves.
+
+`flask partitions maintain` creates the partitions for the coming months and
+should run daily from cron; each worker also does so when it starts, so one
+missed run doesn't send new messages to the default partition. Rows falling
+outside every partition land in the default partition rather than failing,
+and are moved out when a partition for their month is created.
+"""
+
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db, Message
+
+partitions_cli = AppGroup('partitions', help="Manage the partitioned messages table.")
+
+# Windows (in days) tried in turn when fetching the newest messages of a
+# partitioned table. Most pages fill from the first one, which only touches
+# the current month's partition or two.
+RECENT_WINDOWS = (7, 31, 366)
+
+COLUMNS = "id, text, timestamp, user_id, like_count"
+
+# Advisory lock key serializing partition creation between workers and cron
+PARTITIONS_LOCK = 0x7061727473
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_y{month.year}m{month.month:02d}"
+
+
+def is_partitioned():
+    """Is `messages` a partitioned table? Checked once per process."""
+
+    cached = current_app.extensions.get('messages_partitioned')
+    if cached is None:
+        cached = current_app.config.get('MESSAGES_PARTITIONED')
+    if cached is None:
+        cached = False
+        if db.engine.dialect.name == 'postgresql':
+            cached = db.session.execute(
+                text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('messages')")
+            ).scalar() or False
+
+    current_app.extensions['messages_partitioned'] = cached
+    return cached
+
+
+def recent_cutoffs():
+    """Lower bounds on `timestamp` to try in turn for a newest-first page.
+
+    On a partitioned table these are the RECENT_WINDOWS, so the planner
+    prunes to the most recent partitions; the last is always None (no bound).
+    """
+
+    if is_partitioned():
+        now = datetime.utcnow()
+        for days in RECENT_WINDOWS:
+            yield now - timedelta(days=days)
+    yield None
+
+
+def recent_messages(query, limit):
+    """The newest `limit` messages matching `query`, newest first.
+
+    Only widens the time window (see `recent_cutoffs`) when there aren't
+    enough recent rows to fill the page.
+    """
+
+    # By id too, so messages sharing a timestamp keep a stable order for cursors
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+    for since in recent_cutoffs():
+        if since is None:
+            return query.limit(limit).all()
+        messages = query.filter(Message.timestamp >= since).limit(limit).all()
+        if len(messages) == limit:
+            return messages
+
+
+def create_partitioned_table(conn, name):
+    conn.execute(text(f"""
+        CREATE TABLE {name} (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+            text varchar(140) NOT NULL,
+            timestamp timestamp NOT NULL,
+            user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            like_count integer NOT NULL DEFAULT 0,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """))
+    conn.execute(text(f"CREATE INDEX {name}_user_id_timestamp_idx ON {name} (user_id, timestamp DESC)"))
+    conn.execute(text(f"CREATE INDEX {name}_timestamp_idx ON {name} (timestamp DESC)"))
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS messages_default PARTITION OF {name} DEFAULT"))
+
+
+def create_partitions(conn, parent, first_month, last_month):
+    """Create monthly partitions of `parent` from first_month to last_month, inclusive.
+
+    PostgreSQL won't add a partition while the default partition holds rows
+    for its range, so those are first moved into a standalone table, which
+    is then attached, all in the caller's transaction. The default partition
+    is locked meanwhile, which is brief as long as it stays small.
+    """
+
+    default = conn.execute(text(
+        "SELECT partdefid::regclass::text FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass(:parent) AND partdefid <> 0"), {'parent': parent}).scalar()
+
+    month = month_start(first_month)
+    created = []
+
+    while month <= last_month:
+        name = partition_name(month)
+        exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': name}).scalar()
+        if not exists:
+            bounds = {'start': month, 'end': add_months(month, 1)}
+            stranded = default is not None and conn.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM {default} WHERE timestamp >= :start AND timestamp < :end)"),
+                bounds).scalar()
+
+            values = f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+
+            if stranded:
+                # Attaching locks the default partition anyway; taking it first
+                # also stops new rows for the month arriving after the move.
+                conn.execute(text(f"LOCK TABLE {default} IN ACCESS EXCLUSIVE MODE"))
+                conn.execute(text(f"CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS)"))
+                conn.execute(text(
+                    f"WITH moved AS (DELETE FROM {default} WHERE timestamp >= :start AND timestamp < :end "
+                    f"RETURNING {COLUMNS}) "
+                    f"INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved"), bounds)
+                conn.execute(text(f"ALTER TABLE {parent} ATTACH PARTITION {name} {values}"))
+            else:
+                conn.execute(text(f"CREATE TABLE {name} PARTITION OF {parent} {values}"))
+
+            created.append(name)
+        month = add_months(month, 1)
+
+    return created
+
+
+def ensure_future_partitions(months_ahead=3):
+    """Make sure partitions exist for this month and the next `months_ahead`."""
+
+    this_month = month_start(datetime.utcnow())
+    with db.engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': PARTITIONS_LOCK})
+        return create_partitions(conn, 'messages', this_month, add_months(this_month, months_ahead))
+
+
+def prepare_partitions(months_ahead=3):
+    """Create the coming months' partitions at worker start, logging any failure."""
+
+    try:
+        if is_partitioned():
+            ensure_future_partitions(months_ahead)
+    except Exception:
+        current_app.logger.exception("Couldn't create upcoming message partitions")
+
+
+MIRROR_TRIGGER = f"""
+CREATE OR REPLACE FUNCTION messages_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM messages_partitioned WHERE id = OLD.id;
+        RETURN OLD;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM messages_partitioned WHERE id = OLD.id;
+    END IF;
+    INSERT INTO messages_partitioned ({COLUMNS})
+        VALUES (NEW.id, NEW.text, NEW.timestamp, NEW.user_id, NEW.like_count)
+        ON CONFLICT (id, timestamp) DO UPDATE
+        SET text = EXCLUDED.text, user_id = EXCLUDED.user_id, like_count = EXCLUDED.like_count;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_mirror ON messages;
+CREATE TRIGGER messages_mirror AFTER INSERT OR UPDATE OR DELETE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_mirror();
+"""
+
+
+def migrate_to_partitioned(batch_size=10000, months_ahead=3, echo=print):
+    """Convert an unpartitioned `messages` table in place, without a long lock."""
+
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        raise RuntimeError("Partitioning needs PostgreSQL")
+
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")).scalar() == 'p':
+            raise RuntimeError("messages is already partitioned")
+
+        first = conn.execute(text("SELECT min(timestamp) FROM messages")).scalar() or datetime.utcnow()
+        max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM messages")).scalar()
+
+        if conn.execute(text("SELECT to_regclass('messages_partitioned') IS NULL")).scalar():
+            create_partitioned_table(conn, 'messages_partitioned')
+        this_month = month_start(datetime.utcnow())
+        create_partitions(conn, 'messages_partitioned', first, add_months(this_month, months_ahead))
+
+        conn.execute(text(MIRROR_TRIGGER))
+
+    echo(f"Copying messages up to id {max_id} in batches of {batch_size}")
+
+    # Rows newer than max_id only ever arrive through the trigger
+    last_id = 0
+    while last_id < max_id:
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"INSERT INTO messages_partitioned ({COLUMNS}) "
+                f"SELECT {COLUMNS} FROM messages WHERE id > :low AND id <= :high "
+                f"ON CONFLICT DO NOTHING"), {'low': last_id, 'high': last_id + batch_size})
+        last_id += batch_size
+        echo(f"  copied through id {min(last_id, max_id)}")
+
+    echo("Reconciling")
+    last_id = 0
+    while last_id < max_id:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "DELETE FROM messages_partitioned p WHERE p.id > :low AND p.id <= :high "
+                "AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.id = p.id)"),
+                {'low': last_id, 'high': last_id + batch_size})
+        last_id += batch_size
+
+    echo("Swapping tables")
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+
+        referencing = conn.execute(text(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = 'messages'::regclass")).all()
+        for table, constraint in referencing:
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+
+        conn.execute(text("DROP TRIGGER messages_mirror ON messages"))
+        conn.execute(text("DROP FUNCTION messages_mirror()"))
+        conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+        conn.execute(text("ALTER TABLE messages_partitioned RENAME TO messages"))
+        conn.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+
+    current_app.extensions['messages_partitioned'] = True
+    echo("Done. The old table is now messages_unpartitioned; drop it once you're happy.")
+
+
+@partitions_cli.command('migrate')
+@click.option('--batch-size', default=10000, help="Rows copied per transaction.")
+@click.option('--months-ahead', default=3, help="Future months to create partitions for.")
+def migrate_command(batch_size, months_ahead):
+    """Convert the messages table to monthly partitions, online."""
+
+    try:
+        migrate_to_partitioned(batch_size, months_ahead, echo=click.echo)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+@partitions_cli.command('maintain')
+@click.option('--months-ahead', default=3, help="Future months to create partitions for.")
+def maintain_command(months_ahead):
+    """Create partitions for the coming months (run daily)."""
+
+    if not is_partitioned():
+        raise click.ClickException("messages is not partitioned; run `flask partitions migrate` first")
+
+    for name in ensure_future_partitions(months_ahead):
+        click.echo(f"Created {name}")
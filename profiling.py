@@ -0,0 +1,178 @@
+"""Profiling requests on demand.
+
+A request is profiled when it carries a valid X-Warbler-Profile header
+(a signed token from `flask profile token`, good for a few minutes), or at
+random for a PROFILE_SAMPLE_RATE fraction of requests (0, the default,
+means never).
+
+By default a sampling profiler is used: a thread looks at the request's
+stack every PROFILE_INTERVAL_MS, which costs the request next to nothing,
+and the samples are written to PROFILE_FOLDER as collapsed stacks
+(`.folded`), which flamegraph.pl, speedscope and most flame graph tools
+read. With PROFILE_MODE=cprofile, cProfile is used instead and a `.pstats`
+file written; it is exact but slows the request down a lot.
+
+Under gevent workers the sampling thread would be a greenlet, unable to
+interrupt a busy request, so cProfile is used there; its profiles include
+whatever other greenlets ran in the meantime.
+
+The response says which file in an X-Warbler-Profile header. Only the
+newest PROFILE_KEEP profiles are kept.
+"""
+
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, TimestampSigner
+
+from cooperative import is_cooperative
+
+profile_cli = AppGroup('profile', help="Profile requests.")
+
+HEADER = 'X-Warbler-Profile'
+
+
+class StackSampler:
+    """Counts the stacks a thread is seen in, sampled every `interval` seconds."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='warbler-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+@lru_cache(maxsize=None)
+def _label(code):
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _short_path(path):
+    """`path` relative to the sys.path entry it's under."""
+
+    best = path
+    for entry in sys.path:
+        if entry and path.startswith(entry + os.sep) and len(path) - len(entry) - 1 < len(best):
+            best = path[len(entry) + 1:]
+    return best
+
+
+def write_collapsed(stacks, path):
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def signer(app):
+    return TimestampSigner(app.config['SECRET_KEY'], salt='warbler-profile')
+
+
+def make_token(app):
+    return signer(app).sign('profile').decode()
+
+
+def valid_token(app, token):
+    try:
+        signer(app).unsign(token, max_age=app.config['PROFILE_TOKEN_SECONDS'])
+    except BadSignature:
+        return False
+    return True
+
+
+def prune(folder, keep):
+    """Delete all but the newest `keep` profiles in `folder`."""
+
+    profiles = sorted((entry for entry in os.scandir(folder) if entry.name.endswith(('.folded', '.pstats'))),
+                      key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in profiles[keep:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def init_profiling(app):
+    """Profile the requests that ask for it, or a sampled fraction of all of them."""
+
+    @app.before_request
+    def start_profile():
+        token = request.headers.get(HEADER)
+        if not (token and valid_token(app, token)) and not random.random() < app.config['PROFILE_SAMPLE_RATE']:
+            return
+
+        mode = 'cprofile' if is_cooperative() else app.config['PROFILE_MODE']
+        stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+        g.profile_name = f"{stamp}-{request.endpoint or 'none'}.{'pstats' if mode == 'cprofile' else 'folded'}"
+        g.profile_started = time.perf_counter()
+
+        if mode == 'cprofile':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            g.profiler = StackSampler(threading.get_ident(), app.config['PROFILE_INTERVAL_MS'] / 1000)
+            g.profiler.start()
+
+    @app.after_request
+    def name_profile(response):
+        if 'profile_name' in g:
+            response.headers[HEADER] = g.profile_name
+        return response
+
+    @app.teardown_request
+    def finish_profile(error):
+        # After a streamed response has been sent, so that's included
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+
+        folder = app.config['PROFILE_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, g.pop('profile_name'))
+
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(path)
+        else:
+            write_collapsed(profiler.stop(), path)
+
+        app.logger.info("Profiled %s in %.0f ms: %s", request.path,
+                        (time.perf_counter() - g.pop('profile_started')) * 1000, path)
+        prune(folder, app.config['PROFILE_KEEP'])
+
+
+@profile_cli.command('token')
+def token_command():
+    """Print a token that has a request profiled when sent as X-Warbler-Profile."""
+
+    minutes = current_app.config['PROFILE_TOKEN_SECONDS'] / 60
+    click.echo(make_token(current_app))
+    click.echo(f"Valid for {minutes:g} minutes, e.g. curl -H '{HEADER}: <token>' ...", err=True)
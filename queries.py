@@ -0,0 +1,76 @@
+"""The queries nearly every request makes, as cached lambda statements.
+
+A statement built with `lambda_stmt` is constructed and compiled once per
+process; later calls only pull the new parameter values out of the lambda's
+closure. Building the equivalent Query or select() afresh costs more Python
+time than the query itself takes on a warm database.
+
+psycopg2 has no server-side prepared statements, so with the default driver
+the compiled cache is as far as this goes. With psycopg 3
+(`postgresql+psycopg://` URLs) the driver prepares a statement on the server
+once it has run DB_PREPARE_THRESHOLD times; see `engine_options`.
+
+`python bench_queries.py` compares these against the ad-hoc queries.
+"""
+
+from sqlalchemy import lambda_stmt, select, tuple_
+from sqlalchemy.engine import make_url
+
+from models import db, User, Message, Follows
+from partitions import recent_cutoffs
+
+
+def engine_options(uri, prepare_threshold):
+    """SQLALCHEMY_ENGINE_OPTIONS for `uri`: server-side prepares where the driver can."""
+
+    if make_url(uri).drivername == 'postgresql+psycopg':
+        return {'connect_args': {'prepare_threshold': prepare_threshold}}
+    return {}
+
+
+def user_by_id(user_id):
+    return db.session.execute(
+        lambda_stmt(lambda: select(User).where(User.id == user_id))
+    ).scalar_one_or_none()
+
+
+def following_ids(user_id):
+    """Ids of the users `user_id` follows."""
+
+    return db.session.execute(
+        lambda_stmt(lambda: select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id))
+    ).scalars().all()
+
+
+def _newest(stmt, limit, since, position):
+    if since is not None:
+        stmt += lambda s: s.where(Message.timestamp >= since)
+    if position is not None:
+        timestamp, message_id = position
+        stmt += lambda s: s.where(tuple_(Message.timestamp, Message.id) < tuple_(timestamp, message_id))
+    # By id too, so messages sharing a timestamp keep a stable order for the cursor
+    stmt += lambda s: s.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit)
+    messages = db.session.execute(stmt).scalars().all()
+    # With shards (see sharding.py) each one's newest come back in turn
+    return sorted(messages, key=lambda message: (message.timestamp, message.id), reverse=True)[:limit]
+
+
+def feed_messages(user_ids, limit):
+    """The newest `limit` messages by any of `user_ids`, like `recent_messages`."""
+
+    for since in recent_cutoffs():
+        messages = _newest(lambda_stmt(lambda: select(Message).where(Message.user_id.in_(user_ids))),
+                           limit, since, None)
+        if since is None or len(messages) == limit:
+            return messages
+
+
+def user_messages(user_id, limit, position=None):
+    """The newest `limit` hot messages by `user_id`, before the (timestamp, id) `position`."""
+
+    for since in recent_cutoffs():
+        messages = _newest(lambda_stmt(lambda: select(Message).where(Message.user_id == user_id)),
+                           limit, since, position)
+        if since is None or len(messages) == limit:
+            return messages
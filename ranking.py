@@ -0,0 +1,149 @@
+"""The ranked ("top") home timeline.
+
+Instead of the newest 100 messages, take the newest RANKED_CANDIDATES from
+the people you follow and score them all at once with numpy:
+
+    score = recency * (1 + log(1 + likes)) * (1 + AFFINITY_WEIGHT * log(1 + affinity))
+
+where recency halves every RECENCY_HALF_LIFE_HOURS and affinity is how many
+of the author's messages are among your newest RANKED_AFFINITY_LIKES likes.
+Candidates are read as bare columns and only the 100 winners are loaded as
+objects, and affinities are cached per worker for RANKED_AFFINITY_TTL
+seconds, so a ranked page costs about the same as the chronological one. If a request runs past RANKED_BUDGET_MS it
+skips whatever is left (affinity, then scoring) rather than get slower.
+
+numpy is imported on first use, to keep it out of app startup.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from metrics import record_cache
+from models import db, Message, Likes
+from partitions import is_partitioned, recent_messages
+
+RECENCY_HALF_LIFE_HOURS = 6
+AFFINITY_WEIGHT = 0.5
+
+
+class AffinityCache:
+    """Per-worker cache of {author_id: likes} for recently active users."""
+
+    def __init__(self, ttl=300, max_users=10000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                record_cache('affinities', misses=1)
+                return None
+            self._entries.move_to_end(user_id)
+            record_cache('affinities', hits=1)
+            return entry[1]
+
+    def put(self, user_id, affinities):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, affinities)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+
+def load_affinities(user_id, limit=1000):
+    """How many messages by each author `user_id` has liked, as {author_id: count}.
+
+    Only the user's newest `limit` likes are counted, so the cost of a cache
+    miss doesn't grow with how many likes they've ever made.
+    """
+
+    newest = (db.select(Likes.message_id)
+              .where(Likes.user_id == user_id)
+              .order_by(Likes.id.desc())
+              .limit(limit))
+
+    if not db.session().data_shards:
+        return dict(db.session.query(Message.user_id, db.func.count())
+                    .filter(Message.id.in_(newest.scalar_subquery()))
+                    .group_by(Message.user_id))
+
+    # Likes and messages are on different shards, so no join: the liked ids
+    # first, then their authors counted shard by shard (see sharding.py)
+    liked = db.session.scalars(newest).all()
+    affinities = {}
+    if liked:
+        for author_id, count in (db.session.query(Message.user_id, db.func.count())
+                                 .filter(Message.id.in_(liked))
+                                 .group_by(Message.user_id)):
+            affinities[author_id] = affinities.get(author_id, 0) + count
+    return affinities
+
+
+def score(ages, likes, affinities):
+    """Scores for arrays of age in hours, like count and author affinity."""
+
+    import numpy as np
+
+    recency = np.exp2(-ages / RECENCY_HALF_LIFE_HOURS)
+    return recency * (1 + np.log1p(likes)) * (1 + AFFINITY_WEIGHT * np.log1p(affinities))
+
+
+def top_ids(candidates, affinities, limit, now=None):
+    """Ids of the `limit` best (id, user_id, timestamp, like_count) candidates, best first."""
+
+    import numpy as np
+
+    now = now or datetime.utcnow()
+
+    ids = np.fromiter((c.id for c in candidates), dtype=np.int64, count=len(candidates))
+    ages = np.fromiter(((now - c.timestamp).total_seconds() / 3600 for c in candidates),
+                       dtype=np.float64, count=len(candidates))
+    likes = np.fromiter((max(c.like_count, 0) for c in candidates), dtype=np.float64, count=len(candidates))
+    affinity = np.fromiter((affinities.get(c.user_id, 0) for c in candidates),
+                           dtype=np.float64, count=len(candidates))
+
+    scores = score(np.maximum(ages, 0), likes, affinity)
+
+    if len(scores) > limit:
+        best = np.argpartition(scores, -limit)[-limit:]
+    else:
+        best = np.arange(len(scores))
+    best = best[np.lexsort((-ids[best], -scores[best]))]
+
+    return ids[best].tolist()
+
+
+def ranked_messages(user_ids, viewer_id, cache, limit=100, candidates=500, budget_ms=50, affinity_likes=1000):
+    """The `limit` top-scoring recent messages by `user_ids`, for `viewer_id`."""
+
+    deadline = time.monotonic() + budget_ms / 1000
+
+    rows = recent_messages(
+        db.session.query(Message.id, Message.user_id, Message.timestamp, Message.like_count)
+        .filter(Message.user_id.in_(user_ids)),
+        candidates)
+
+    affinities = cache.get(viewer_id)
+    if affinities is None and time.monotonic() < deadline:
+        affinities = load_affinities(viewer_id, affinity_likes)
+        cache.put(viewer_id, affinities)
+
+    if time.monotonic() < deadline:
+        ids = top_ids(rows, affinities or {}, limit)
+    else:
+        # Out of time: fall back to newest first
+        ids = [row.id for row in rows[:limit]]
+
+    # Authors in a second query: they may be in another database (see sharding.py)
+    winners = Message.query.filter(Message.id.in_(ids)).options(db.selectinload(Message.user))
+    if is_partitioned() and rows:
+        # Lets the planner skip partitions older than the candidates
+        winners = winners.filter(Message.timestamp >= min(row.timestamp for row in rows))
+
+    found = {m.id: m for m in winners}
+    return [found[message_id] for message_id in ids if message_id in found]
@@ -0,0 +1,211 @@
+"""Follow suggestions ("who to follow").
+
+`flask recommendations build` loads the whole follows table into a sparse
+adjacency matrix A (A[i, j] = 1 when user i follows user j) and scores
+candidates for every user with two signals:
+
+- friends of friends: A @ A counts how many of the people you follow also
+  follow someone;
+- co-follow similarity: users whose follows overlap with yours (cosine
+  similarity, with popular accounts down-weighted so following the same
+  celebrity doesn't make two people alike), and who they follow.
+
+Users are processed a chunk of rows at a time, so memory is bounded by the
+chunk rather than by the number of users squared. Within a chunk, accounts
+with more than `max_followers` followers are left out of the similarity
+(everyone who follows them would otherwise be alike), and each user keeps
+only their `neighbors` most similar users before their follows are counted,
+so a row never grows towards the full width of the matrix. The top suggestions for
+each user are stored in `follow_suggestions`, and pages read them with a
+primary key lookup. numpy and scipy are only needed to run the job, not to
+serve suggestions.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import insert, select
+
+from models import db, User, Follows, FollowSuggestion
+from queries import following_ids
+
+recommendations_cli = AppGroup('recommendations', help="Build follow suggestions.")
+
+# Relative weight of the two signals in the final score
+FOF_WEIGHT = 1.0
+COFOLLOW_WEIGHT = 2.0
+
+
+def suggestions_for(user_id, limit=5, already_following=None):
+    """Stored suggestions for `user_id`, best first, skipping users they now follow.
+
+    Pass `already_following` if the caller has the user's following ids.
+    """
+
+    # Looked up first rather than joined: follows may be on a shard
+    if already_following is None:
+        already_following = following_ids(user_id)
+
+    return (FollowSuggestion.query
+            .filter(FollowSuggestion.user_id == user_id,
+                    FollowSuggestion.suggested_user_id.not_in(already_following))
+            .order_by(FollowSuggestion.rank)
+            .options(db.joinedload(FollowSuggestion.suggested_user))
+            .limit(limit)
+            .all())
+
+
+def load_follow_matrix(batch_size=100000):
+    """The follows table as a CSR matrix indexed by user id."""
+
+    import numpy as np
+    from scipy import sparse
+
+    size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    followers, followed = [], []
+    result = db.session.execute(
+        select(Follows.user_following_id, Follows.user_being_followed_id)
+        .execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        pairs = np.array(rows, dtype=np.int32)
+        followers.append(pairs[:, 0])
+        followed.append(pairs[:, 1])
+
+    rows = np.concatenate(followers) if followers else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(followed) if followed else np.empty(0, dtype=np.int32)
+    data = np.ones(len(rows), dtype=np.float32)
+
+    return sparse.csr_matrix((data, (rows, cols)), shape=(size, size))
+
+
+def top_per_row(matrix, k):
+    """`matrix` (CSR) keeping only the `k` largest entries of each row."""
+
+    import numpy as np
+    from scipy import sparse
+
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # Each row's entries largest first; an entry's rank is its position
+    # counted from the start of its row
+    order = np.lexsort((-matrix.data, rows))
+    keep = order[np.arange(matrix.nnz) - matrix.indptr[rows[order]] < k]
+
+    return sparse.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+
+def normalize(follows, max_followers):
+    """The follow matrix weighted for similarity, with rows normalized.
+
+    Each followed account is weighted by 1/log(2 + followers), and those with
+    more than `max_followers` are dropped, so the dot product of two rows is a
+    popularity-adjusted cosine similarity.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    follower_counts = np.asarray(follows.sum(axis=0)).ravel()
+    weights = 1 / np.log(2 + follower_counts)
+    weights[follower_counts > max_followers] = 0
+    weighted = follows @ sparse.diags(weights)
+    weighted.eliminate_zeros()
+
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags(1 / norms) @ weighted).tocsr()
+
+
+def score_chunk(follows, normalized, start, stop, neighbors=50):
+    """Candidate scores for users start..stop-1, as a sparse matrix.
+
+    `normalized` is the popularity-weighted, row-normalized follow matrix
+    used for similarity. Only the `neighbors` most similar users count
+    towards co-follow scores. People the user already follows, and the user
+    themselves, score zero.
+    """
+
+    from scipy import sparse
+
+    rows = follows[start:stop]
+    # Row i of the chunk is user start + i
+    themselves = sparse.eye(stop - start, follows.shape[1], k=start, format='csr')
+
+    friends_of_friends = rows @ follows
+
+    similarity = normalized[start:stop] @ normalized.T
+    similarity = (similarity - similarity.multiply(themselves)).tocsr()
+    similarity.eliminate_zeros()
+    cofollowed = top_per_row(similarity, neighbors) @ follows
+
+    scores = (FOF_WEIGHT * friends_of_friends + COFOLLOW_WEIGHT * cofollowed).tocsr()
+    scores = scores - scores.multiply((rows + themselves).astype(bool))
+    scores.eliminate_zeros()
+
+    return scores.tocsr()
+
+
+def best_suggestions(scores, start, k):
+    """Yield (user_id, [(suggested_id, score), ...]) for each row of a chunk."""
+
+    import numpy as np
+
+    for offset in range(scores.shape[0]):
+        begin, end = scores.indptr[offset], scores.indptr[offset + 1]
+        if begin == end:
+            continue
+
+        values = scores.data[begin:end]
+        columns = scores.indices[begin:end]
+
+        if len(values) > k:
+            best = np.argpartition(values, -k)[-k:]
+            values, columns = values[best], columns[best]
+
+        order = np.lexsort((columns, -values))
+        yield start + offset, [(int(columns[i]), float(values[i])) for i in order]
+
+
+def build_suggestions(k=20, chunk_size=2000, neighbors=50, max_followers=10000, echo=print):
+    """Recompute every user's top `k` suggestions. Returns how many users got some."""
+
+    import numpy as np
+    from scipy import sparse
+
+    follows = load_follow_matrix()
+    size = follows.shape[0]
+    echo(f"Loaded {follows.nnz} follows between {size - 1} user ids")
+
+    normalized = normalize(follows, max_followers)
+
+    users = 0
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        scores = score_chunk(follows, normalized, start, stop, neighbors)
+
+        rows = []
+        for user_id, suggestions in best_suggestions(scores, start, k):
+            users += 1
+            rows.extend({'user_id': user_id, 'rank': rank, 'suggested_user_id': suggested, 'score': score}
+                        for rank, (suggested, score) in enumerate(suggestions))
+
+        FollowSuggestion.query.filter(FollowSuggestion.user_id >= start,
+                                      FollowSuggestion.user_id < stop).delete()
+        if rows:
+            db.session.execute(insert(FollowSuggestion), rows)
+        db.session.commit()
+
+        echo(f"  users {start}-{stop - 1}: {len(rows)} suggestions")
+
+    return users
+
+
+@recommendations_cli.command('build')
+@click.option('--top-k', default=20, help="Suggestions stored per user.")
+@click.option('--chunk-size', default=2000, help="Users scored at once; bounds memory use.")
+@click.option('--neighbors', default=50, help="Most similar users counted for co-follow scores.")
+@click.option('--max-followers', default=10000, help="Accounts with more followers don't make users similar.")
+def build_command(top_k, chunk_size, neighbors, max_followers):
+    """Recompute "who to follow" suggestions for every user."""
+
+    users = build_suggestions(top_k, chunk_size, neighbors, max_followers, echo=click.echo)
+    click.echo(f"Stored suggestions for {users} users.")
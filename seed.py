@@ -18,4 +18,10 @@ with app.app_context():
     with open('generator/follows.csv') as follows:
         db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+    # Bulk inserts skip the views that keep follower counts up to date
+    follower_count = (db.select(db.func.count())
+                      .where(Follows.user_being_followed_id == User.id)
+                      .scalar_subquery())
+    db.session.execute(db.update(User).values(follower_count=follower_count))
+
     db.session.commit()
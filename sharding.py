@@ -0,0 +1,260 @@
+"""Sharding users' messages, likes and follows across several databases.
+
+Set SHARD_DATABASE_URLS to a comma-separated list of database URLs and the
+`messages`, `likes` and `follows` tables move off the primary onto those
+shards, split by user (models.SHARD_KEYS):
+
+- a message lives on its author's shard,
+- a like on the shard of the user who liked it,
+- a follow on the shard of the follower.
+
+Everything else, including `users`, stays on the primary. `users.shard` is
+the shard map: a user without one is on shard `id % number of shards`.
+`db.session` (models.RoutingSession) does the routing: writes go to the
+row's shard, reads to the shards their `user_id` criteria name, or to every
+shard (scatter-gather) when they don't name any. Message ids come from one
+sequence on the primary, so they stay unique across shards.
+
+A statement can only touch one database, so code reading both sharded and
+primary tables does it in two steps (see e.g. User.liked_messages) rather
+than with a join. Writes that span databases, like a follow and the
+followed user's follower_count, commit one database after the other.
+
+The batch jobs (archive, partitions, recommendations, like counter
+compaction, hashtag reindexing) still expect one database and shouldn't be
+run against a sharded deployment. Exports join across databases themselves
+(see export.py).
+
+Commands:
+
+- `flask shards create` creates the sharded tables on every shard;
+- `flask shards pin` records every user's current shard, which must be done
+  before changing the number of shards;
+- `flask shards move USER_ID SHARD` moves a user's rows to another shard;
+- `flask shards status` counts rows per shard.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import MetaData, delete, func, insert, select, tuple_, update
+
+from models import db, User, SHARD_KEYS
+
+shards_cli = AppGroup('shards', help="Manage the message, like and follow shards.")
+
+# What identifies a row when copying between shards. Likes get new ids on
+# the target shard; nothing refers to them.
+ROW_KEYS = {
+    'messages': ('id',),
+    'likes': ('user_id', 'message_id'),
+    'follows': ('user_being_followed_id', 'user_following_id'),
+}
+
+
+def shard_binds(urls):
+    """SQLALCHEMY_BINDS for a list of shard database URLs."""
+
+    return {f'shard{number}': url for number, url in enumerate(urls)}
+
+
+def shard_engines():
+    """{shard number: engine} for the configured shards."""
+
+    return {int(key[len('shard'):]): engine
+            for key, engine in db.engines.items() if key and key.startswith('shard')}
+
+
+def shard_metadata():
+    """The sharded tables, without their foreign keys.
+
+    The tables they refer to (users, and messages for likes) may be in
+    another database.
+    """
+
+    metadata = MetaData()
+    for name in SHARD_KEYS:
+        table = db.metadata.tables[name].to_metadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            table.constraints.discard(constraint)
+        for column in table.c:
+            column.foreign_keys.clear()
+        table.foreign_keys.clear()
+    return metadata
+
+
+def create_shard_tables():
+    metadata = shard_metadata()
+    for engine in shard_engines().values():
+        metadata.create_all(engine)
+
+
+def pin_users():
+    """Record the shard of every user placed by default. Returns how many."""
+
+    count = len(shard_engines())
+    result = db.session.execute(
+        update(User).where(User.shard.is_(None)).values(shard=User.id % count)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+
+def copy_rows(source, target, user_id, skip=None, batch_size=1000):
+    """Copy `user_id`'s rows from one shard connection to another.
+
+    Rows whose key (ROW_KEYS) is in `skip` are left out. Returns
+    {table name: set of copied keys}.
+    """
+
+    copied = {}
+    for name, key_column in SHARD_KEYS.items():
+        table = db.metadata.tables[name]
+        keys = ROW_KEYS[name]
+        columns = [column for column in table.c if not (name == 'likes' and column.name == 'id')]
+        already = (skip or {}).get(name, set())
+
+        rows = source.execution_options(yield_per=batch_size).execute(
+            select(*columns).where(table.c[key_column] == user_id))
+
+        copied[name] = set()
+        for batch in rows.partitions():
+            batch = [row._asdict() for row in batch]
+            batch = [row for row in batch if tuple(row[k] for k in keys) not in already]
+            if batch:
+                target.execute(insert(table), batch)
+                copied[name].update(tuple(row[k] for k in keys) for row in batch)
+
+    return copied
+
+
+def row_keys(conn, user_id):
+    """{table name: set of keys (ROW_KEYS)} of `user_id`'s rows on a shard connection."""
+
+    keys = {}
+    for name, key_column in SHARD_KEYS.items():
+        table = db.metadata.tables[name]
+        rows = conn.execute(select(*(table.c[k] for k in ROW_KEYS[name])).where(table.c[key_column] == user_id))
+        keys[name] = {tuple(row) for row in rows}
+    return keys
+
+
+def delete_rows(conn, name, keys):
+    """Delete the rows of table `name` with the given keys (ROW_KEYS)."""
+
+    table = db.metadata.tables[name]
+    columns = [table.c[k] for k in ROW_KEYS[name]]
+    keys = list(keys)
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        if len(columns) == 1:
+            conn.execute(delete(table).where(columns[0].in_([key[0] for key in batch])))
+        else:
+            conn.execute(delete(table).where(tuple_(*columns).in_(batch)))
+
+
+def move_user(user_id, shard, batch_size=1000):
+    """Move a user's messages, likes and follows to `shard`. Returns rows moved.
+
+    The rows are copied, the shard map switched, anything the user wrote to
+    the old shard in the meantime copied too, anything deleted from it in
+    the meantime deleted from the new one, and the old rows deleted.
+    Requests that looked up the user's shard just before the switch may
+    still write to the old one after that, so this is meant for quiet
+    users, or a maintenance window.
+    """
+
+    engines = shard_engines()
+    if shard not in engines:
+        raise ValueError(f"There is no shard {shard}.")
+
+    current = db.session().shards_for_users([user_id])[user_id]
+    source_number = int(current[len('shard'):])
+    if source_number == shard:
+        return 0
+
+    source, target = engines[source_number], engines[shard]
+
+    with source.connect() as src, target.begin() as dst:
+        # Leftovers of an earlier, interrupted move
+        for name, key_column in SHARD_KEYS.items():
+            table = db.metadata.tables[name]
+            dst.execute(delete(table).where(table.c[key_column] == user_id))
+        copied = copy_rows(src, dst, user_id, batch_size=batch_size)
+
+    db.session.execute(update(User).where(User.id == user_id).values(shard=shard)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    db.session().forget_placements()
+
+    with source.begin() as src, target.begin() as dst:
+        late = copy_rows(src, dst, user_id, skip=copied, batch_size=batch_size)
+
+        # Rows deleted from the old shard since they were copied mustn't come back
+        remaining = row_keys(src, user_id)
+        for name in SHARD_KEYS:
+            gone = copied[name] - remaining[name]
+            delete_rows(dst, name, gone)
+            copied[name] -= gone
+
+        for name, key_column in SHARD_KEYS.items():
+            table = db.metadata.tables[name]
+            src.execute(delete(table).where(table.c[key_column] == user_id))
+
+    return sum(len(keys) for keys in copied.values()) + sum(len(keys) for keys in late.values())
+
+
+def shard_row_counts():
+    """{shard number: {table name: rows}}."""
+
+    counts = {}
+    for number, engine in sorted(shard_engines().items()):
+        with engine.connect() as conn:
+            counts[number] = {name: conn.scalar(select(func.count()).select_from(db.metadata.tables[name]))
+                              for name in SHARD_KEYS}
+    return counts
+
+
+def require_shards():
+    if not shard_engines():
+        raise click.ClickException("No shards configured: set SHARD_DATABASE_URLS.")
+
+
+@shards_cli.command('create')
+def create_command():
+    """Create the sharded tables on every shard."""
+
+    require_shards()
+    create_shard_tables()
+    click.echo(f"Created {', '.join(SHARD_KEYS)} on {len(shard_engines())} shards.")
+
+
+@shards_cli.command('pin')
+def pin_command():
+    """Record every user's current shard (do this before adding shards)."""
+
+    require_shards()
+    click.echo(f"Pinned {pin_users()} users.")
+
+
+@shards_cli.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+@click.option('--batch-size', default=1000, help="Rows copied per statement.")
+def move_command(user_id, shard, batch_size):
+    """Move a user's messages, likes and follows to another shard."""
+
+    require_shards()
+    try:
+        moved = move_user(user_id, shard, batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Moved {moved} rows of user {user_id} to shard {shard}.")
+
+
+@shards_cli.command('status')
+def status_command():
+    """Count the rows on each shard."""
+
+    require_shards()
+    for number, counts in shard_row_counts().items():
+        click.echo(f"shard{number}: " + ', '.join(f"{name} {count}" for name, count in counts.items()))
@@ -0,0 +1,295 @@
+"""Slow-query log.
+
+Off unless SLOW_QUERY_MS is set. Then every statement taking longer than
+that is written to SLOW_QUERY_LOG, one JSON object per line, with its
+duration, bind parameters (passwords redacted, long values cut short), the
+view or thread that ran it, and a fingerprint: the statement with its
+literals, parameters and IN lists replaced, so the same query with
+different values counts as one.
+
+On PostgreSQL a background thread follows each one up with its plan, read
+on a separate connection with a plain EXPLAIN, which doesn't run the
+statement. With SLOW_QUERY_EXPLAIN_ANALYZE set, plain SELECTs get
+`EXPLAIN (ANALYZE, BUFFERS)` instead, run in a read-only transaction that
+is rolled back; anything that could have side effects even as a SELECT
+(data-modifying CTEs, advisory locks, sequences, row locks) isn't run
+again. At most one plan per fingerprint is captured per
+SLOW_QUERY_EXPLAIN_SECONDS, and if the thread falls behind plans are
+skipped rather than queued without limit.
+
+The log is rotated at SLOW_QUERY_LOG_BYTES, keeping SLOW_QUERY_LOG_BACKUPS
+old files. Each process rotates it by itself, so with several workers a
+rotation can scatter a few lines into the wrong file; nothing is lost.
+
+`flask slowlog top` sums it up by fingerprint.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import current_app, has_request_context, request
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+slowlog_cli = AppGroup('slowlog', help="Read the slow-query log.")
+
+MAX_VALUE_LENGTH = 200
+
+# Statements EXPLAIN accepts
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+# Calls and clauses that make a SELECT do more than read
+SIDE_EFFECTS = re.compile(r'\b(?:nextval|setval|pg_advisory\w*|pg_try_advisory\w*|pg_notify|lo_\w+'
+                          r'|dblink\w*)\s*\(|\bfor\s+(?:no\s+key\s+)?(?:update|share|key\s+share)\b'
+                          r'|\binto\b', re.IGNORECASE)
+
+FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+|\$\d+|\?'), '?'),
+    (re.compile(r'__\[POSTCOMPILE_\w+\]'), '(?)'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\[\s*\?(?:\s*,\s*\?)*\s*\]'), '[?]'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(statement):
+    """`statement` with its values replaced, for grouping."""
+
+    for pattern, replacement in FINGERPRINT_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    return hashlib.blake2b(normalize(statement).encode(), digest_size=6).hexdigest()
+
+
+def loggable(parameters):
+    """Bind parameters as they're written to the log."""
+
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(parameters[0], (dict, list, tuple)):
+        # executemany: the first row, and how many there were
+        return {'first': loggable(parameters[0]), 'rows': len(parameters)}
+    if isinstance(parameters, dict):
+        return {key: '[redacted]' if 'password' in key else _short(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_short(value) for value in parameters]
+    return parameters
+
+
+def _short(value):
+    if isinstance(value, (str, bytes)) and len(value) > MAX_VALUE_LENGTH:
+        return value[:MAX_VALUE_LENGTH] + '...'
+    return value
+
+
+class SlowQueryLog:
+    """Times statements on the engines it's attached to, logging the slow ones."""
+
+    def __init__(self, path, threshold_ms, max_bytes=10 * 1024 * 1024, backups=5, explain_seconds=300,
+                 analyze=False):
+        self.threshold = threshold_ms / 1000
+        self.explain_seconds = explain_seconds
+        self.analyze = analyze
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.logger = logging.getLogger(f'warbler.slow_queries.{path}')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+        self._lock = threading.Lock()
+        self._explained = {}
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_slow_query_started', None)
+        if started is None or conn.get_execution_options().get('slow_query_log') is False:
+            return
+
+        duration = time.perf_counter() - started
+        if duration < self.threshold:
+            return
+
+        record = {
+            'kind': 'query',
+            'id': uuid.uuid4().hex,
+            'at': datetime.utcnow().isoformat(),
+            'ms': round(duration * 1000, 1),
+            'view': request.endpoint if has_request_context() else None,
+            'thread': threading.current_thread().name,
+            'database': conn.engine.url.database,
+            'fingerprint': fingerprint(statement),
+            'statement': statement,
+            'parameters': loggable(parameters),
+        }
+        self.write(record)
+
+        if (conn.dialect.name == 'postgresql' and statement.lstrip().lower().startswith(EXPLAINABLE)
+                and self._explain_due(record['fingerprint'])):
+            first = parameters[0] if executemany and parameters else parameters
+            self._enqueue((conn.engine, record['id'], statement, first))
+
+    def write(self, record):
+        self.logger.info(json.dumps(record, default=repr))
+
+    def _explain_due(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(key, -self.explain_seconds) < self.explain_seconds:
+                return False
+            self._explained[key] = now
+            return True
+
+    def _enqueue(self, job):
+        with self._lock:
+            # Not inherited across a fork: a new worker starts its own
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=100)
+                self._thread = threading.Thread(target=self._run, name='warbler-explain', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        jobs = self._queue
+        while True:
+            engine, query_id, statement, parameters = jobs.get()
+            try:
+                plan = explain(engine, statement, parameters, self.analyze)
+                self.write({'kind': 'explain', 'id': query_id, 'plan': plan})
+            except Exception as e:
+                self.write({'kind': 'explain', 'id': query_id, 'error': str(e)})
+
+
+def read_only(statement):
+    """Is `statement` a SELECT that only reads?
+
+    Deliberately narrow: a WITH may hide a data-modifying CTE, and a SELECT
+    can still write through a function that isn't listed here, which is why
+    analyzed statements also run in a read-only transaction.
+    """
+
+    return statement.lstrip().lower().startswith('select') and not SIDE_EFFECTS.search(statement)
+
+
+def explain(engine, statement, parameters, analyze=False):
+    """The plan for `statement`.
+
+    With `analyze`, a read-only SELECT is run for real to get its actual
+    timings, in a read-only transaction that is rolled back.
+    """
+
+    analyze = analyze and read_only(statement)
+    options = '(ANALYZE, BUFFERS) ' if analyze else ''
+    with engine.connect() as conn:
+        conn = conn.execution_options(slow_query_log=False)
+        with conn.begin() as transaction:
+            if analyze:
+                conn.exec_driver_sql('SET TRANSACTION READ ONLY')
+            rows = conn.exec_driver_sql(f'EXPLAIN {options}{statement}', parameters or ())
+            plan = '\n'.join(row[0] for row in rows)
+            transaction.rollback()
+    return plan
+
+
+def init_slow_query_log(app, engines):
+    """Log `app`'s slow statements on `engines` if SLOW_QUERY_MS is set."""
+
+    if not app.config['SLOW_QUERY_MS']:
+        return
+
+    log = SlowQueryLog(app.config['SLOW_QUERY_LOG'], app.config['SLOW_QUERY_MS'],
+                       max_bytes=app.config['SLOW_QUERY_LOG_BYTES'],
+                       backups=app.config['SLOW_QUERY_LOG_BACKUPS'],
+                       explain_seconds=app.config['SLOW_QUERY_EXPLAIN_SECONDS'],
+                       analyze=app.config['SLOW_QUERY_EXPLAIN_ANALYZE'])
+    for engine in engines.values():
+        log.attach(engine)
+    app.extensions['slow_queries'] = log
+
+
+def read_log(path, backups):
+    """The records in the log at `path` and its rotated copies, oldest file first."""
+
+    paths = [f'{path}.{number}' for number in range(backups, 0, -1)] + [path]
+    for name in paths:
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def top_offenders(records, limit=10, order='total'):
+    """Slow queries grouped by fingerprint, worst first.
+
+    Returns dicts of fingerprint, calls, total_ms, max_ms, mean_ms, views
+    (a Counter) and an example statement. `order` is total, calls or max.
+    """
+
+    groups = {}
+    for record in records:
+        if record.get('kind') != 'query':
+            continue
+        group = groups.setdefault(record['fingerprint'], {
+            'fingerprint': record['fingerprint'], 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'views': Counter(), 'statement': normalize(record['statement']),
+        })
+        group['calls'] += 1
+        group['total_ms'] += record['ms']
+        group['max_ms'] = max(group['max_ms'], record['ms'])
+        group['views'][record.get('view') or record.get('thread')] += 1
+
+    for group in groups.values():
+        group['mean_ms'] = group['total_ms'] / group['calls']
+
+    key = {'total': 'total_ms', 'calls': 'calls', 'max': 'max_ms'}[order]
+    return sorted(groups.values(), key=lambda group: group[key], reverse=True)[:limit]
+
+
+@slowlog_cli.command('top')
+@click.option('--limit', default=10, help="How many fingerprints to show.")
+@click.option('--order', type=click.Choice(['total', 'calls', 'max']), default='total',
+              help="Rank by total time, number of calls or slowest call.")
+def top_command(limit, order):
+    """Show the slowest statements, grouped by fingerprint."""
+
+    config = current_app.config
+    records = read_log(config['SLOW_QUERY_LOG'], config['SLOW_QUERY_LOG_BACKUPS'])
+    for group in top_offenders(records, limit, order):
+        views = ', '.join(f"{view} ({count})" for view, count in group['views'].most_common(3))
+        click.echo(f"{group['fingerprint']}  {group['calls']} calls, {group['total_ms']:.0f} ms total, "
+                   f"{group['mean_ms']:.0f} ms mean, {group['max_ms']:.0f} ms max  [{views}]")
+        click.echo(f"    {group['statement'][:300]}")
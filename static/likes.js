@@ -1,39 +1,155 @@
-const likeBtns = document.querySelectorAll('button.btn.btn-sm');
-
-for (btn of likeBtns) {
-    btn.addEventListener('click', async (e) => {
-        e.preventDefault()
-        try {
-            // Grab the button so we can have an id
-            const button = e.target.matches('button.btn.btn-sm') ? e.target: e.target.parentNode
-
-            const res = await axios.post(`/messages/${button.id}/like`);
-
-            if (res.status === 200) {
-                if (res.data.like_status === true) {
-                    // We are liking a post
-                    button.classList.toggle('btn-secondary');
-                    button.classList.toggle('btn-primary');
-                } else {
-                    // We are removing like from post
-                    button.classList.toggle('btn-primary');
-                    button.classList.toggle('btn-secondary');
-
-                }
-        }
-            } catch (error) {
+const timeline = document.getElementById('messages');
 
-            if (error.response.status === 403) {
-                await flash(error.response.data.warning, 'danger');
-            }
+// Like buttons are handled on the list itself so warbles added by the live
+// stream get the same behaviour as the ones rendered with the page.
+//
+// Clicks update the button straight away and are sent in batches: after a
+// short pause in clicking, every message's latest state goes to /api/likes
+// in one request. Only one batch is in flight at a time.
+const LIKE_DEBOUNCE_MS = 400;
+const LIKE_MAX_WAIT_MS = 2000;
+
+const pendingLikes = new Map();
+let likeTimer = null;
+let firstPendingAt = null;
+let likesInFlight = false;
+
+timeline.addEventListener('click', (e) => {
+    const button = e.target.closest('button.btn.btn-sm');
+    if (!button) {
+        return
+    }
+
+    e.preventDefault()
+    const liked = !button.classList.contains('btn-primary');
+    showLike(button, liked);
+    pendingLikes.set(button.id, liked);
+    scheduleLikes();
+})
+
+function showLike(button, liked) {
+    if (button.classList.contains('btn-primary') === liked) {
+        return
+    }
+    button.classList.toggle('btn-secondary');
+    button.classList.toggle('btn-primary');
+    const count = button.querySelector('.like-count');
+    if (count) count.innerText = Number(count.innerText) + (liked ? 1 : -1);
+}
+
+function scheduleLikes() {
+    firstPendingAt = firstPendingAt || Date.now();
+    clearTimeout(likeTimer);
+    const wait = Math.min(LIKE_DEBOUNCE_MS, firstPendingAt + LIKE_MAX_WAIT_MS - Date.now());
+    likeTimer = setTimeout(sendLikes, Math.max(wait, 0));
+}
 
+async function sendLikes() {
+    if (likesInFlight || pendingLikes.size === 0) {
+        return
+    }
+
+    const batch = Object.fromEntries(pendingLikes);
+    pendingLikes.clear();
+    firstPendingAt = null;
+    likesInFlight = true;
+
+    try {
+        const res = await axios.post('/api/likes', batch);
+        for (const [id, warning] of Object.entries(res.data.errors)) {
+            // Put the button back, unless it has been clicked again since
+            const button = document.getElementById(id);
+            if (button && !pendingLikes.has(id)) showLike(button, !batch[id]);
+            await flash(warning, 'danger');
+        }
+    } catch (error) {
+        if (error.response && error.response.status < 500) {
+            await flash(error.response.data.warning, 'danger');
+        } else {
+            // Try again later, keeping any newer clicks
+            for (const [id, liked] of Object.entries(batch)) {
+                if (!pendingLikes.has(id)) pendingLikes.set(id, liked);
+            }
         }
+    } finally {
+        likesInFlight = false;
+    }
+
+    if (pendingLikes.size) {
+        scheduleLikes();
+    }
+}
 
+// Don't lose the last clicks when the page is closed or navigated away from
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden' && pendingLikes.size) {
+        const batch = Object.fromEntries(pendingLikes);
+        pendingLikes.clear();
+        navigator.sendBeacon('/api/likes', new Blob([JSON.stringify(batch)], {type: 'application/json'}));
+    }
+})
 
+// Live timeline: new warbles from followed users are pushed over SSE and
+// prepended to the list. EventSource reconnects on its own, sending the id
+// of the last warble it saw so nothing is missed.
+if (timeline.dataset.stream) {
+    const source = new EventSource(`${timeline.dataset.stream}?last_event_id=${timeline.dataset.lastId}`);
 
+    source.addEventListener('warble', (e) => {
+        const msg = JSON.parse(e.data);
+        if (document.getElementById(msg.id)) {
+            return
+        }
+        timeline.prepend(buildMessage(msg));
     })
 }
 
+function buildMessage(msg) {
+    // Mirrors the markup of a timeline item in home.html
+    const li = document.createElement('li');
+    li.className = 'list-group-item';
+
+    const messageLink = document.createElement('a');
+    messageLink.href = `/messages/${msg.id}`;
+    messageLink.className = 'message-link';
+
+    const imageLink = document.createElement('a');
+    imageLink.href = `/users/${msg.user_id}`;
+    const image = document.createElement('img');
+    image.src = msg.image_url;
+    image.className = 'timeline-image';
+    imageLink.append(image);
+
+    const area = document.createElement('div');
+    area.className = 'message-area';
+    const userLink = document.createElement('a');
+    userLink.href = `/users/${msg.user_id}`;
+    userLink.innerText = `@${msg.username}`;
+    const timestamp = document.createElement('span');
+    timestamp.className = 'text-muted';
+    timestamp.innerText = ` ${msg.timestamp}`;
+    const text = document.createElement('p');
+    text.innerText = msg.text;
+    area.append(userLink, timestamp, text);
+
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = `/messages/${msg.id}/like`;
+    const button = document.createElement('button');
+    button.id = msg.id;
+    button.className = 'btn btn-sm btn-secondary';
+    const icon = document.createElement('i');
+    icon.className = 'fa fa-thumbs-up';
+    const count = document.createElement('span');
+    count.className = 'like-count';
+    count.innerText = msg.like_count;
+    button.append(icon, ' ', count);
+    form.append(button);
+
+    li.append(messageLink, imageLink, area, form);
+    return li
+}
+
 async function flash(message, category) {
     // We get the flash messages div
     const container = document.querySelector('div.container');
@@ -44,4 +160,4 @@ async function flash(message, category) {
     m.innerText = message;
 
     container.prepend(m)
-}
\ No newline at end of file
+}
@@ -0,0 +1,313 @@
+"""Live timeline updates for Warbler, delivered over Server-Sent Events."""
+
+import collections
+import json
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import text
+
+from images import sized
+from models import db, User, Message
+
+CHANNEL = 'warbler_messages'
+
+
+def is_postgres():
+    """Are we talking to PostgreSQL (and so able to use LISTEN/NOTIFY)?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def announce_new_messages():
+    """Wake up every worker's broadcaster once the current transaction commits.
+
+    Call this after adding messages and before committing; PostgreSQL only
+    delivers the notification on commit. Elsewhere the broadcasters poll, so
+    there is nothing to do.
+    """
+
+    if is_postgres():
+        db.session.execute(text("SELECT pg_notify(:channel, '')"), {'channel': CHANNEL})
+
+
+def message_event(message, user):
+    """Serialize a message the way the timeline renders it."""
+
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.strftime('%d %B %Y'),
+        'like_count': message.like_count,
+        'user_id': user.id,
+        'username': user.username,
+        'image_url': sized(user.image_url, 'avatar'),
+    }
+
+
+def format_event(event):
+    """Format an event dict as an SSE frame."""
+
+    return f"id: {event['id']}\nevent: warble\ndata: {json.dumps(event)}\n\n"
+
+
+class Subscription:
+    """One connected client: the authors it cares about and its pending events."""
+
+    def __init__(self, user_ids, queue_size):
+        self.user_ids = set(user_ids)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def offer(self, event):
+        """Queue an event, giving up on the client if it can't keep up.
+
+        A client that falls behind is disconnected; the browser reconnects with
+        `Last-Event-ID` and catches up from the database.
+        """
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class Broadcaster:
+    """Fan new messages out to every SSE connection held by this worker.
+
+    There is one broadcaster per process. Its thread is started by the first
+    subscriber (so it is never inherited across a fork). Each time it is woken,
+    by NOTIFY on PostgreSQL or by its poll timer elsewhere, it fetches the
+    messages added since it last looked in a single query and hands them to the
+    matching subscribers, so the database cost doesn't grow with the number of
+    connected clients.
+
+    Message ids are handed out before commit, so a message can become visible
+    after one with a higher id. The ids skipped over (at most `max_gaps` at a
+    time) are fetched again along with the new ones for `gap_seconds`, in case
+    their transaction is still to commit.
+
+    The last `replay_size` events are kept so a client can subscribe from a
+    `mark()` taken before it read its backlog, and miss nothing in between.
+    """
+
+    def __init__(self, app, max_connections=100, poll_interval=2.0, queue_size=100, batch_size=500,
+                 max_gaps=1000, gap_seconds=30.0, replay_size=1000):
+        self.app = app
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_gaps = max_gaps
+        self.gap_seconds = gap_seconds
+
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listener = None
+        self._last_id = None
+        self._gaps = {}
+        self._recent = collections.deque(maxlen=replay_size)
+        self._sequence = 0
+
+    def mark(self):
+        """The current position in the published events, for `subscribe`."""
+
+        with self._lock:
+            self._start()
+            return self._sequence
+
+    def subscribe(self, user_ids, since=None):
+        """Register a client. Returns None if this worker is at capacity.
+
+        With `since` (a `mark()`), the events published after it are queued
+        first. If some have already been dropped, the subscription starts
+        overflowed, so the client reconnects and catches up from the database.
+        """
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_connections:
+                return None
+
+            subscription = Subscription(user_ids, self.queue_size)
+            self._start()
+
+            if since is not None:
+                if self._recent and self._recent[0][0] > since + 1:
+                    subscription.overflowed = True
+                for sequence, event in self._recent:
+                    if sequence > since and event['user_id'] in subscription.user_ids:
+                        subscription.offer(event)
+
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def connection_count(self):
+        return len(self._subscribers)
+
+    @property
+    def full(self):
+        return len(self._subscribers) >= self.max_connections
+
+    def publish(self, events):
+        """Hand each event to the subscribers following its author."""
+
+        # Recorded and handed out under one lock, so a concurrent subscriber
+        # gets each event either live or replayed, never both or neither.
+        with self._lock:
+            for event in events:
+                self._sequence += 1
+                self._recent.append((self._sequence, event))
+            subscribers = list(self._subscribers)
+
+        for event in events:
+            for subscription in subscribers:
+                if event['user_id'] in subscription.user_ids:
+                    subscription.offer(event)
+
+    def fetch_new(self):
+        """Fetch messages not yet published, oldest first."""
+
+        now = time.monotonic()
+        self._gaps = {id: seen for id, seen in self._gaps.items() if now - seen < self.gap_seconds}
+
+        unseen = Message.id > self._last_id
+        if self._gaps:
+            unseen = db.or_(unseen, Message.id.in_(self._gaps))
+        messages = Message.query.filter(unseen).order_by(Message.id).limit(self.batch_size)
+        # Sorted again, and users fetched separately, for when messages are
+        # spread over shards (see sharding.py)
+        messages = sorted(messages, key=lambda message: message.id)[:self.batch_size]
+        if not messages:
+            return []
+
+        ids = {message.id for message in messages}
+        for id in ids:
+            self._gaps.pop(id, None)
+        newest = messages[-1].id
+        if newest > self._last_id:
+            self._note_gaps(range(max(self._last_id + 1, newest - self.max_gaps), newest), ids, now)
+            self._last_id = newest
+
+        users = {user.id: user for user in User.query.filter(User.id.in_({m.user_id for m in messages}))}
+        return [message_event(message, users[message.user_id]) for message in messages]
+
+    def _note_gaps(self, candidates, present, now):
+        """Remember the ids in `candidates` not in `present`, keeping the newest `max_gaps`."""
+
+        for id in candidates:
+            if id not in present:
+                self._gaps[id] = now
+        if len(self._gaps) > self.max_gaps:
+            self._gaps = dict(sorted(self._gaps.items())[-self.max_gaps:])
+
+    def _start(self):
+        """Start the thread if it isn't running. Call with the lock held."""
+
+        if self._thread is None or not self._thread.is_alive():
+            if self._last_id is None:
+                self._seed()
+
+            self._thread = threading.Thread(target=self._run, name='warbler-broadcaster', daemon=True)
+            self._thread.start()
+
+    def _seed(self):
+        """Start from the newest message."""
+
+        newest = db.session().scatter(db.select(db.func.max(Message.id)))
+        self._last_id = max((result.scalar() or 0 for result in newest), default=0)
+
+        # Ids missing just below it may be transactions still to commit
+        recent = db.session().scatter(db.select(Message.id).where(Message.id > self._last_id - self.max_gaps))
+        self._gaps = {}
+        self._note_gaps(range(max(self._last_id - self.max_gaps + 1, 1), self._last_id),
+                        {id for result in recent for id in result.scalars()}, time.monotonic())
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    self.publish(self.fetch_new())
+                    db.session.remove()
+                    self._wait()
+                except Exception:
+                    self.app.logger.exception("Timeline broadcaster failed; retrying")
+                    db.session.remove()
+                    self._close_listener()
+                    time.sleep(self.poll_interval)
+
+    def _wait(self):
+        """Block until there may be new messages."""
+
+        if not is_postgres():
+            time.sleep(self.poll_interval)
+            return
+
+        if self._listener is None:
+            # A dedicated connection, detached from the pool, so LISTEN doesn't
+            # pin one of the request connections.
+            connection = db.engine.raw_connection()
+            connection.detach()
+            self._listener = connection.driver_connection
+            self._listener.autocommit = True
+            self._listener.cursor().execute(f"LISTEN {CHANNEL}")
+
+        # Fall back to polling every so often in case a notification was lost.
+        if select.select([self._listener], [], [], self.poll_interval * 10) != ([], [], []):
+            self._listener.poll()
+            self._listener.notifies.clear()
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+
+def event_stream(broadcaster, user_ids, since, backlog, heartbeat=15.0):
+    """Generate the SSE body for one client.
+
+    The client is subscribed from `since` (a `Broadcaster.mark()` taken before
+    `backlog` was read) only once the body is iterated, so a response that is
+    never sent doesn't hold a connection slot. `backlog` holds the messages the
+    client missed; live events already covered by it are skipped. Comment lines
+    are sent while idle so proxies don't time the connection out.
+    """
+
+    subscription = broadcaster.subscribe(user_ids, since)
+    if subscription is None:
+        # The worker filled up after the view checked; the client will retry.
+        yield "retry: 30000\n\n"
+        return
+
+    try:
+        yield "retry: 3000\n\n"
+
+        sent = set()
+        for event in backlog:
+            sent.add(event['id'])
+            yield format_event(event)
+
+        while not subscription.overflowed:
+            try:
+                event = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+
+            if event['id'] in sent:
+                continue
+
+            yield format_event(event)
+    finally:
+        broadcaster.unsubscribe(subscription)
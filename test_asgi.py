@@ -0,0 +1,143 @@
+"""ASGI read endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+import os
+from unittest import TestCase
+from sqlalchemy.orm.session import close_all_sessions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from asgi import create_asgi_app
+from models import db, User, Message, Follows, Likes, LikeCounterShard
+
+app = create_app(csrf=False)
+asgi_app = create_asgi_app(app)
+
+
+async def call(path, cookie=None, method='GET'):
+    """(status, headers, body) for a request to the ASGI app."""
+
+    headers = [(b'host', b'localhost')]
+    if cookie:
+        headers.append((b'cookie', f"{app.config['SESSION_COOKIE_NAME']}={cookie}".encode()))
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+             'root_path': '', 'headers': headers, 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    start = messages[0]
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def run(*requests):
+    """Responses to `requests` ((path, cookie) pairs), sent at once and each decoded from JSON."""
+
+    async def main():
+        try:
+            responses = await asyncio.gather(*(call(*request) for request in requests))
+        finally:
+            await asgi_app.stop()
+        return [(status, json.loads(body)) for status, _, body in responses]
+
+    return asyncio.run(main())
+
+
+class AsgiViewsTestCase(TestCase):
+    """Test the async read endpoints."""
+
+    def setUp(self):
+        app.app_context().push()
+        close_all_sessions()
+        db.drop_all()
+        db.create_all()
+
+        self.user1 = User.signup('testuser', 'test@test.com', 'testpassword', None)
+        self.user2 = User.signup('testuser2', 'test2@test.com', 'testpassword', None)
+        db.session.commit()
+
+        self.message1 = Message(text='First message', user_id=self.user1.id)
+        self.message2 = Message(text='Second message', user_id=self.user2.id)
+        db.session.add_all([self.message1, self.message2])
+        db.session.commit()
+
+        db.session.add_all([Follows(user_following_id=self.user1.id, user_being_followed_id=self.user2.id),
+                            Likes(user_id=self.user1.id, message_id=self.message2.id),
+                            LikeCounterShard(message_id=self.message2.id, shard=0, delta=1)])
+        db.session.commit()
+
+        self.cookie = app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: self.user1.id})
+
+    def test_users_show(self):
+        """Does a profile come with its counts and messages, and a missing one 404?"""
+
+        (status, body), (missing, _) = run((f'/api/users/{self.user1.id}', None), ('/api/users/9999', None))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['user']['username'], 'testuser')
+        self.assertEqual((body['user']['message_count'], body['user']['following_count'],
+                          body['user']['likes_count']), (1, 1, 1))
+        self.assertEqual([message['text'] for message in body['messages']], ['First message'])
+        self.assertIsNone(body['older'])
+        self.assertEqual(missing, 404)
+
+    def test_timeline(self):
+        """Does the timeline show followed users' messages with likes, and need a login?"""
+
+        (status, body), (anonymous, _), (forged, _) = run(('/api/timeline', self.cookie), ('/api/timeline', None),
+                                                          ('/api/timeline', self.cookie[:-2] + 'xx'))
+
+        self.assertEqual(status, 200)
+        messages = {message['text']: message for message in body['messages']}
+        self.assertEqual(set(messages), {'First message', 'Second message'})
+        self.assertEqual(messages['Second message']['username'], 'testuser2')
+        self.assertEqual(messages['Second message']['like_count'], 1)
+        self.assertTrue(messages['Second message']['liked'])
+        self.assertFalse(messages['First message']['liked'])
+        self.assertEqual((anonymous, forged), (401, 401))
+
+    def test_follow_lists_and_message(self):
+        """Do the follow lists and a single message come back?"""
+
+        (_, following), (_, followers), (status, shown) = run(
+            (f'/api/users/{self.user1.id}/following', self.cookie),
+            (f'/api/users/{self.user2.id}/followers', self.cookie),
+            (f'/api/messages/{self.message2.id}', None))
+
+        self.assertEqual([user['username'] for user in following['users']], ['testuser2'])
+        self.assertTrue(following['users'][0]['followed'])
+        self.assertEqual([user['username'] for user in followers['users']], ['testuser'])
+        self.assertEqual(status, 200)
+        self.assertEqual((shown['message']['text'], shown['message']['like_count']), ('Second message', 1))
+
+    def test_flask_fallback(self):
+        """Are other paths served by the Flask app?"""
+
+        async def main():
+            return await call('/login')
+
+        status, headers, body = asyncio.run(main())
+        self.assertEqual(status, 200)
+        self.assertIn(b'text/html', headers[b'content-type'])
+        self.assertIn(b'Welcome back', body)
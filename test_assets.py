@@ -0,0 +1,77 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app
+from assets import build_assets, minify_css, minify_js
+
+app = create_app(csrf=False)
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        app.app_context().push()
+        app.config['ASSETS_FOLDER'] = tempfile.mkdtemp()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['assets'] = {}
+
+    def test_minify(self):
+        """Do the minifiers drop what they should and keep what they must?"""
+
+        self.assertEqual(minify_css("/* nav */\na {\n  color: red;\n  margin: 0 auto;\n}\n"),
+                         "a{color:red;margin:0 auto}")
+        self.assertEqual(minify_js("// comment\n  const a = 1\n\n  go(`http://x`)\n"),
+                         "const a = 1\ngo(`http://x`)\n")
+
+    def test_unbuilt_assets(self):
+        """Without a build, are plain static files linked?"""
+
+        resp = self.client.get('/login')
+        self.assertIn('href="/static/stylesheets/style.css"', resp.text)
+
+    def test_build_and_serve(self):
+        """Are built assets linked by fingerprint and served precompressed?"""
+
+        manifest = build_assets(app.static_folder, app.config['ASSETS_FOLDER'], echo=lambda line: None)
+        app.extensions['assets'] = manifest
+
+        css = manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        resp = self.client.get('/login')
+        self.assertIn(f'href="/assets/{css}"', resp.text)
+
+        plain = self.client.get(f'/assets/{css}')
+        self.assertEqual(plain.status_code, 200)
+        self.assertEqual(plain.mimetype, 'text/css')
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn('immutable', plain.headers['Cache-Control'])
+
+        packed = self.client.get(f'/assets/{css}', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(packed.content_encoding, 'gzip')
+        self.assertIn('Accept-Encoding', packed.headers['Vary'])
+        self.assertEqual(gzip.decompress(packed.data), plain.data)
+
+        self.assertEqual(self.client.get('/assets/../app.py').status_code, 404)
+        self.assertEqual(self.client.get('/assets/nope.css').status_code, 404)
@@ -1,6 +1,7 @@
 """Message model tests."""
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError, DataError
 from models import db, User, Message, Follows
@@ -12,6 +13,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import create_app
 
+from queries import feed_messages, following_ids, user_by_id, user_messages
+
 app = create_app()
 
 # Create our tables (we do this here, so we only create the tables
@@ -91,5 +94,29 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(len(self.u.likes), 1)
 
+    def test_cached_queries(self):
+        """Do the cached statements pick up new parameters on every call?"""
+
+        other = User(email="other@test.com", username="other", password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+
+        start = datetime(2024, 1, 1)
+        for i in range(6):
+            db.session.add(Message(text=f'u{i}', user_id=self.u.id, timestamp=start + timedelta(minutes=2 * i)))
+            db.session.add(Message(text=f'o{i}', user_id=other.id, timestamp=start + timedelta(minutes=2 * i + 1)))
+        db.session.add(Follows(user_being_followed_id=other.id, user_following_id=self.u.id))
+        db.session.commit()
+
+        self.assertEqual(user_by_id(other.id).username, 'other')
+        self.assertIsNone(user_by_id(-1))
+        self.assertEqual(following_ids(self.u.id), [other.id])
+        self.assertEqual(following_ids(other.id), [])
 
+        self.assertEqual([m.text for m in feed_messages([self.u.id], 3)], ['u5', 'u4', 'u3'])
+        self.assertEqual([m.text for m in feed_messages([self.u.id, other.id], 3)], ['o5', 'u5', 'o4'])
 
+        first = user_messages(other.id, 4)
+        self.assertEqual([m.text for m in first], ['o5', 'o4', 'o3', 'o2'])
+        rest = user_messages(other.id, 4, (first[-1].timestamp, first[-1].id))
+        self.assertEqual([m.text for m in rest], ['o1', 'o0'])
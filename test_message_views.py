@@ -1,11 +1,16 @@
 """Message View tests."""
 
+import html
+import json
 import os
+import re
+import threading
+from datetime import datetime, timedelta
 from pprint import pprint
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import close_all_sessions
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, ArchivedMessage, TagBucketCount, TrendingTag, MessageTag
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,6 +22,11 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import create_app, CURR_USER_KEY
+from archive import archive_batch, cursor_for, user_messages_page
+from bulk import ingest_messages
+from hashtags import extract_hashtags
+from trending import refresh_snapshot
+from queries import user_messages
 
 app = create_app(csrf=False)
 
@@ -27,6 +37,7 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
         app.app_context().push()
+        close_all_sessions()
         User.query.delete()
         Message.query.delete()
 
@@ -146,4 +157,281 @@ class MessageViewTestCase(TestCase):
             self.assertIn('Access unauthorized', html)
 
             msg = Message.query.all()
-            self.assertEqual(len(msg), 2)
\ No newline at end of file
+            self.assertEqual(len(msg), 2)
+
+    def test_bulk_add_messages(self):
+        """Can a user post many messages at once, with bad lines reported?"""
+
+        lines = [json.dumps({'text': f'Imported {i}'}) for i in range(5)]
+        lines.append('not json')
+        lines.append(json.dumps({'text': 'x' * 141}))
+        lines.append(json.dumps({'text': 'Old one', 'timestamp': '2020-01-02T03:04:05'}))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.post('/api/messages/bulk', data='\n'.join(lines),
+                          content_type='application/x-ndjson')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['inserted'], 6)
+            self.assertEqual([e['line'] for e in resp.json['errors']], [6, 7])
+
+            msg = Message.query.filter_by(text='Old one').one()
+            self.assertEqual(msg.user_id, self.testuser1.id)
+            self.assertEqual(msg.timestamp.year, 2020)
+            self.assertEqual(Message.query.count(), 8)
+
+    def test_bulk_import_pages(self):
+        """Can every message of a bulk import be reached by paging the profile?"""
+
+        lines = [json.dumps({'text': f'Imported {i}'}) for i in range(250)]
+        self.assertEqual(ingest_messages(self.testuser1.id, lines, chunk_size=100), (250, []))
+
+        seen, url = [], f'/users/{self.testuser1.id}'
+        while url:
+            page = self.client.get(url).text
+            seen.extend(re.findall(r'<p>Imported (\d+)</p>', page))
+            older = re.search(r'href="([^"]+)">Older warbles', page)
+            url = older and html.unescape(older.group(1))
+
+        # Newest first, which is the reverse of the import
+        self.assertEqual(seen, [str(i) for i in range(249, -1, -1)])
+
+    def test_bulk_add_unauthorized(self):
+        """Can a non logged in user post messages in bulk?"""
+
+        resp = self.client.post('/api/messages/bulk', data=json.dumps({'text': 'Hello'}))
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_bulk_add_needs_ndjson(self):
+        """Is a bulk post that a cross-site form could send turned away?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.post('/api/messages/bulk', data=json.dumps({'text': 'Hello'}), content_type='text/plain')
+            self.assertEqual(resp.status_code, 415)
+            self.assertEqual(Message.query.count(), 2)
+
+    def test_user_messages_tied_timestamps(self):
+        """Does paging by (timestamp, id) reach every message when timestamps are shared?"""
+
+        now = datetime.utcnow()
+        db.session.add_all([Message(text=f'Tied {i}', user_id=self.testuser1.id, timestamp=now)
+                            for i in range(250)])
+        db.session.commit()
+
+        seen, position = [], None
+        while True:
+            page = user_messages(self.testuser1.id, 100, position)
+            if not page:
+                break
+            seen.extend(message.id for message in page)
+            position = page[-1].timestamp, page[-1].id
+
+        self.assertEqual(len(seen), 251)
+        self.assertEqual(len(set(seen)), 251)
+
+    def test_csrf_token_masked(self):
+        """Is the CSRF token different in every page, and still accepted?"""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser1.id
+
+                tokens = [re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', c.get('/').text)[1]
+                          for _ in range(2)]
+                self.assertNotEqual(tokens[0], tokens[1])
+
+                resp = c.post('/messages/new', data={'text': 'Masked', 'csrf_token': tokens[0]})
+                self.assertEqual(resp.status_code, 302)
+                self.assertIsNotNone(Message.query.filter_by(text='Masked').first())
+
+                resp = c.post('/messages/new', data={'text': 'Forged', 'csrf_token': 'forged'})
+                self.assertIsNone(Message.query.filter_by(text='Forged').first())
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_archived_message(self):
+        """Are archived messages still shown on their page and on the profile?"""
+
+        old = Message(text='Ancient message', user_id=self.testuser1.id,
+                      timestamp=datetime.utcnow() - timedelta(days=1000))
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+
+        self.assertEqual(archive_batch(datetime.utcnow() - timedelta(days=365)), 1)
+        self.assertIsNone(Message.query.get(old_id))
+        self.assertIsNotNone(ArchivedMessage.query.get(old_id))
+
+        with self.client as c:
+            resp = c.get(f'/messages/{old_id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Ancient message', resp.text)
+
+            resp = c.get(f'/users/{self.testuser1.id}')
+            self.assertIn('First message', resp.text)
+            self.assertIn('Ancient message', resp.text)
+
+    def test_archived_message_keeps_likes(self):
+        """Does a like of an archived message still count and show on the liker's page?"""
+
+        old = Message(text='Ancient message', user_id=self.testuser1.id,
+                      timestamp=datetime.utcnow() - timedelta(days=1000))
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            c.post(f'/messages/{old_id}/like')
+            archive_batch(datetime.utcnow() - timedelta(days=365))
+
+            self.assertEqual(ArchivedMessage.query.get(old_id).like_count, 1)
+            self.assertEqual(self.testuser2.likes_count(), 1)
+
+            resp = c.get(f'/users/{self.testuser2.id}/likes')
+            self.assertIn('Ancient message', resp.text)
+
+            # Deleting it takes its likes too
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+            c.post(f'/messages/{old_id}/delete')
+            self.assertEqual(self.testuser2.likes_count(), 0)
+
+    def test_profile_pages_tied_timestamps(self):
+        """Does paging a profile reach every message in both tiers when timestamps are shared?"""
+
+        now = datetime.utcnow()
+        old = now - timedelta(days=1000)
+        db.session.add_all([Message(text=f'Old {i}', user_id=self.testuser1.id, timestamp=old)
+                            for i in range(150)])
+        db.session.add_all([Message(text=f'New {i}', user_id=self.testuser1.id, timestamp=now)
+                            for i in range(150)])
+        db.session.commit()
+        archive_batch(now - timedelta(days=365))
+
+        seen, before = [], None
+        while True:
+            page = user_messages_page(self.testuser1.id, before, 100)
+            if not page:
+                break
+            seen.extend(message.id for message in page)
+            before = cursor_for(page[-1])
+
+        self.assertEqual(len(seen), 301)
+        self.assertEqual(len(set(seen)), 301)
+
+    def test_trending_hashtags(self):
+        """Do hashtags in new messages show up as trending?"""
+
+        self.assertEqual(extract_hashtags("#Flask and #flask, not a#b or ##x"), ['flask'])
+
+        TagBucketCount.query.delete()
+        TrendingTag.query.delete()
+        db.session.commit()
+
+        # Start from empty counts, and flush to the database on every message
+        app.extensions['trends'].take()
+        app.extensions['trends'].flush_seconds = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser1.id
+
+                c.post("/messages/new", data={"text": "Loving #warbler"})
+                c.post("/messages/new", data={"text": "#Warbler again #python"})
+
+                trends = TrendingTag.query.filter_by(period='1h').order_by(TrendingTag.rank).all()
+                self.assertEqual([(t.tag, t.count) for t in trends], [('warbler', 2), ('python', 1)])
+
+                resp = c.get('/')
+                self.assertIn('#warbler', resp.text)
+        finally:
+            app.extensions['trends'].flush_seconds = app.config['TRENDING_FLUSH_SECONDS']
+
+    def test_trends_flush_without_new_hashtags(self):
+        """Does a worker flush its counts once due, on a request that posts nothing?"""
+
+        TagBucketCount.query.delete()
+        TrendingTag.query.delete()
+        db.session.commit()
+
+        tracker = app.extensions['trends']
+        tracker.take()
+        tracker.record(['quiet'])
+        tracker.flush_seconds = 0
+        try:
+            self.client.get('/login')
+        finally:
+            tracker.flush_seconds = app.config['TRENDING_FLUSH_SECONDS']
+
+        self.assertEqual([t.tag for t in TrendingTag.query.filter_by(period='1h')], ['quiet'])
+
+    def test_concurrent_trend_refreshes(self):
+        """Can workers refresh the trending snapshot at the same time?"""
+
+        db.session.add_all(TagBucketCount(bucket_start=datetime.utcnow(), tag=f'tag{i}', count=i)
+                           for i in range(1, 6))
+        db.session.commit()
+
+        errors = []
+
+        def refresh():
+            with app.app_context():
+                try:
+                    for _ in range(20):
+                        refresh_snapshot()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=refresh) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(TrendingTag.query.filter_by(period='1h').count(), 5)
+
+    def test_tag_page(self):
+        """Does a tag page list the messages using it, newest first, across pages?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            c.post("/messages/new", data={"text": "Hello #Flask"})
+            c.post("/messages/new", data={"text": "No tag here"})
+            bulk = "\n".join(json.dumps({"text": f"bulk {i} #flask"}) for i in range(101))
+            c.post("/api/messages/bulk", data=bulk, content_type='application/x-ndjson')
+
+            self.assertEqual(MessageTag.query.filter_by(tag='flask').count(), 102)
+
+            resp = c.get('/tags/FLASK')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('href="/tags/flask"', resp.text)
+            self.assertIn('bulk 100 ', resp.text)
+            self.assertNotIn('No tag here', resp.text)
+            self.assertNotIn('Hello ', resp.text)
+            self.assertIn('Older warbles', resp.text)
+
+            older = c.get('/tags/flask', query_string={'before': resp.text.split('before=')[1].split('"')[0]})
+            self.assertIn('Hello <a href="/tags/flask" class="hashtag">#Flask</a>', older.text)
+            self.assertNotIn('Older warbles', older.text)
+
+            msg = Message.query.filter_by(text='Hello #Flask').one()
+            c.post(f'/messages/{msg.id}/delete')
+            self.assertEqual(MessageTag.query.filter_by(tag='flask').count(), 101)
+
+            self.assertEqual(c.get('/tags/not-a-tag').status_code, 404)
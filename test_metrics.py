@@ -0,0 +1,92 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from sqlalchemy.orm.session import close_all_sessions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app
+from models import db, User
+
+app = create_app(csrf=False)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A worker: serves one page, or prints /metrics
+WORKER = """
+import sys
+from app import create_app
+client = create_app(csrf=False).test_client()
+response = client.get(sys.argv[1])
+print(response.text if sys.argv[1] == '/metrics' else response.status_code)
+"""
+
+
+def sample(text, line_start):
+    """The value of the first sample in `text` starting with `line_start`."""
+
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class MetricsTestCase(TestCase):
+    """Test the /metrics endpoint."""
+
+    def setUp(self):
+        app.app_context().push()
+        close_all_sessions()
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+    def test_request_metrics(self):
+        """Are requests counted and timed per view, with bcrypt, pool and cache metrics?"""
+
+        before = self.client.get('/metrics').text
+        self.client.get('/login')
+        self.client.get('/messages/999999')
+        User.signup('testuser', 'test@test.com', 'testpassword', None)
+        db.session.commit()
+        self.client.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+
+        text = self.client.get('/metrics').text
+        login = 'warbler_http_requests_total{endpoint="login",method="GET",status="200"}'
+        self.assertEqual(sample(text, login) - (sample(before, login) or 0), 1)
+        self.assertIsNotNone(sample(text, 'warbler_http_requests_total{endpoint="messages_show",method="GET",'
+                                          'status="404"}'))
+        self.assertIsNotNone(sample(text, 'warbler_http_request_duration_seconds_bucket{endpoint="login"'))
+        self.assertGreaterEqual(sample(text, 'warbler_bcrypt_seconds_count{operation="check"}'), 1)
+        self.assertGreaterEqual(sample(text, 'warbler_bcrypt_seconds_count{operation="hash"}'), 1)
+        self.assertIsNotNone(sample(text, 'warbler_db_pool_checked_out{bind="primary"}'))
+        # This request, and no other
+        self.assertEqual(sample(text, 'warbler_http_requests_in_progress'), 1)
+
+    def test_multiprocess(self):
+        """Do separate worker processes' metrics add up?"""
+
+        env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': tempfile.mkdtemp()}
+        for _ in range(2):
+            subprocess.run([sys.executable, '-c', WORKER, '/login'], env=env, cwd=HERE, check=True, capture_output=True)
+        text = subprocess.run([sys.executable, '-c', WORKER, '/metrics'], env=env, cwd=HERE, check=True,
+                              capture_output=True, text=True).stdout
+
+        self.assertEqual(sample(text, 'warbler_http_requests_total{endpoint="login",method="GET",status="200"}'), 2)
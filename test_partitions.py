@@ -0,0 +1,82 @@
+"""Messages partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from sqlalchemy import text
+from sqlalchemy.orm.session import close_all_sessions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app
+from models import db, User
+from partitions import create_partitioned_table, create_partitions
+
+app = create_app(csrf=False)
+
+
+class PartitionsTestCase(TestCase):
+    """Test creating monthly partitions."""
+
+    def setUp(self):
+        app.app_context().push()
+        close_all_sessions()
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup('testuser', 'test@test.com', 'testpassword', None)
+        db.session.commit()
+        self.user_id = user.id
+        # Don't hold locks on users while the test changes tables referencing it
+        db.session.commit()
+
+    def test_partition_takes_default_rows(self):
+        """Are rows stranded in the default partition moved into a new month's partition?"""
+
+        def insert(conn, when):
+            conn.execute(text("INSERT INTO messages_partitioned (text, timestamp, user_id) "
+                              "VALUES ('hi', :when, :user_id)"), {'when': when, 'user_id': self.user_id})
+
+        def count(conn, table):
+            return conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+        # DDL is transactional in PostgreSQL, so all of this is rolled back
+        with db.engine.connect() as conn:
+            create_partitioned_table(conn, 'messages_partitioned')
+            create_partitions(conn, 'messages_partitioned', datetime(2020, 1, 1), datetime(2020, 1, 1))
+
+            insert(conn, datetime(2020, 1, 15))
+            insert(conn, datetime(2020, 3, 1))
+            insert(conn, datetime(2020, 3, 31, 23, 59))
+            insert(conn, datetime(2020, 6, 1))
+            self.assertEqual(count(conn, 'messages_default'), 3)
+
+            created = create_partitions(conn, 'messages_partitioned', datetime(2020, 1, 1), datetime(2020, 3, 1))
+            self.assertEqual(created, ['messages_y2020m02', 'messages_y2020m03'])
+            self.assertEqual(count(conn, 'messages_y2020m03'), 2)
+            self.assertEqual(count(conn, 'messages_default'), 1)
+            self.assertEqual(count(conn, 'messages_partitioned'), 4)
+
+            # It has the parent's foreign key and indexes, like any other partition
+            self.assertEqual(conn.execute(text(
+                "SELECT count(*) FROM pg_constraint "
+                "WHERE conrelid = 'messages_y2020m03'::regclass AND contype = 'f'")).scalar(), 1)
+            self.assertEqual(count(conn, "pg_indexes WHERE tablename = 'messages_y2020m03'"), 3)
+
+            # The default partition is attached again
+            insert(conn, datetime(2020, 7, 1))
+            self.assertEqual(count(conn, 'messages_default'), 2)
+
+            conn.rollback()
@@ -0,0 +1,86 @@
+"""Request profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import os
+import pstats
+import tempfile
+import time
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app
+from profiling import HEADER, make_token
+
+os.environ['PROFILE_FOLDER'] = folder = tempfile.mkdtemp()
+try:
+    app = create_app(csrf=False)
+finally:
+    del os.environ['PROFILE_FOLDER']
+
+
+@app.route('/test/slow')
+def slow_view():
+    time.sleep(0.05)
+    return 'done'
+
+
+class ProfilingTestCase(TestCase):
+    """Test profiling requests."""
+
+    def setUp(self):
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        self.client = app.test_client()
+
+    def test_signed_header(self):
+        """Is a request with a valid token profiled, and one without left alone?"""
+
+        response = self.client.get('/test/slow', headers={HEADER: make_token(app)})
+        name = response.headers[HEADER]
+        self.assertEqual(os.listdir(folder), [name])
+
+        with open(os.path.join(folder, name)) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(any('slow_view (test_profiling.py' in line for line in stacks))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+        for headers in ({}, {HEADER: 'profile.forged'}):
+            response = self.client.get('/test/slow', headers=headers)
+            self.assertNotIn(HEADER, response.headers)
+        self.assertEqual(len(os.listdir(folder)), 1)
+
+    def test_sampled_requests_and_retention(self):
+        """Are sampled requests profiled, keeping only the newest PROFILE_KEEP?"""
+
+        app.config.update(PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2)
+        try:
+            names = [self.client.get('/test/slow').headers[HEADER] for _ in range(3)]
+        finally:
+            app.config.update(PROFILE_SAMPLE_RATE=0, PROFILE_KEEP=200)
+
+        self.assertEqual(sorted(os.listdir(folder)), sorted(names[1:]))
+
+    def test_cprofile(self):
+        """Does the cProfile mode write stats?"""
+
+        app.config['PROFILE_MODE'] = 'cprofile'
+        try:
+            name = self.client.get('/test/slow', headers={HEADER: make_token(app)}).headers[HEADER]
+        finally:
+            app.config['PROFILE_MODE'] = 'sample'
+
+        self.assertTrue(name.endswith('.pstats'))
+        stats = pstats.Stats(os.path.join(folder, name))
+        self.assertTrue(any(function == 'slow_view' for _, _, function in stats.stats))
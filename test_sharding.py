@@ -0,0 +1,198 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm.session import close_all_sessions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+from export import export_stream
+from sharding import create_shard_tables, move_user, shard_engines, shard_metadata
+
+# Two SQLite shards for this module's app only
+folder = tempfile.mkdtemp()
+os.environ['SHARD_DATABASE_URLS'] = ','.join(f"sqlite:///{folder}/shard{number}.db" for number in range(2))
+try:
+    app = create_app(csrf=False)
+finally:
+    del os.environ['SHARD_DATABASE_URLS']
+
+# `db` also serves the other test modules' unsharded apps, whose
+# db.create_all() would look for these binds' (empty) metadata
+for key in app.config['SQLALCHEMY_BINDS']:
+    db.metadatas.pop(key)
+
+
+def rows_on(shard, model, **criteria):
+    """Count `model` rows matching `criteria` on one shard, bypassing the routing."""
+
+    with shard_engines()[shard].connect() as conn:
+        return conn.scalar(select(func.count()).select_from(model.__table__).filter_by(**criteria))
+
+
+class ShardingTestCase(TestCase):
+    """Test routing messages, likes and follows to their users' shards."""
+
+    def setUp(self):
+        app.app_context().push()
+        close_all_sessions()
+        db.drop_all()
+        db.create_all()
+        for engine in shard_engines().values():
+            shard_metadata().drop_all(engine)
+        create_shard_tables()
+
+        # Ids 1 and 2 are placed on shards 1 and 0
+        self.user1 = User.signup('testuser', 'test@test.com', 'testpassword', None)
+        self.user2 = User.signup('testuser2', 'test2@test.com', 'testpassword', None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def login(self, client, user):
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = user.id
+
+    def test_writes_go_to_user_shard(self):
+        """Do messages, follows and likes land on the shard of the user they belong to?"""
+
+        with self.client as client:
+            self.login(client, self.user1)
+            client.post('/messages/new', data={'text': 'first from user1'})
+            client.post('/users/follow/2')
+
+            self.login(client, self.user2)
+            client.post('/messages/new', data={'text': 'first from user2'})
+            message_id = db.session.scalar(select(Message.id).where(Message.user_id == 1))
+            self.assertEqual(client.post(f'/messages/{message_id}/like').json, {'like_status': True})
+
+        self.assertEqual(rows_on(1, Message, user_id=1), 1)
+        self.assertEqual(rows_on(0, Message, user_id=2), 1)
+        self.assertEqual(rows_on(0, Message, user_id=1), 0)
+        self.assertEqual(rows_on(1, Follows, user_following_id=1), 1)
+        self.assertEqual(rows_on(0, Likes, user_id=2), 1)
+
+        # The primary keeps none of them
+        self.assertEqual(db.session().connection(bind_arguments={'shard_id': 'primary'}).scalar(
+            select(func.count()).select_from(Message.__table__)), 0)
+
+    def test_reads_gather_from_shards(self):
+        """Do pages combine rows from several shards, and lazy loads find their users?"""
+
+        db.session.add_all([Message(text='from user1', user_id=1), Message(text='from user2', user_id=2),
+                            Follows(user_being_followed_id=2, user_following_id=1)])
+        db.session.commit()
+        message = db.session.scalars(select(Message).where(Message.user_id == 2)).one()
+        db.session.add(Likes(user_id=1, message_id=message.id))
+        db.session.commit()
+        db.session.expunge_all()
+
+        with self.client as client:
+            self.login(client, db.session.get(User, 1))
+            home = client.get('/').text
+            self.assertIn('from user1', home)
+            self.assertIn('from user2', home)
+            self.assertIn('from user2', client.get('/users/1/likes').text)
+            self.assertIn('testuser', client.get('/users/2/followers').text)
+
+        self.assertEqual(db.session.get(User, 2).message_count(), 1)
+        message = db.session.scalars(select(Message).where(Message.user_id == 2)).one()
+        self.assertEqual(message.user.username, 'testuser2')
+
+    def test_ids_unique_across_shards(self):
+        """Do messages on different shards get different ids?"""
+
+        messages = [Message(text=f'message {i}', user_id=1 + i % 2) for i in range(6)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.assertEqual(len({message.id for message in messages}), 6)
+
+    def test_cross_database_statement(self):
+        """Is a statement joining sharded and primary tables refused?"""
+
+        with self.assertRaises(InvalidRequestError):
+            db.session.execute(select(Message).join(User))
+
+    def test_move_user(self):
+        """Does moving a user take their rows along and update the shard map?"""
+
+        db.session.add_all([Message(text='moving', user_id=1),
+                            Follows(user_being_followed_id=2, user_following_id=1)])
+        db.session.commit()
+
+        self.assertEqual(move_user(1, 0), 2)
+
+        self.assertEqual(rows_on(1, Message), 0)
+        self.assertEqual(rows_on(0, Message, user_id=1), 1)
+        self.assertEqual(rows_on(0, Follows, user_following_id=1), 1)
+        self.assertEqual(db.session.get(User, 1).shard, 0)
+
+        db.session.add(Message(text='after the move', user_id=1))
+        db.session.commit()
+        self.assertEqual(rows_on(0, Message, user_id=1), 2)
+
+        with self.assertRaises(ValueError):
+            move_user(1, 5)
+
+    def test_move_user_keeps_deletions(self):
+        """Does a row deleted from the old shard during a move stay deleted?"""
+
+        db.session.add_all([Message(text='kept', user_id=1), Message(text='deleted meanwhile', user_id=1)])
+        db.session.commit()
+        deleted_id = db.session.scalar(select(Message.id).where(Message.text == 'deleted meanwhile'))
+
+        # Right after the first copy is committed to the new shard
+        def delete_on_source(conn):
+            with shard_engines()[1].begin() as source:
+                source.execute(delete(Message.__table__).where(Message.__table__.c.id == deleted_id))
+
+        event.listen(shard_engines()[0], 'commit', delete_on_source, once=True)
+        self.assertEqual(move_user(1, 0), 1)
+
+        self.assertEqual(rows_on(0, Message, user_id=1), 1)
+        self.assertEqual(rows_on(0, Message, id=deleted_id), 0)
+
+    def test_export_across_shards(self):
+        """Does an export join likes and follows with rows on other shards?"""
+
+        user3 = User.signup('testuser3', 'test3@test.com', 'testpassword', None)
+        db.session.commit()
+        db.session.add(Message(text='liked', user_id=2))
+        db.session.commit()
+        message_id = db.session.scalar(select(Message.id).where(Message.user_id == 2))
+
+        # user 1 is on shard 1, user 2 on shard 0 and user 3 on shard 1
+        db.session.add_all([Likes(user_id=1, message_id=message_id),
+                            Follows(user_following_id=1, user_being_followed_id=2),
+                            Follows(user_following_id=2, user_being_followed_id=1),
+                            Follows(user_following_id=user3.id, user_being_followed_id=1)])
+        db.session.commit()
+
+        records = [json.loads(line) for line in ''.join(export_stream(1)).splitlines()]
+        by_type = {}
+        for record in records:
+            by_type.setdefault(record['type'], []).append(record)
+
+        like, = by_type['like']
+        self.assertEqual((like['message_id'], like['username'], like['text']), (message_id, 'testuser2', 'liked'))
+        self.assertEqual([r['id'] for r in by_type['follower']], [2, user3.id])
+        self.assertEqual([r['username'] for r in by_type['following']], ['testuser2'])
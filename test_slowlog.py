@@ -0,0 +1,100 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+from sqlalchemy.orm.session import close_all_sessions
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import create_app
+from models import db, User
+from slowlog import explain, normalize, read_log, read_only, top_offenders
+
+# Every statement counts as slow for this module's app
+log_path = os.path.join(tempfile.mkdtemp(), 'slow.log')
+os.environ['SLOW_QUERY_MS'] = '0.001'
+os.environ['SLOW_QUERY_LOG'] = log_path
+try:
+    app = create_app(csrf=False)
+finally:
+    del os.environ['SLOW_QUERY_MS'], os.environ['SLOW_QUERY_LOG']
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging slow statements with their plans."""
+
+    def setUp(self):
+        app.app_context().push()
+        close_all_sessions()
+        db.drop_all()
+        db.create_all()
+
+        User.signup('testuser', 'test@test.com', 'testpassword', None)
+        db.session.commit()
+
+    def test_normalize(self):
+        """Do statements differing only in their values normalize the same?"""
+
+        self.assertEqual(normalize("SELECT * FROM users WHERE id IN (%(id_1)s, %(id_2)s) AND name = 'bob'"),
+                         normalize("SELECT *\nFROM users WHERE id IN (3) AND name = 'o''brien'"))
+
+    def test_slow_queries_logged(self):
+        """Are slow statements logged with their view and parameters, and explained?"""
+
+        app.test_client().get('/users/1')
+
+        records = []
+        for _ in range(50):
+            records = list(read_log(log_path, 5))
+            if any(record['kind'] == 'explain' for record in records):
+                break
+            time.sleep(0.1)
+
+        queries = [record for record in records if record['kind'] == 'query' and record['view'] == 'users_show']
+        self.assertTrue(queries)
+        self.assertIn(1, queries[0]['parameters'].values())
+
+        signups = [record for record in records
+                   if record['kind'] == 'query' and record['statement'].startswith('INSERT INTO users')]
+        self.assertEqual(signups[0]['parameters']['password'], '[redacted]')
+
+        plans = [record for record in records if record['kind'] == 'explain']
+        self.assertTrue(any('plan' in record for record in plans))
+
+        top = top_offenders(records, limit=3, order='calls')
+        self.assertEqual(len(top), 3)
+        self.assertGreaterEqual(top[0]['calls'], top[1]['calls'])
+
+    def test_explain_without_side_effects(self):
+        """Are only read-only statements analyzed, so nothing runs twice?"""
+
+        self.assertTrue(read_only("SELECT * FROM users WHERE id = %(id)s"))
+        self.assertFalse(read_only("WITH moved AS (DELETE FROM users RETURNING *) SELECT * FROM moved"))
+        self.assertFalse(read_only("SELECT pg_advisory_xact_lock(1)"))
+        self.assertFalse(read_only("SELECT nextval('messages_id_seq')"))
+        self.assertFalse(read_only("SELECT * FROM users FOR UPDATE"))
+
+        plan = explain(db.engine, "SELECT * FROM users", {}, analyze=True)
+        self.assertIn('actual time', plan)
+
+        plan = explain(db.engine, "SELECT * FROM users", {})
+        self.assertNotIn('actual time', plan)
+
+        plan = explain(db.engine, "WITH moved AS (DELETE FROM users RETURNING *) SELECT * FROM moved", {},
+                       analyze=True)
+        self.assertNotIn('actual time', plan)
+        self.assertEqual(User.query.count(), 1)
@@ -0,0 +1,119 @@
+"""App startup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_startup.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import app as app_module
+from app import create_app
+from assets import compile_templates
+from models import db
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Three requests each waiting a second on PostgreSQL, and a bcrypt hash,
+# in greenlets of one monkey-patched process
+GEVENT_RUN = """
+from gevent import monkey
+monkey.patch_all()
+
+import time
+import gevent
+from app import create_app
+from cooperative import is_cooperative, offload
+from models import bcrypt, db
+
+app = create_app(csrf=False)
+
+def wait():
+    with app.app_context():
+        return db.session.execute(db.text('SELECT pg_sleep(1), pg_backend_pid()')).one()[1]
+
+started = time.perf_counter()
+jobs = [gevent.spawn(wait) for _ in range(3)]
+hashed = offload(bcrypt.generate_password_hash, 'password')
+gevent.joinall(jobs, raise_error=True)
+elapsed = time.perf_counter() - started
+
+assert is_cooperative()
+assert len({job.value for job in jobs}) == 3, "a session was shared between greenlets"
+assert elapsed < 2, f"took {elapsed:.1f} s"
+assert bcrypt.check_password_hash(hashed, 'password')
+"""
+
+
+class StartupTestCase(TestCase):
+    """Test lazy, fork-friendly app construction."""
+
+    def test_import_is_lazy(self):
+        """Does importing the module leave building the default app until it's used?"""
+
+        self.assertNotIn('app', vars(app_module))
+        self.assertNotIn('numpy', vars(app_module))
+
+        # Nor, in a fresh process, import gevent without monkey-patching
+        result = subprocess.run([sys.executable, '-c', "import sys, app; print('gevent' in sys.modules)"],
+                                cwd=HERE, capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=HERE))
+        self.assertEqual(result.stdout.strip(), 'False', result.stderr[-2000:])
+
+    def test_reset_after_fork(self):
+        """Does a forked worker get fresh connections and per-worker state?"""
+
+        app = create_app(csrf=False)
+        broadcaster = app.extensions['broadcaster']
+        trends = app.extensions['trends']
+
+        with app.app_context():
+            db.session.execute(db.text('SELECT 1'))
+            db.session.remove()
+            pool = db.engine.pool
+
+        pid = os.fork()
+        if pid == 0:
+            with app.app_context():
+                fresh = (app.extensions['broadcaster'] is not broadcaster
+                         and app.extensions['trends'] is not trends
+                         and db.engine.pool is not pool
+                         and db.session.execute(db.text('SELECT 1')).scalar() == 1)
+            os._exit(0 if fresh else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_template_cache(self):
+        """Are templates compiled into the cache and loaded from it?"""
+
+        os.environ['TEMPLATE_CACHE_FOLDER'] = folder = os.path.join(tempfile.mkdtemp(), 'jinja')
+        try:
+            builder = create_app(csrf=False)
+            self.assertGreater(compile_templates(builder), 10)
+            self.assertTrue(os.listdir(folder))
+
+            app = create_app(csrf=False)
+            self.assertIsNotNone(app.jinja_env.bytecode_cache)
+            self.assertEqual(app.test_client().get('/login').status_code, 200)
+        finally:
+            del os.environ['TEMPLATE_CACHE_FOLDER']
+
+    def test_gevent(self):
+        """Under gevent, do greenlets get their own sessions and wait on the database side by side?"""
+
+        result = subprocess.run([sys.executable, '-c', GEVENT_RUN], cwd=HERE, capture_output=True, text=True,
+                                env=dict(os.environ, PYTHONPATH=HERE))
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
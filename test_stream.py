@@ -0,0 +1,218 @@
+"""Live timeline stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_stream.py
+
+
+import os
+from unittest import TestCase
+from flask import session
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import app as app_module
+from app import create_app, start_worker, CURR_USER_KEY
+from stream import Broadcaster, Subscription, format_event
+
+app = create_app(csrf=False)
+
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+
+class TimelineStreamTestCase(TestCase):
+    """Test the Server-Sent Events timeline."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        app.app_context().push()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser1 = User.signup(username="testuser",
+                                     email="test@test.com",
+                                     password="testuser",
+                                     image_url=None)
+
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="testuser2",
+                                     image_url=None)
+
+        self.testuser3 = User.signup(username="testuser3",
+                                     email="test3@test.com",
+                                     password="testuser3",
+                                     image_url=None)
+        db.session.commit()
+
+        self.testuser1.following.append(self.testuser2)
+
+        self.msg1 = Message(text='Followed message', user_id=self.testuser2.id)
+        self.msg2 = Message(text='Stranger message', user_id=self.testuser3.id)
+        db.session.add_all([self.msg1, self.msg2])
+        db.session.commit()
+
+    def test_stream_unauthorized(self):
+        """Do anonymous users get turned away?"""
+
+        resp = self.client.get('/stream/timeline')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_stream_resume(self):
+        """Does a client resuming from Last-Event-ID get the messages it missed?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.get('/stream/timeline', headers={'Last-Event-ID': '0'}, buffered=False)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+
+            chunks = iter(resp.response)
+            self.assertIn(b'retry:', next(chunks))
+
+            event = next(chunks).decode()
+            self.assertIn(f'id: {self.msg1.id}', event)
+            self.assertIn('Followed message', event)
+            self.assertNotIn('Stranger message', event)
+
+            resp.close()
+            self.assertEqual(app.extensions['broadcaster'].connection_count, 0)
+
+    def test_stream_connection_cap(self):
+        """Are clients turned away once the worker is full?"""
+
+        broadcaster = app.extensions['broadcaster']
+        broadcaster.max_connections = 1
+        other = Subscription([self.testuser2.id], queue_size=10)
+        broadcaster._subscribers.add(other)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser1.id
+
+                resp = c.get('/stream/timeline')
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('Retry-After', resp.headers)
+        finally:
+            broadcaster.unsubscribe(other)
+            broadcaster.max_connections = app.config['STREAM_MAX_CONNECTIONS']
+
+    def test_stream_sync_worker(self):
+        """Does a worker serving one request at a time refuse live connections?"""
+
+        broadcaster = app.extensions['broadcaster']
+        # start_worker sets up every app built in this process
+        caps = {other: other.extensions['broadcaster'].max_connections for other in list(app_module._apps)}
+
+        try:
+            start_worker(concurrency=4)
+            self.assertEqual(broadcaster.max_connections, 3)
+
+            start_worker(concurrency=1)
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser1.id
+
+                resp = c.get('/stream/timeline')
+                self.assertEqual(resp.status_code, 503)
+                self.assertNotIn('Retry-After', resp.headers)
+        finally:
+            for other, cap in caps.items():
+                other.extensions['broadcaster'].max_connections = cap
+
+    def test_stream_not_iterated(self):
+        """Is no connection slot taken by a stream that is never sent?"""
+
+        # Dispatched directly: the test client always reads the first chunk
+        with app.test_request_context('/stream/timeline'):
+            session[CURR_USER_KEY] = self.testuser1.id
+            resp = app.full_dispatch_request()
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(app.extensions['broadcaster'].connection_count, 0)
+            resp.close()
+
+        self.assertEqual(app.extensions['broadcaster'].connection_count, 0)
+
+    def test_subscribe_replays_since_mark(self):
+        """Does a client subscribing late get the events published since its mark?"""
+
+        broadcaster = Broadcaster(app, replay_size=2)
+        broadcaster._seed()
+
+        since = broadcaster._sequence
+        broadcaster.publish([{'id': 1, 'user_id': self.testuser2.id},
+                             {'id': 2, 'user_id': self.testuser3.id}])
+        subscription = broadcaster.subscribe([self.testuser2.id], since)
+        self.assertEqual(subscription.queue.get_nowait()['id'], 1)
+        self.assertTrue(subscription.queue.empty())
+        self.assertFalse(subscription.overflowed)
+
+        broadcaster.publish([{'id': 3, 'user_id': self.testuser2.id}])
+        late = broadcaster.subscribe([self.testuser2.id], since)
+        self.assertTrue(late.overflowed)
+
+    def test_fetch_new_late_commit(self):
+        """Is a message committed after one with a higher id still published?"""
+
+        broadcaster = Broadcaster(app)
+        broadcaster._seed()
+        self.assertEqual(broadcaster.fetch_new(), [])
+
+        later = Message(id=self.msg2.id + 5, text='Committed first', user_id=self.testuser2.id)
+        db.session.add(later)
+        db.session.commit()
+        self.assertEqual([event['text'] for event in broadcaster.fetch_new()], ['Committed first'])
+        # Only the ids skipped over are looked at again
+        self.assertEqual(set(broadcaster._gaps), {self.msg2.id + offset for offset in (1, 2, 3, 4)})
+
+        earlier = Message(id=self.msg2.id + 2, text='Committed late', user_id=self.testuser2.id)
+        db.session.add(earlier)
+        db.session.commit()
+        self.assertEqual([event['text'] for event in broadcaster.fetch_new()], ['Committed late'])
+        self.assertEqual(broadcaster.fetch_new(), [])
+        self.assertNotIn(self.msg2.id + 2, broadcaster._gaps)
+
+        # Ids that never turn up are given up on
+        broadcaster.gap_seconds = 0
+        self.assertEqual(broadcaster.fetch_new(), [])
+        self.assertEqual(broadcaster._gaps, {})
+
+    def test_publish_filters_authors(self):
+        """Does the broadcaster only deliver messages from followed users?"""
+
+        broadcaster = app.extensions['broadcaster']
+        subscription = Subscription([self.testuser2.id], queue_size=10)
+        broadcaster._subscribers.add(subscription)
+
+        try:
+            broadcaster.publish([{'id': 1, 'user_id': self.testuser2.id},
+                                 {'id': 2, 'user_id': self.testuser3.id}])
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+        self.assertEqual(subscription.queue.qsize(), 1)
+        self.assertEqual(subscription.queue.get()['id'], 1)
+
+    def test_format_event(self):
+        """Are events framed with their id so clients can resume?"""
+
+        frame = format_event({'id': 7, 'user_id': 1, 'text': 'hi'})
+        self.assertTrue(frame.startswith('id: 7\nevent: warble\ndata: '))
+        self.assertTrue(frame.endswith('\n\n'))
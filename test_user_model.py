@@ -258,3 +258,25 @@ class UserModelTestCase(TestCase):
                 username="testuser",
                 password="HASHED_PASSWORD"
             )
+
+    def test_user_liked_message_ids(self):
+        """Does liked_message_ids only return liked messages out of the ones asked about?"""
+
+        with app.app_context():
+            u1 = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+            u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD")
+            db.session.add_all([u1, u2])
+            db.session.commit()
+
+            m1 = Message(text='First', user_id=u2.id)
+            m2 = Message(text='Second', user_id=u2.id)
+            m3 = Message(text='Third', user_id=u2.id)
+            db.session.add_all([m1, m2, m3])
+            db.session.commit()
+
+            u1.likes.extend([m1, m3])
+            db.session.commit()
+
+            self.assertEqual(u1.liked_message_ids([m1.id, m2.id]), {m1.id})
+            self.assertEqual(u1.liked_message_ids([]), set())
+            self.assertEqual(u2.liked_message_ids([m1.id, m2.id, m3.id]), set())
@@ -1,11 +1,18 @@
 """User views tests."""
 
+import gzip
+import io
+import json
 import os
+import tempfile
+import time
+from datetime import datetime, timedelta
 from pprint import pprint
 from unittest import TestCase
+from PIL import Image
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import close_all_sessions
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, LikeCounterShard, Notification
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,6 +24,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import create_app, CURR_USER_KEY
+from archive import archive_batch
+from counters import compact_like_shards, like_counts
+from export import export_stream
+from likes import LikeBuffer
+from ranking import load_affinities
+from recommendations import build_suggestions, normalize, score_chunk
 
 app = create_app(csrf=False)
 
@@ -127,6 +140,56 @@ class UserViewsGetTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn('<div class="card user-card">\n', html)
 
+    def test_compressed_pages(self):
+        """
+        Are streamed pages gzipped for clients that accept it?
+        """
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            response = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.content_encoding, 'gzip')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertIn('@testuser2', gzip.decompress(response.data).decode())
+
+            # Too small to be worth it
+            response = client.get('/api/likes/state?ids=1', headers={'Accept-Encoding': 'gzip'})
+            self.assertIsNone(response.content_encoding)
+
+            response = client.get('/users')
+            self.assertIsNone(response.content_encoding)
+            self.assertIn('@testuser2', response.text)
+
+    def test_users_list_pages(self):
+        """
+        Is the user list paginated, and can it be sorted by followers?
+        """
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with self.client as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.user1.id
+
+                client.post(f'/users/follow/{self.user2.id}')
+                self.assertEqual(User.query.get(self.user2.id).follower_count, 1)
+
+                response = client.get('/users?order=followers')
+                self.assertIn('@testuser2', response.text)
+                self.assertNotIn('@testuser<', response.text)
+                self.assertIn(f'after=1.{self.user2.id}', response.text)
+
+                response = client.get(f'/users?order=followers&after=1.{self.user2.id}')
+                self.assertIn('@testuser<', response.text)
+
+                response = client.get(f'/users?order=newest&after={self.user1.id}')
+                self.assertIn('Sorry, no users found', response.text)
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
     def test_show_user_home(self):
         """
         Can we get a user's home with messages
@@ -198,6 +261,52 @@ class UserViewsGetTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn('<p>@testuser</p>', html)
 
+    def test_export_user(self):
+        """Can a user download their account, and resume a broken download?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            response = client.get(f'/users/{self.user1.id}/export')
+            self.assertEqual(response.status_code, 200)
+
+            records = [json.loads(line) for line in response.text.splitlines()]
+            self.assertEqual([r['type'] for r in records], ['message', 'message', 'complete'])
+
+            with app.test_request_context():
+                lines = list(export_stream(self.user1.id, checkpoint_every=1))
+            token = json.loads(lines[1])['resume']
+
+            response = client.get(f'/users/{self.user1.id}/export?resume={token}')
+            records = [json.loads(line) for line in response.text.splitlines()]
+            self.assertEqual(records[0]['id'], self.u2_m1.id)
+
+            response = client.get(f'/users/{self.user1.id}/export?format=csv')
+            self.assertTrue(response.text.startswith('type,id,'))
+            self.assertIn('This is a test message', response.text)
+
+            response = client.get(f'/users/{self.user2.id}/export', follow_redirects=True)
+            self.assertIn('Access unauthorized', response.text)
+
+    def test_export_archived_like(self):
+        """Does an export include likes of archived messages?"""
+
+        old = Message(text='Ancient message', user_id=self.user2.id,
+                      timestamp=datetime.utcnow() - timedelta(days=1000))
+        db.session.add(old)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user1.id, message_id=old.id))
+        db.session.commit()
+        archive_batch(datetime.utcnow() - timedelta(days=365))
+
+        with app.test_request_context():
+            records = [json.loads(line) for line in export_stream(self.user1.id)]
+
+        likes = [record for record in records if record['type'] == 'like']
+        self.assertEqual([like['text'] for like in likes], ['Ancient message'])
+        self.assertEqual(likes[0]['username'], self.user2.username)
+
     def test_edit_user_profile(self):
         """
         Can we get a user profile form?
@@ -274,6 +383,25 @@ class UserViewsPostTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn('@testuser', html)
 
+    def test_flash_shown_once(self):
+        """
+        Is a flashed message on a streamed page gone from the next one?
+        """
+
+        with self.client as client:
+            response = client.post('/login', data={'username': 'testuser',
+                                                   'password': 'testpassword'}, follow_redirects=True)
+            self.assertIn('Hello, testuser!', response.text)
+
+            self.assertNotIn('Hello, testuser!', client.get('/').text)
+            self.assertNotIn('Hello, testuser!', client.get('/users').text)
+
+            # The user directory is streamed too
+            with client.session_transaction() as session:
+                session['_flashes'] = [('success', 'Directory flash')]
+            self.assertIn('Directory flash', client.get('/users').text)
+            self.assertNotIn('Directory flash', client.get('/users').text)
+
     def test_add_remove_like(self):
         """
         Can a user like or unlike a message?
@@ -295,6 +423,188 @@ class UserViewsPostTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(len(self.user1.likes), 0)
 
+    def test_like_counts(self):
+        """
+        Are like counts kept up to date, including sharded counts for hot messages?
+        """
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            client.post(f'/messages/{self.u2_m1.id}/like')
+            self.assertEqual(like_counts([Message.query.get(self.u2_m1.id)])[self.u2_m1.id], 1)
+
+            # Every message counts as hot now, so the unlike goes to a shard
+            app.config['LIKE_COUNTER_HOT_THRESHOLD'] = 0
+            try:
+                client.post(f'/messages/{self.u2_m1.id}/like')
+            finally:
+                app.config['LIKE_COUNTER_HOT_THRESHOLD'] = 1000
+
+            msg = Message.query.get(self.u2_m1.id)
+            self.assertEqual(msg.like_count, 1)
+            self.assertEqual(LikeCounterShard.query.count(), 1)
+            self.assertEqual(like_counts([msg])[msg.id], 0)
+
+            compact_like_shards()
+            msg = Message.query.get(self.u2_m1.id)
+            self.assertEqual(msg.like_count, 0)
+            self.assertEqual(LikeCounterShard.query.count(), 0)
+
+    def test_likes_state(self):
+        """
+        Does the like-state API only report the requested messages the user liked?
+        """
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            client.post(f'/messages/{self.u2_m1.id}/like')
+
+            response = client.get(f'/api/likes/state?ids={self.u1_m1.id},{self.u2_m1.id}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['liked'], [self.u2_m1.id])
+
+            response = client.get(f'/api/likes/state?ids={self.u1_m1.id}')
+            self.assertEqual(response.json['liked'], [])
+
+            response = client.get('/api/likes/state?ids=1,abc')
+            self.assertEqual(response.status_code, 400)
+
+    def test_likes_batch(self):
+        """
+        Are batched likes buffered, coalesced and written in one go?
+        """
+
+        buffer = app.extensions['likes']
+        app.extensions['likes'] = LikeBuffer(app, tempfile.mkdtemp(), flush_seconds=3600)
+        try:
+            with self.client as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = self.user1.id
+
+                response = client.post('/api/likes', json={str(self.u2_m1.id): True,
+                                                           str(self.u1_m1.id): True, '999999': False})
+                self.assertEqual(response.status_code, 202)
+                self.assertEqual(response.json['accepted'], [self.u2_m1.id])
+                self.assertEqual(set(response.json['errors']), {str(self.u1_m1.id), '999999'})
+
+                # Not written yet, but this worker already shows it
+                self.assertEqual(Likes.query.count(), 0)
+                response = client.get(f'/api/likes/state?ids={self.u2_m1.id}')
+                self.assertEqual(response.json['liked'], [self.u2_m1.id])
+
+                # Toggled off and on again: one intent, one row
+                client.post('/api/likes', json={str(self.u2_m1.id): False})
+                client.post('/api/likes', json={str(self.u2_m1.id): True})
+                self.assertEqual(app.extensions['likes'].flush(), 1)
+
+                self.assertEqual(Likes.query.count(), 1)
+                self.assertEqual(like_counts([Message.query.get(self.u2_m1.id)])[self.u2_m1.id], 1)
+                self.assertEqual(Notification.query.filter_by(kind='like').count(), 1)
+                self.assertEqual(os.listdir(app.extensions['likes'].folder), [])
+
+                response = client.post('/api/likes', json={str(self.u2_m1.id): 'yes'})
+                self.assertEqual(response.status_code, 400)
+        finally:
+            app.extensions['likes'] = buffer
+
+    def test_likes_journal_recovery(self):
+        """
+        Are likes journaled by a worker that died before writing them recovered?
+        """
+
+        folder = tempfile.mkdtemp()
+        # Beyond the largest pid Linux hands out, so never a live process
+        with open(os.path.join(folder, 'likes-4194305-0.log'), 'w') as f:
+            f.write(json.dumps([self.user1.id, self.u2_m1.id, True]) + '\n')
+            f.write('[1, 2, tr')
+
+        self.assertEqual(LikeBuffer(app, folder).flush(), 1)
+        self.assertEqual(Likes.query.filter_by(user_id=self.user1.id, message_id=self.u2_m1.id).count(), 1)
+        self.assertEqual(os.listdir(folder), [])
+
+    def test_likes_journal_recovered_at_start(self):
+        """
+        Are dead workers' journals written as a worker starts, without clobbering a reused pid's?
+        """
+
+        folder = tempfile.mkdtemp()
+        # A predecessor with our pid, and one that's certainly dead
+        with open(os.path.join(folder, f'likes-{os.getpid()}-0.log'), 'w') as f:
+            f.write(json.dumps([self.user1.id, self.u2_m1.id, True]) + '\n')
+        with open(os.path.join(folder, 'likes-4194305-0.log'), 'w') as f:
+            f.write(json.dumps([self.user2.id, self.u1_m1.id, True]) + '\n')
+
+        LikeBuffer(app, folder, flush_seconds=0.01).recover()
+        for _ in range(100):
+            if not os.listdir(folder):
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(os.listdir(folder), [])
+        self.assertEqual(sorted((like.user_id, like.message_id) for like in Likes.query),
+                         sorted([(self.user1.id, self.u2_m1.id), (self.user2.id, self.u1_m1.id)]))
+
+    def test_follow_suggestions(self):
+        """
+        Are friends of friends suggested, and served from the API?
+        """
+
+        user3 = User.signup('testuser3', 'test3@test.com', 'testpassword', None)
+        db.session.commit()
+
+        # testuser follows testuser2, who follows testuser3
+        self.user1.following.append(self.user2)
+        self.user2.following.append(user3)
+        db.session.commit()
+
+        build_suggestions(k=5, echo=lambda *args: None)
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            response = client.get(f'/api/users/{self.user1.id}/suggestions')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([s['id'] for s in response.json['suggestions']], [user3.id])
+
+            response = client.get('/')
+            self.assertIn('Who to follow', response.text)
+
+            response = client.get(f'/api/users/{self.user2.id}/suggestions')
+            self.assertEqual(response.status_code, 401)
+
+    def test_follow_suggestions_bounded(self):
+        """
+        Do scores stay sparse when everyone follows the same account?
+        """
+
+        import numpy as np
+        from scipy import sparse
+
+        # Users 10 and up all follow user 1, and one of users 2-9
+        users = np.arange(10, 3010)
+        follows = sparse.csr_matrix((np.ones(2 * len(users), dtype=np.float32),
+                                     (np.concatenate([users, users]),
+                                      np.concatenate([np.ones_like(users), 2 + users % 8]))),
+                                    shape=(3010, 3010))
+
+        # Every user is similar to every other one...
+        normalized = normalize(follows, max_followers=10000)
+        self.assertEqual((normalized[10:1010] @ normalized.T).getnnz(axis=1).min(), 3000)
+
+        # ...but only the ten nearest count, each following two accounts
+        scores = score_chunk(follows, normalized, 10, 1010, neighbors=10)
+        self.assertLessEqual(scores.getnnz(axis=1).max(), 20)
+
+        # Too popular an account doesn't make its followers similar at all
+        normalized = normalize(follows, max_followers=1000)
+        self.assertEqual(normalized[:, 1].nnz, 0)
+        self.assertEqual((normalized[10:1010] @ normalized.T).getnnz(axis=1).max(), len(users) // 8)
+
     def test_follow_unfollow(self):
         """
         Can a user follow and unfollow another user?
@@ -317,6 +627,85 @@ class UserViewsPostTestCase(TestCase):
             self.assertEqual(len(self.user1.following), 0)
             self.assertEqual(len(self.user2.followers), 0)
 
+    def test_notifications(self):
+        """
+        Do mentions, follows and likes notify, with a maintained unread count?
+        """
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            client.post('/messages/new', data={'text': 'Hi @testuser2 and @nobody, and me @testuser'})
+            client.post(f'/users/follow/{self.user2.id}')
+            client.post(f'/messages/{self.u2_m1.id}/like')
+
+            self.assertEqual(db.session.get(User, self.user2.id).unread_notifications, 3)
+            self.assertEqual(db.session.get(User, self.user1.id).unread_notifications, 0)
+
+            # Unliking takes the like notification back
+            client.post(f'/messages/{self.u2_m1.id}/like')
+            self.assertEqual(db.session.get(User, self.user2.id).unread_notifications, 2)
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user2.id
+
+            html = client.get('/').text
+            self.assertIn('<span class="badge bg-primary unread-count">2</span>', html)
+
+            html = client.get('/notifications').text
+            self.assertIn('mentioned you', html)
+            self.assertIn('followed you', html)
+            self.assertNotIn('liked your warble', html)
+            self.assertNotIn('unread-count', html)
+            self.assertEqual(db.session.get(User, self.user2.id).unread_notifications, 0)
+
+            # Deleting the message removes its mention
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+            mention = Message.query.filter(Message.text.startswith('Hi @')).one()
+            client.post(f'/messages/{mention.id}/delete')
+            self.assertEqual(Notification.query.filter_by(user_id=self.user2.id).count(), 1)
+
+    def test_top_feed(self):
+        """
+        Does the top feed rank a popular message above a newer one?
+        """
+
+        popular = Message(text='Popular message', user_id=self.user2.id, like_count=1000,
+                          timestamp=datetime.utcnow() - timedelta(hours=3))
+        fresh = Message(text='Fresh message', user_id=self.user1.id)
+        db.session.add_all([popular, fresh])
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            html = client.get('/').text
+            self.assertLess(html.index('Fresh message'), html.index('Popular message'))
+            self.assertIn('data-stream', html)
+
+            html = client.get('/?feed=top').text
+            self.assertLess(html.index('Popular message'), html.index('Fresh message'))
+            self.assertNotIn('data-stream', html)
+
+    def test_affinities_newest_likes(self):
+        """Are affinities counted over only the user's newest likes?"""
+
+        older = Message(text='Older message', user_id=self.user2.id)
+        newer = Message(text='Newer message', user_id=self.user2.id)
+        db.session.add_all([older, newer])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user1.id, message_id=older.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user1.id, message_id=newer.id))
+        db.session.commit()
+
+        self.assertEqual(load_affinities(self.user1.id), {self.user2.id: 2})
+        self.assertEqual(load_affinities(self.user1.id, limit=1), {self.user2.id: 1})
+
     def test_user_profile_edit(self):
         """
         Can we submit a profile update form?
@@ -340,6 +729,57 @@ class UserViewsPostTestCase(TestCase):
             self.assertIn('@editeduser', html)
             self.assertIn('edited user bio', html)
 
+    def test_upload_profile_images(self):
+        """
+        Are uploaded images stored with sized variants and cached for good?
+        """
+
+        app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+
+        def png(width, height):
+            data = io.BytesIO()
+            Image.new('RGB', (width, height), 'teal').save(data, 'PNG')
+            data.seek(0)
+            return data
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.user1.id
+
+            response = client.post('/users/profile',
+                                   data={'username': 'testuser',
+                                         'email': 'test@test.com',
+                                         'image': (png(800, 600), 'me.png'),
+                                         'header_image': (png(2000, 900), 'header.png'),
+                                         'password': 'testpassword'},
+                                   content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 302)
+
+            user = db.session.get(User, self.user1.id)
+            self.assertRegex(user.image_url, r'^/images/[0-9a-f]{64}\.jpg$')
+            avatar = user.image_url.replace('.jpg', '-avatar.jpg')
+            self.assertIn(avatar, client.get(f'/users/{user.id}').text)
+
+            response = client.get(avatar)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size, (200, 200))
+
+            # Variants that weren't made at upload time are made on request
+            response = client.get(user.image_url.replace('.jpg', '-header.jpg'))
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size, (1500, 500))
+
+            self.assertEqual(client.get(user.image_url.replace('.jpg', '-huge.jpg')).status_code, 404)
+            self.assertEqual(client.get('/images/' + '0' * 64 + '-avatar.jpg').status_code, 404)
+
+            response = client.post('/users/profile',
+                                   data={'username': 'testuser',
+                                         'email': 'test@test.com',
+                                         'image': (io.BytesIO(b'not an image'), 'me.png'),
+                                         'password': 'testpassword'},
+                                   content_type='multipart/form-data')
+            self.assertIn("isn&#39;t an image", response.text)
+
     def test_delete_user(self):
         """
         Can we delete a user?
@@ -0,0 +1,252 @@
+"""Trending hashtags.
+
+Each worker counts the hashtags it sees in a count-min sketch and keeps the
+heaviest of them in a small top-K heap, so memory stays fixed however many
+distinct tags go by. Every TRENDING_FLUSH_SECONDS the worker adds its heavy
+hitters to `tag_bucket_counts` (one row per tag per time bucket, summed
+across workers) and starts over. The flush also rebuilds the `trending_tags`
+snapshot for each window from that small table, so the sidebar is a
+primary-key read and nothing ever aggregates over `messages`.
+
+A worker flushes when it records hashtags and at the end of any request
+once it's due, so one that sees no new hashtags still does its share and
+the snapshot keeps sliding forward. Flushes take turns on an advisory lock,
+and a failed one is logged rather than failing the request.
+"""
+
+import hashlib
+import heapq
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from sqlalchemy import text
+
+from models import db, TagBucketCount, TrendingTag, dialect_insert
+
+trending_cli = AppGroup('trending', help="Maintain trending hashtags.")
+
+# Sidebar windows, in seconds
+WINDOWS = {'1h': 3600, '24h': 86400}
+
+BUCKET_SECONDS = 300
+
+# pg_advisory_xact_lock key that flushes take turns on
+SNAPSHOT_LOCK = 0x7472656e64
+
+
+class CountMinSketch:
+    """Approximate counts for a stream of keys in fixed memory.
+
+    Estimates never undercount; they overcount by at most about
+    2 / width of the total with probability 1 - 2 ** -depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', bytes(array('L').itemsize * width)) for _ in range(depth)]
+
+    def _cells(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        for row in range(self.depth):
+            yield row, int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+
+    def add(self, key, count=1):
+        """Count `key` and return its new estimate."""
+
+        estimate = None
+        for row, cell in self._cells(key):
+            self.rows[row][cell] += count
+            value = self.rows[row][cell]
+            estimate = value if estimate is None else min(estimate, value)
+        return estimate
+
+    def estimate(self, key):
+        return min(self.rows[row][cell] for row, cell in self._cells(key))
+
+
+class TopK:
+    """The k keys with the highest counts seen so far.
+
+    Uses a min-heap with lazy deletion: when a key's count changes a new
+    entry is pushed, and stale entries are skipped when they reach the top.
+    """
+
+    def __init__(self, k=50):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def offer(self, key, count):
+        if key in self.counts or len(self.counts) < self.k:
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+        else:
+            smallest_count, smallest_key = self._smallest()
+            if count <= smallest_count:
+                return
+            heapq.heappop(self.heap)
+            del self.counts[smallest_key]
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, key))
+
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _smallest(self):
+        while True:
+            count, key = self.heap[0]
+            if self.counts.get(key) == count:
+                return count, key
+            heapq.heappop(self.heap)
+
+    def items(self):
+        """(key, count) pairs, highest first."""
+
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+class TrendTracker:
+    """This worker's hashtag counts since its last flush."""
+
+    def __init__(self, k=50, flush_seconds=60):
+        self.k = k
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.sketch = CountMinSketch()
+        self.top = TopK(self.k)
+        self.started = time.monotonic()
+
+    def record(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.top.offer(tag, self.sketch.add(tag))
+
+    def due(self):
+        return time.monotonic() - self.started >= self.flush_seconds
+
+    def take(self):
+        """Return the heavy hitters and start counting afresh."""
+
+        with self._lock:
+            items = self.top.items()
+            self._reset()
+        return items
+
+
+def bucket_for(when):
+    epoch = int(when.timestamp()) if when.tzinfo else int((when - datetime(1970, 1, 1)).total_seconds())
+    return datetime.utcfromtimestamp(epoch - epoch % BUCKET_SECONDS)
+
+
+def flush(items, now=None):
+    """Add a worker's heavy hitters to the shared bucket counts, then refresh the snapshot."""
+
+    now = now or datetime.utcnow()
+    _lock_snapshot()
+
+    if items:
+        stmt = dialect_insert(TagBucketCount)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['bucket_start', 'tag'],
+            set_={'count': TagBucketCount.count + stmt.excluded.count})
+        bucket = bucket_for(now)
+        db.session.execute(stmt, [{'bucket_start': bucket, 'tag': tag, 'count': count}
+                                  for tag, count in items])
+
+    refresh_snapshot(now)
+
+
+def refresh_snapshot(now=None, limit=10):
+    """Recompute `trending_tags` for every window from the bucket counts."""
+
+    now = now or datetime.utcnow()
+    _lock_snapshot()
+
+    for period, seconds in WINDOWS.items():
+        total = db.func.sum(TagBucketCount.count)
+        top = (db.session.query(TagBucketCount.tag, total)
+               .filter(TagBucketCount.bucket_start >= now - timedelta(seconds=seconds))
+               .group_by(TagBucketCount.tag)
+               .order_by(total.desc(), TagBucketCount.tag)
+               .limit(limit)
+               .all())
+
+        TrendingTag.query.filter_by(period=period).delete()
+        db.session.add_all(TrendingTag(period=period, rank=rank, tag=tag, count=count, computed_at=now)
+                           for rank, (tag, count) in enumerate(top))
+
+    # Buckets older than the longest window are no longer needed
+    oldest = now - timedelta(seconds=max(WINDOWS.values()) + BUCKET_SECONDS)
+    TagBucketCount.query.filter(TagBucketCount.bucket_start < oldest).delete()
+
+    db.session.commit()
+
+
+def _lock_snapshot():
+    """Wait for any other worker's flush, so two don't rewrite the snapshot at once."""
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SNAPSHOT_LOCK})
+
+
+def flush_due(tracker):
+    """Flush `tracker` if it's time. Failures are logged, and those counts dropped."""
+
+    if not tracker.due():
+        return
+    try:
+        flush(tracker.take())
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Couldn't flush trending hashtags")
+
+
+def record_hashtags(tag_lists):
+    """Count the hashtags of newly posted messages, flushing if it's time.
+
+    Call after the messages are committed.
+    """
+
+    tracker = current_app.extensions['trends']
+    for tags in tag_lists:
+        tracker.record(tags)
+    flush_due(tracker)
+
+
+def init_trending(app):
+    """Flush each worker's counts when due, even if it isn't seeing new hashtags."""
+
+    @app.teardown_request
+    def flush_trends(error):
+        tracker = app.extensions['trends']
+        if tracker.due():
+            # Whatever the request left uncommitted isn't ours to commit
+            db.session.rollback()
+            flush_due(tracker)
+
+
+def trending(period='1h'):
+    """The current snapshot for `period`, as TrendingTag rows in rank order."""
+
+    return TrendingTag.query.filter_by(period=period).order_by(TrendingTag.rank).all()
+
+
+@trending_cli.command('refresh')
+def refresh_command():
+    """Rebuild the trending snapshot from the bucket counts."""
+
+    refresh_snapshot()
+    for period in WINDOWS:
+        tags = ', '.join(f"#{t.tag} ({t.count})" for t in trending(period))
+        click.echo(f"{period}: {tags or '-'}")